@@ -0,0 +1,11 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# benchmarks/
+#
+
+
+# The `benchmarks` directory contains timing scripts for the preprocessing
+# and modelling stages. Each module can be ran directly from the project
+# root, e.g: `python -m src.benchmarks.text_normalization`
@@ -0,0 +1,42 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# boosting_engines.py
+#
+# Accuracy and fit time of the exact and histogram gradient boosting
+# engines, side by side, for the regressor (master table) and the
+# classifier (restaurant inspection table). Both engines are trained
+# on the same split and nothing is loaded from the registry.
+#
+
+import warnings
+
+import pandas as pd
+
+from src.models.prediction import ClosureClassifier, ClosureRegressor
+
+
+def run():
+    """
+    :return: dict of model name : `DataFrame` comparing the engines
+    """
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 20)
+
+    tables = {}
+    for model_class in [ClosureRegressor, ClosureClassifier]:
+        print("[ INF ] Comparing boosting engines of", model_class.__name__)
+        tables[model_class.__name__] = model_class().compare_boosting_engines(use_registry=False)
+
+    for name, table in tables.items():
+        print()
+        print("*** %s %s" % (name, '*' * (48 - len(name))))
+        print(table)
+
+    return tables
+
+
+if __name__ == '__main__':
+    warnings.simplefilter(action='ignore', category=FutureWarning)
+    run()
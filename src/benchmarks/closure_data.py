@@ -0,0 +1,120 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# closure_data.py
+#
+# Benchmark of the single pass restaurant half of `closure_data`
+# (one parse of the raw data, one grouped aggregation) against the
+# original two parses, three groupbys and two merges. Reports runtime
+# and peak traced memory of each.
+#
+
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+import src.preprocessing.fetch as fetch
+import src.preprocessing.merge as merge
+
+GROUP_KEYS = merge.GROUP_KEYS
+
+
+#
+# Original Path
+#
+
+
+def _total_restaurant_closure(restaurant_dataset):
+    r = restaurant_dataset[['is_closed'] + GROUP_KEYS]
+    r = r.loc[r['is_closed'] != 0]
+    return r.groupby(GROUP_KEYS, as_index=False).count()
+
+
+def _violation_distribution_table(restaurant_dataset):
+    r = restaurant_dataset[['is_closed'] + GROUP_KEYS + ['violation_code']]
+
+    dummies = pd.get_dummies(r['violation_code'], prefix='violation')
+    dummies = dummies[merge._closure_violations(r)]
+    r = r.join(dummies).drop('violation_code', axis=1)
+
+    r = r.loc[r['is_closed'] != 0].drop('is_closed', axis=1)
+
+    return r.groupby(GROUP_KEYS, as_index=False).sum()
+
+
+def _cuisine_distribution_table(restaurant_dataset):
+    r = restaurant_dataset[['is_closed'] + GROUP_KEYS + ['cuisine_description']]
+
+    r = r.loc[r['is_closed'] != 0].drop('is_closed', axis=1)
+
+    r = r.join(pd.get_dummies(r['cuisine_description'],
+                              prefix='cuisine')).drop('cuisine_description', axis=1)
+
+    return r.groupby(GROUP_KEYS, as_index=False).sum()
+
+
+def _two_pass(file_names):
+    r1 = fetch._build_restaurant_inspection_data(file_names, include_violation_code=True)
+    r2 = fetch._build_restaurant_inspection_data(file_names)
+
+    m = pd.merge(_total_restaurant_closure(r2), _violation_distribution_table(r1), on=GROUP_KEYS)
+    return pd.merge(m, _cuisine_distribution_table(r2), on=GROUP_KEYS)
+
+
+def _single_pass(file_names):
+    levels = fetch._build_restaurant_inspection_levels(file_names)
+    return merge._restaurant_closure_table(levels[True], levels[False])
+
+
+#
+# Benchmark
+#
+
+
+def _measure(f, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    result = f(*args)
+
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+def run(file_names=None):
+    """
+    Times both paths over the merged restaurant inspection set
+
+    :param file_names:  DOHMH CSV paths (new set, then original)
+    :return:            dict of path name : (seconds, peak bytes)
+    """
+    file_names = file_names or fetch.restaurant_inspection_files()
+
+    a, a_time, a_peak = _measure(_two_pass, file_names)
+    b, b_time, b_peak = _measure(_single_pass, file_names)
+
+    a = a.sort_values(GROUP_KEYS).reset_index(drop=True)
+    b = b.sort_values(GROUP_KEYS).reset_index(drop=True)
+    pd.testing.assert_frame_equal(a, b, check_dtype=False)
+
+    results = {'two pass': (a_time, a_peak), 'single pass': (b_time, b_peak)}
+
+    print("[ INF ] Groups:", len(b))
+    for k, (t, peak) in results.items():
+        print("%-12s %8.3fs  (%.1fx)  peak %8.1f MB" % (k, t, a_time / t, peak / 1024 ** 2))
+
+    return results
+
+
+if __name__ == '__main__':
+    missing = [f for f in fetch.restaurant_inspection_files() if not os.path.isfile(f)]
+    if missing:
+        print("[ ERR ] Restaurant inspection data not found:", ", ".join(missing))
+    else:
+        run()
@@ -0,0 +1,90 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# lookup_encoding.py
+#
+# Benchmark of the vectorized grade / action lookup encoding
+# against the original per-row `.apply` lambdas
+#
+
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import src.preprocessing.fetch as fetch
+
+RESTAURANT_INSPECTION_FILE = fetch.NYC_OPEN_DATA_DIR + 'DOHMH_New_York_City_Restaurant_Inspection_Results.csv'
+
+
+def _apply_encoding(df):
+    grades = ['c', 'b', 'a']
+    action_lookup = dict(fetch.ACTION_LOOKUP)
+    action_lookup[np.nan] = (False, 0)
+
+    grade = df['grade'].apply(lambda x: grades.index(x) + 1 if x in grades else 0)
+    is_closed = df['action'].apply(lambda x: action_lookup[x][0])
+    violation_count = df['action'].apply(lambda x: action_lookup[x][1])
+
+    return grade, is_closed, violation_count
+
+
+def _lookup_encoding(df):
+    grade = np.append(fetch.GRADE_LOOKUP_VALUES, 0)[fetch.lookup_codes(df['grade'], fetch.GRADE_LOOKUP, 'grade')]
+
+    action_codes = fetch.lookup_codes(df['action'], fetch.ACTION_LOOKUP, 'action', report_unknown=True)
+    is_closed = np.append(fetch.ACTION_LOOKUP_IS_CLOSED, False)[action_codes]
+    violation_count = np.append(fetch.ACTION_LOOKUP_VIOLATION_COUNT, 0)[action_codes]
+
+    return grade, is_closed, violation_count
+
+
+def _synthetic_frame(n=400000, seed=42):
+    rng = np.random.RandomState(seed)
+    actions = list(fetch.ACTION_LOOKUP.keys()) + [np.nan]
+
+    return pd.DataFrame({
+        'grade': rng.choice(['a', 'b', 'c', 'z', 'p', np.nan], n),
+        'action': np.array(actions, dtype=object)[rng.randint(0, len(actions), n)]
+    })
+
+
+def run(df, repeat=3):
+    """
+    Times both encodings on the normalized `grade` and `action` columns
+
+    :param df:      `DataFrame` with normalized `grade` and `action` columns
+    :param repeat:  Number of timed repetitions (best is reported)
+    :return:        dict of best times in seconds
+    """
+    a = _apply_encoding(df)
+    b = _lookup_encoding(df)
+    for x, y in zip(a, b):
+        assert np.array_equal(np.asarray(x), y), "Encodings differ"
+
+    results = {
+        'apply': min(timeit.repeat(lambda: _apply_encoding(df), number=1, repeat=repeat)),
+        'lookup': min(timeit.repeat(lambda: _lookup_encoding(df), number=1, repeat=repeat))
+    }
+
+    print("[ INF ] Rows:", len(df))
+    for k, v in results.items():
+        print("%-10s %8.3fs  (%.1fx)" % (k, v, results['apply'] / v))
+
+    return results
+
+
+if __name__ == '__main__':
+    if os.path.isfile(RESTAURANT_INSPECTION_FILE):
+        print("[ INF ] Using", RESTAURANT_INSPECTION_FILE)
+        frame = pd.read_csv(RESTAURANT_INSPECTION_FILE, dtype=fetch.RESTAURANT_INSPECTION_DTYPES,
+                            usecols=['GRADE', 'ACTION'])
+        frame = fetch.normalize_text(frame)
+    else:
+        print("[ INF ] Inspection data not found, using synthetic frame")
+        frame = _synthetic_frame(int(sys.argv[1]) if len(sys.argv) > 1 else 400000)
+
+    run(frame)
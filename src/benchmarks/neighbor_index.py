@@ -0,0 +1,158 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# neighbor_index.py
+#
+# Benchmark of the neighbor indexes of `ClosureClassifier.fit_knn`.
+# Each index is built over the training rows, then queried with every
+# restaurant of the inspection table (as when scoring the whole city).
+# Recall is the share of the neighbors found which are no farther than
+# the true k-th nearest neighbor, found by brute force. `scaling` times
+# the exact and 'lsh' indexes as the number of indexed rows grows.
+#
+
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import sklearn.metrics as metric
+from sklearn.neighbors import NearestNeighbors
+
+from src.models.prediction import ClosureClassifier, LSH_PROBES
+from src.preprocessing.fetch import fetch_restaurant_inspection_data
+
+# Probes of the 'lsh' index compared
+PROBES = [0, 2, LSH_PROBES, 8, 16]
+
+# Numbers of indexed rows timed by `scaling`, and the queries per size
+SIZES = [10000, 30000, 100000, 300000]
+SCALING_QUERIES = 2000
+
+
+def _recall(distances, exact_distances):
+    kth = exact_distances[:, -1:] * (1 + 1e-5) + 1e-6
+    return float((distances <= kth).mean())
+
+
+def run(probes=PROBES):
+    """
+    :param probes:  Probes of the 'lsh' index to compare
+    :return:        `DataFrame` of build and query time, recall, agreement
+                    with exact kNN and F1 on the test split per index
+    """
+    model = ClosureClassifier()
+    m = model.design_matrix()
+
+    x_train, y_train = m.x[:m.n_train], m.y[:m.n_train]
+    x_test, y_test = m.x[m.n_train:], m.y[m.n_train:]
+
+    queries = model.transform_rows(fetch_restaurant_inspection_data(columns=model.feature_cols))
+    print("[ INF ] Index of", x_train.shape[0], "rows, queried with", len(queries), "restaurants")
+
+    exact = NearestNeighbors(n_neighbors=30, algorithm='brute').fit(x_train.toarray() if hasattr(x_train, 'toarray')
+                                                                     else x_train)
+    exact_distances, _ = exact.kneighbors(queries)
+
+    configs = [('exact', None), ('ball_tree', None)] + [('lsh', p) for p in probes]
+    exact_pred = None
+    rows = []
+
+    for index, p in configs:
+        estimator = ClosureClassifier.knn_spec(model, index).estimator
+        if p is not None:
+            estimator.set_params(n_probes=p)
+
+        x = x_train.toarray() if index != 'exact' and hasattr(x_train, 'toarray') else x_train
+
+        start = time.perf_counter()
+        estimator.fit(x, y_train)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        distances, neighbors = estimator.kneighbors(queries)
+        query = time.perf_counter() - start
+
+        # The majority vote of the neighbors, as `predict` (ties are open),
+        # so the queries are only ran once
+        pred = (np.asarray(y_train)[neighbors].mean(axis=1) > 0.5).astype('int64')
+        if exact_pred is None:
+            exact_pred = pred
+
+        rows.append({'Index': index if p is None else 'lsh (%d probes)' % p,
+                     'Build (s)': build,
+                     'Query (s)': query,
+                     'Per row (us)': query / len(queries) * 1e6,
+                     'Recall': _recall(distances, exact_distances),
+                     'Agreement': float((pred == exact_pred).mean()),
+                     'F1': metric.f1_score(y_test, estimator.predict(x_test.toarray() if hasattr(x_test, 'toarray')
+                                                                     else x_test))})
+
+    table = pd.DataFrame(rows).set_index('Index')
+
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 20)
+    print(table)
+
+    return table
+
+
+def scaling(sizes=SIZES, n_queries=SCALING_QUERIES):
+    """
+    Times the 'exact' and 'lsh' indexes over training sets of each size,
+    drawn from the training rows with a small jitter of their nonzero
+    values (so that the drawn rows are not exact duplicates)
+
+    :param sizes:       Numbers of indexed rows
+    :param n_queries:   Number of restaurants queried per size
+    :return:            `DataFrame` of build and query time per index and
+                        size, and the candidates measured per 'lsh' query
+    """
+    model = ClosureClassifier()
+    m = model.design_matrix()
+
+    x = m.x[:m.n_train]
+    x, y = (x.toarray() if hasattr(x, 'toarray') else np.asarray(x)), np.asarray(m.y[:m.n_train])
+    queries = model.transform_rows(fetch_restaurant_inspection_data(columns=model.feature_cols))[:n_queries]
+
+    rng = np.random.RandomState(0)
+    rows = []
+
+    for n in sizes:
+        i = rng.randint(0, len(x), n)
+        x_n = (x[i] + rng.normal(0, 0.01, (n, x.shape[1])) * (x[i] != 0)).astype('float32')
+
+        for index in ['exact', 'lsh']:
+            estimator = ClosureClassifier.knn_spec(model, index).estimator
+
+            start = time.perf_counter()
+            estimator.fit(x_n, y[i])
+            build = time.perf_counter() - start
+
+            start = time.perf_counter()
+            estimator.kneighbors(queries)
+            query = time.perf_counter() - start
+
+            row = {'Rows': n, 'Index': index, 'Build (s)': build, 'Per row (us)': query / len(queries) * 1e6}
+            if index == 'lsh':
+                q = queries[:estimator.batch_size]
+                candidates = len(estimator._candidates(*estimator._project(q))[0]) / len(q)
+                row.update({'Candidates': candidates, 'Candidates (%)': candidates / n * 100})
+            rows.append(row)
+
+    table = pd.DataFrame(rows).set_index(['Rows', 'Index'])
+
+    pd.set_option('display.width', 200)
+    print(table)
+
+    return table
+
+
+if __name__ == '__main__':
+    warnings.simplefilter(action='ignore', category=FutureWarning)
+    if sys.argv[1:2] == ['--scaling']:
+        scaling([int(n) for n in sys.argv[2:]] or SIZES)
+    else:
+        run([int(p) for p in sys.argv[1:]] or PROBES)
@@ -0,0 +1,282 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# pipeline.py
+#
+# Benchmark suite of the ingestion to model pipeline over synthetic
+# data (see `synthetic.py`) at several scales. Each public stage is
+# timed cold (caches rebuilt) in its own process, so its peak RSS is
+# its own, and the results are compared to a stored baseline: a stage
+# slower, or using more memory, than the baseline by more than
+# `TOLERANCE` is flagged. Run from the project root with:
+#
+#   python -m src.benchmarks.pipeline [--scales 1 10 100] [--save-baseline]
+#
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import src.profiling as profiling
+from src.benchmarks.synthetic import generate
+
+#
+# Constants
+#
+
+BENCHMARK_DIR = "data/benchmarks/"
+BASELINE_FILE = BENCHMARK_DIR + "baseline.json"
+HISTORY_FILE = BENCHMARK_DIR + "history.jsonl"
+
+# Fraction by which a stage may be slower, or use more memory,
+# than its baseline before it is flagged
+TOLERANCE = 0.25
+
+# Differences under these are noise, and never flagged
+MIN_WALL_S = 0.5
+MIN_RSS_MB = 50
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+#
+# Cases
+#
+
+def _prepared(model_class):
+    # The model is prepared and its design matrix written
+    # before the timing, so only the fit is measured
+    m = model_class()
+    m.prepare()
+    m.design_matrix()
+    return m
+
+
+def _cases():
+    """
+    The benchmarked stages, in the order they are ran (later stages
+    read the tables cached by earlier ones, outside of their timing)
+
+    :return:    dict of case name : function of no arguments returning
+                the function to time
+    """
+    from src.models.prediction import ClosureClassifier, ClosureRegressor
+    from src.preprocessing.fetch import fetch_restaurant_inspection_data
+    from src.preprocessing.merge import closure_data, master
+
+    return {
+        'fetch_restaurant_inspection_data': lambda: lambda: fetch_restaurant_inspection_data(reload=True),
+        'closure_data': lambda: lambda: closure_data(reload=True),
+        'master': lambda: lambda: master(reload=True),
+        'ClosureClassifier.prepare': lambda: ClosureClassifier().prepare,
+        'ClosureRegressor.prepare': lambda: ClosureRegressor().prepare,
+        'ClosureClassifier.fit_gradient_boosting': lambda: _prepared(ClosureClassifier).fit_gradient_boosting,
+        'ClosureClassifier.fit_knn': lambda: _prepared(ClosureClassifier).fit_knn,
+        'ClosureClassifier.fit_neural_network': lambda: _prepared(ClosureClassifier).fit_neural_network,
+        'ClosureRegressor.fit_gradient_boosting': lambda: _prepared(ClosureRegressor).fit_gradient_boosting,
+        'ClosureRegressor.fit_lin_reg': lambda: _prepared(ClosureRegressor).fit_lin_reg,
+        'ClosureRegressor.fit_neural_network': lambda: _prepared(ClosureRegressor).fit_neural_network}
+
+
+def _run_case(name):
+    # Ran in the case's own process, from the scale's directory, with
+    # profiling enabled by the parent. The timed call is recorded as
+    # the stage 'bench.<name>'.
+    f = _cases()[name]()
+    model = getattr(f, '__self__', None)
+
+    with profiling.stage('bench.' + name) as s:
+        result = f()
+
+        if _is_fit(name):
+            # A fit's output is its training rows
+            s.output(model.matrix.y[:model.matrix.n_train])
+        else:
+            # Model methods build `self.df` rather than returning it
+            s.output(result if result is not None else getattr(model, 'df', None))
+
+
+def _is_fit(name):
+    return '.fit_' in name
+
+
+#
+# Suite
+#
+
+def _scale_dir(scale):
+    return os.path.join(BENCHMARK_DIR, '%gx' % scale)
+
+
+def _generate(scale, regenerate=False):
+    """
+    Generates the synthetic data of a scale, unless already generated
+
+    :return:    Number of raw inspection rows (DOHMH and DCA)
+    """
+    scale_dir = _scale_dir(scale)
+    rows_file = os.path.join(scale_dir, 'rows.json')
+
+    if regenerate or not os.path.isfile(rows_file):
+        rows = generate(scale_dir, scale)
+        with open(rows_file, 'w') as f:
+            json.dump(rows, f)
+
+    with open(rows_file) as f:
+        rows = json.load(f)
+
+    return sum(n for path, n in rows.items() if 'DOHMH' in path or 'Inspections' in path)
+
+
+def run_scale(scale, cases=None, regenerate=False):
+    """
+    Runs each case in a process of its own over the data of a scale
+
+    :param scale:       Size of the data, as a multiple of the current data
+    :param cases:       Names of the cases to run, defaults to all of them
+    :param regenerate:  Generate the data again even if present
+    :return:            `DataFrame` of wall / CPU time, peak RSS, output
+                        size and rows per second of each case (training
+                        rows for the fits, raw inspection rows otherwise)
+    """
+    raw_rows = _generate(scale, regenerate)
+    scale_dir = os.path.abspath(_scale_dir(scale))
+    trace_file = os.path.join(scale_dir, 'trace-%d.jsonl' % time.time())
+
+    env = dict(os.environ, PROFILE_TRACE=trace_file, PROFILE_STAGES='',
+               PYTHONPATH=os.pathsep.join([PROJECT_ROOT, os.environ.get('PYTHONPATH', '')]))
+
+    for name in cases or list(_cases()):
+        print("[ INF ] Benchmarking", name, "at %gx" % scale)
+        result = subprocess.run([sys.executable, '-m', 'src.benchmarks.pipeline', '--case', name],
+                                cwd=scale_dir, env=env, stdout=subprocess.DEVNULL)
+        if result.returncode != 0:
+            print("[ ERR ] Benchmark", name, "failed at %gx" % scale)
+
+    trace = profiling.read_trace(trace_file)
+    trace = trace.loc[trace['name'].str.startswith('bench.')]
+
+    case = trace['name'].str[len('bench.'):]
+
+    # Fits process their training rows, the other stages the raw rows
+    fit = case.map(_is_fit).values
+    rows = np.where(fit, trace['rows'], raw_rows)
+
+    df = pd.DataFrame({'case': case,
+                       'scale': scale,
+                       'wall_s': trace['wall_s'],
+                       'cpu_s': trace['cpu_s'],
+                       'peak_rss_mb': trace['peak_rss_mb'],
+                       'rows': trace['rows'],
+                       'cols': trace['cols'],
+                       'rows_per_s': rows / trace['wall_s']})
+
+    return df.reset_index(drop=True)
+
+
+def compare(results, baseline):
+    """
+    Flags the cases slower, or using more memory, than the baseline
+
+    :param results:     `DataFrame` from `run_scale`
+    :param baseline:    dict of scale : case : dict of `wall_s`, `peak_rss_mb`
+    :return:            `results` with the baseline values, a `regressed`
+                        column and a `flag` column naming the regression
+    """
+    def base(row, metric):
+        return baseline.get('%g' % row['scale'], {}).get(row['case'], {}).get(metric)
+
+    df = results.copy()
+    for metric in ['wall_s', 'peak_rss_mb']:
+        df['base_' + metric] = pd.Series([base(r, metric) for _, r in df.iterrows()],
+                                         index=df.index, dtype='float64')
+
+    slower = (df['wall_s'] > df['base_wall_s'] * (1 + TOLERANCE)) & \
+             (df['wall_s'] - df['base_wall_s'] > MIN_WALL_S)
+    larger = (df['peak_rss_mb'] > df['base_peak_rss_mb'] * (1 + TOLERANCE)) & \
+             (df['peak_rss_mb'] - df['base_peak_rss_mb'] > MIN_RSS_MB)
+
+    df['regressed'] = slower | larger
+    df['flag'] = np.select([slower & larger, slower, larger, df['base_wall_s'].isna()],
+                           ['SLOWER, MEMORY', 'SLOWER', 'MEMORY', 'no baseline'], '')
+
+    return df
+
+
+def load_baseline(path=BASELINE_FILE):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE_FILE):
+    """
+    Makes the results the baseline of their scales and cases,
+    keeping the baseline of the others
+    """
+    baseline = load_baseline(path)
+    for _, r in results.iterrows():
+        baseline.setdefault('%g' % r['scale'], {})[r['case']] = {'wall_s': r['wall_s'],
+                                                                 'peak_rss_mb': r['peak_rss_mb']}
+
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+    print("[ INF ] Saved baseline to", path)
+
+
+def run(scales=(1,), cases=None, regenerate=False, update_baseline=False):
+    """
+    Runs the suite at each scale, records it to the history and
+    compares it to the baseline
+
+    :param scales:          Sizes of the data, as multiples of the current data
+    :param cases:           Names of the cases to run, defaults to all of them
+    :param regenerate:      Generate the data again even if present
+    :param update_baseline: Make these results the new baseline
+    :return:                `DataFrame` of `compare`
+    """
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+
+    results = pd.concat([run_scale(s, cases, regenerate) for s in scales], ignore_index=True)
+
+    with open(HISTORY_FILE, 'a') as f:
+        for r in results.to_dict('records'):
+            f.write(json.dumps(dict(r, time=time.time()), default=str) + '\n')
+
+    df = compare(results, load_baseline())
+
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 20)
+    print(df.set_index(['scale', 'case']))
+
+    for _, r in df.loc[df['regressed']].iterrows():
+        print("[ WRN ] Regression in %s at %gx: %s" % (r['case'], r['scale'], r['flag']))
+
+    if update_baseline:
+        save_baseline(results)
+
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', nargs='+', type=float, default=[1])
+    parser.add_argument('--cases', nargs='+', default=None)
+    parser.add_argument('--regenerate', action='store_true')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        _run_case(args.case)
+    else:
+        run(args.scales, args.cases, args.regenerate, args.save_baseline)
@@ -0,0 +1,78 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# serving_load.py
+#
+# Load test of the online scoring service (`src/models/serving.py`).
+# The service is started in process and scored with concurrent
+# requests from `ScoringClient`. Run with:
+# `python -m src.benchmarks.serving_load [requests] [concurrency]`
+#
+
+import asyncio
+import sys
+import time
+
+import numpy as np
+
+from src.models.serving import ScoringClient, load_service
+
+LOAD_TEST_PORT = 8018
+
+
+async def run(n_requests=5000, concurrency=64, port=LOAD_TEST_PORT, seed=42):
+    """
+    Sends `n_requests` score requests for random indexed restaurants,
+    with at most `concurrency` in flight at once
+
+    :param n_requests:  Total number of requests
+    :param concurrency: Number of requests in flight
+    :param port:        Port to serve on
+    :param seed:        Random seed of the CAMIS sample
+    :return:            dict of client side and server side statistics
+    """
+    service = load_service()
+    server = await service.start(port=port)
+
+    client = ScoringClient(port=port)
+    camis = np.random.RandomState(seed).choice(list(service.index.positions), n_requests)
+
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(c):
+        async with semaphore:
+            start = time.perf_counter()
+            status, _ = await client.score(int(c))
+            latencies.append(time.perf_counter() - start)
+            assert status == 200
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(c) for c in camis])
+    elapsed = time.perf_counter() - start
+
+    _, server_stats = await client.stats()
+
+    server.close()
+    await server.wait_closed()
+
+    latencies = np.array(latencies) * 1000
+    results = {'requests': n_requests,
+               'concurrency': concurrency,
+               'throughput_rps': n_requests / elapsed,
+               'client_p50_ms': float(np.percentile(latencies, 50)),
+               'client_p99_ms': float(np.percentile(latencies, 99)),
+               'server_p50_ms': server_stats['p50_ms'],
+               'server_p99_ms': server_stats['p99_ms'],
+               'mean_batch': server_stats['requests'] / max(server_stats['batches'], 1)}
+
+    for k, v in results.items():
+        print("%-16s %10.2f" % (k, v))
+
+    return results
+
+
+if __name__ == '__main__':
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000,
+                    int(sys.argv[2]) if len(sys.argv) > 2 else 64))
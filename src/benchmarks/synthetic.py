@@ -0,0 +1,232 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# synthetic.py
+#
+# Generator of synthetic raw data sets, in the layout of the files read
+# by `fetch.py`, at a multiple of the size of the current data. The
+# DOHMH restaurant inspections and DCA inspections grow with the scale;
+# the IRS returns and demographics (one row per zip and bracket) and the
+# Yahoo prices (one row per day) are sized by the zips and dates, which
+# are the same at every scale. Run with:
+# `python -m src.benchmarks.synthetic <output dir> [scale]`
+#
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+#
+# Constants
+#
+
+# Rows of each file at a scale of 1 (the size of the current data)
+DOHMH_ROWS = 380000
+DCA_ROWS = 210000
+RESTAURANTS = 27000
+
+ZIPS = 190
+START_DATE = '2015-01-01'
+END_DATE = '2019-04-30'
+
+ACTIONS = ['Violations were cited in the following area(s).',
+           'No violations were recorded at the time of this inspection.',
+           'Establishment Closed by DOHMH.  Violations were cited in the following area(s) and those '
+           'requiring immediate action were addressed.',
+           'Establishment re-closed by DOHMH.',
+           'Establishment re-opened by DOHMH.']
+ACTION_P = [.62, .2, .1, .03, .05]
+
+CUISINES = ['American', 'Chinese', 'Café/Coffee/Tea', 'Pizza', 'Italian', 'Mexican', 'Japanese',
+            'Latin (Cuban, Dominican, Puerto Rican, South & Central American)', 'Bakery', 'Caribbean',
+            'Spanish', 'Donuts', 'Pizza/Italian', 'Chicken', 'Delicatessen', 'Indian', 'Thai', 'Korean']
+
+VIOLATION_CODES = ['10F', '08A', '04L', '06D', '06C', '02G', '10B', '04N', '02B', '04H', '06E',
+                   '06F', '08C', '04A', '09C', '05D', '04M', '10H', '02H', '04J']
+
+INSPECTION_RESULTS = ['No Violation Issued', 'Violation Issued', 'Pass', 'Fail', 'Out of Business',
+                      'Unable to Locate', 'Closed', 'Warning Issued']
+INSPECTION_RESULT_P = [.35, .2, .15, .05, .1, .08, .04, .03]
+
+INDUSTRIES = ['Restaurant - 818', 'Sidewalk Cafe - 013', 'Gaming Cafe - 129', 'Laundry - 064',
+              'Electronic Store - 001', 'Home Improvement Contractor - 100']
+
+AGI_BRACKETS = ['$1 under $25,000', '$25,000 under $50,000', '$50,000 under $75,000',
+                '$75,000 under $100,000', '$100,000 under $200,000', '$200,000 or more']
+
+DEMOGRAPHIC_GROUPS = ['FEMALE', 'MALE', 'GENDER UNKNOWN', 'GENDER TOTAL', 'PACIFIC ISLANDER',
+                      'HISPANIC LATINO', 'AMERICAN INDIAN', 'ASIAN NON HISPANIC', 'WHITE NON HISPANIC',
+                      'BLACK NON HISPANIC', 'OTHER ETHNICITY', 'ETHNICITY UNKNOWN', 'ETHNICITY TOTAL',
+                      'PERMANENT RESIDENT ALIEN', 'US CITIZEN', 'OTHER CITIZEN STATUS',
+                      'CITIZEN STATUS UNKNOWN', 'CITIZEN STATUS TOTAL', 'RECEIVES PUBLIC ASSISTANCE',
+                      'NRECEIVES PUBLIC ASSISTANCE', 'PUBLIC ASSISTANCE UNKNOWN', 'PUBLIC ASSISTANCE TOTAL']
+
+
+#
+# Helper Functions
+#
+
+def _zips(rng):
+    return np.sort(rng.choice(np.arange(10001, 11500), ZIPS, replace=False))
+
+
+def _dates(rng, n, fmt='%m/%d/%Y'):
+    days = (pd.Timestamp(END_DATE) - pd.Timestamp(START_DATE)).days
+    dates = pd.Timestamp(START_DATE) + pd.to_timedelta(rng.randint(0, days, n), unit='D')
+    return pd.Series(dates.strftime(fmt))
+
+
+def _restaurant_inspections(rng, n, camis, zips):
+    """
+    :param n:       Number of rows (violations cited)
+    :param camis:   CAMIS of the restaurants
+    :param zips:    Zip codes to place the restaurants in
+    :return:        `DataFrame` in the layout of the DOHMH data
+    """
+    restaurant = rng.randint(0, len(camis), n)
+    c = camis[restaurant]
+
+    names = np.array(['Restaurant #%d' % i for i in range(len(camis))], dtype=object)
+    cuisine = np.array(CUISINES, dtype=object)[restaurant % len(CUISINES)]
+    zipcode = zips[restaurant % len(zips)].astype('float64')
+    zipcode[rng.rand(n) < .01] = np.nan
+
+    dates = _dates(rng, n)
+
+    # Restaurants which have not been inspected yet
+    dates[rng.rand(n) < .005] = '01/01/1900'
+
+    score = rng.randint(0, 60, n).astype('float64')
+    score[rng.rand(n) < .05] = np.nan
+
+    return pd.DataFrame({
+        'CAMIS': c,
+        'DBA': names[restaurant],
+        'BORO': rng.choice(['MANHATTAN', 'BROOKLYN', 'QUEENS', 'BRONX', 'STATEN ISLAND'], n),
+        'BUILDING': (restaurant % 900).astype(str),
+        'STREET': np.array([' %d Street ' % (i % 400) for i in range(len(camis))], dtype=object)[restaurant],
+        'ZIPCODE': zipcode,
+        'PHONE': (2120000000 + restaurant).astype(str),
+        'CUISINE DESCRIPTION': cuisine,
+        'INSPECTION DATE': dates.values,
+        'ACTION': rng.choice(ACTIONS, n, p=ACTION_P),
+        'VIOLATION CODE': rng.choice(VIOLATION_CODES, n),
+        'VIOLATION DESCRIPTION': 'Violation cited.',
+        'CRITICAL FLAG': rng.choice(['Critical', 'Not Critical', 'Not Applicable'], n, p=[.55, .42, .03]),
+        'SCORE': score,
+        'GRADE': rng.choice(['A', 'B', 'C', 'Z', 'P', None], n, p=[.4, .08, .04, .02, .01, .45]),
+        'GRADE DATE': dates.values,
+        'RECORD DATE': '05/05/2019',
+        'INSPECTION TYPE': 'Cycle Inspection / Initial Inspection'})
+
+
+def _dca_inspections(rng, n, zips):
+    return pd.DataFrame({
+        'Record ID': ['%05d-%d-ENFO' % (i, 2015 + i % 5) for i in rng.randint(0, n, n)],
+        'Certificate Number': rng.randint(1, 10 ** 7, n),
+        'Business Name': 'Business',
+        'Inspection Date': _dates(rng, n).values,
+        'Inspection Result': rng.choice(INSPECTION_RESULTS, n, p=INSPECTION_RESULT_P),
+        'Industry': rng.choice(INDUSTRIES, n),
+        'Borough': 'Queens',
+        'Building Number': '1',
+        'Street': 'Main Street',
+        'Street 2': '',
+        'Unit Type': '',
+        'Unit': '',
+        'Description': '',
+        'City': 'New York',
+        'State': 'NY',
+        'Zip': rng.choice(zips, n)})
+
+
+def _agi_returns(rng, zips):
+    # Out of city zips are filtered out by `fetch_alternative_agi_returns`
+    z = np.concatenate([zips, [12010, 14850]])
+
+    return pd.DataFrame({'ZIP': np.repeat(z, len(AGI_BRACKETS)),
+                         'Size of adjusted gross income': np.tile(AGI_BRACKETS, len(z)),
+                         'Number of returns': rng.randint(0, 200, len(z) * len(AGI_BRACKETS)) * 10})
+
+
+def _demographics(rng, zips):
+    df = pd.DataFrame({'JURISDICTION NAME': zips,
+                       'COUNT PARTICIPANTS': rng.randint(0, 200, len(zips))})
+
+    for g in DEMOGRAPHIC_GROUPS:
+        p = rng.rand(len(zips)).round(2)
+        df['COUNT ' + g] = (p * df['COUNT PARTICIPANTS']).astype(int)
+        df['PERCENT ' + g] = p
+
+    return df
+
+
+def _prices(rng, start):
+    dates = pd.bdate_range(START_DATE, END_DATE)
+    close = start * np.exp(np.cumsum(rng.normal(0, .01, len(dates))))
+
+    return pd.DataFrame({'Date': dates.strftime('%Y-%m-%d'),
+                         'Open': close, 'High': close, 'Low': close, 'Close': close,
+                         'Adj Close': close,
+                         'Volume': rng.randint(10 ** 7, 10 ** 8, len(dates))})
+
+
+#
+# Generation
+#
+
+def generate(out_dir, scale=1, seed=42):
+    """
+    Writes every raw data set under `<out_dir>/data/`, in the
+    paths `fetch.py` reads them from
+
+    :param out_dir: Root of the generated tree (the working directory
+                    the pipeline is then ran from)
+    :param scale:   Size as a multiple of the current data (i.e: 1, 10, 100)
+    :param seed:    Random seed
+    :return:        dict of file name : number of rows
+    """
+    rng = np.random.RandomState(seed)
+
+    data_dir = os.path.join(out_dir, 'data')
+    nyc_dir = os.path.join(data_dir, 'nyc_open_data', 'datasets')
+    irs_dir = os.path.join(data_dir, 'irs', 'datasets')
+    yahoo_dir = os.path.join(data_dir, 'yahoo_finance')
+
+    for d in [nyc_dir, irs_dir, yahoo_dir, os.path.join(data_dir, 'merged')]:
+        os.makedirs(d, exist_ok=True)
+
+    zips = _zips(rng)
+    n = int(DOHMH_ROWS * scale)
+
+    # The new set shares most of its restaurants with the original
+    restaurants = max(int(RESTAURANTS * scale), 100)
+    old_camis = 30000000 + np.arange(restaurants)
+    new_camis = old_camis + restaurants // 10
+
+    files = {
+        os.path.join(nyc_dir, 'DOHMH_New_York_City_Restaurant_Inspection_Results.csv'):
+            _restaurant_inspections(rng, n, old_camis, zips),
+        os.path.join(nyc_dir, 'DOHMH_New_York_City_Restaurant_Inspection_Results-new.csv'):
+            _restaurant_inspections(rng, n, new_camis, zips),
+        os.path.join(nyc_dir, 'Inspections.csv'): _dca_inspections(rng, int(DCA_ROWS * scale), zips),
+        os.path.join(nyc_dir, 'Demographic_Statistics_By_Zip_Code.csv'): _demographics(rng, zips),
+        os.path.join(irs_dir, 'AGI-Returns.csv'): _agi_returns(rng, zips),
+        os.path.join(yahoo_dir, '^DJI.csv'): _prices(rng, 17000),
+        os.path.join(yahoo_dir, '^VIX.csv'): _prices(rng, 15)}
+
+    for path, df in files.items():
+        df.to_csv(path, index=False)
+        print("[ INF ] Wrote", len(df), "rows to", path)
+
+    return {path: len(df) for path, df in files.items()}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("[ ERR ] Usage: python -m src.benchmarks.synthetic <output dir> [scale]")
+    else:
+        generate(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1)
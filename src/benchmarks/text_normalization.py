@@ -0,0 +1,84 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# text_normalization.py
+#
+# Benchmark of the fused `normalize_text` stage against the
+# original `strip_strings`, `camel_case_cols`, `remove_punctuation`
+# helper chain
+#
+
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import src.preprocessing.fetch as fetch
+
+RESTAURANT_INSPECTION_FILE = fetch.NYC_OPEN_DATA_DIR + 'DOHMH_New_York_City_Restaurant_Inspection_Results.csv'
+
+
+def _synthetic_frame(n=400000, seed=42):
+    """
+    Builds a frame shaped like the raw DOHMH data: a handful of
+    low-cardinality string columns plus a numeric one
+
+    :param n:       Number of rows
+    :param seed:    Random seed
+    :return:        `DataFrame`
+    """
+    rng = np.random.RandomState(seed)
+    camis = rng.randint(0, 27000, n)
+
+    return pd.DataFrame({
+        'CAMIS': camis,
+        'DBA': np.array(['Restaurant #%d, Inc.' % c for c in range(27000)], dtype=object)[camis],
+        'BORO': rng.choice(['MANHATTAN', 'BROOKLYN', 'QUEENS', 'BRONX', 'STATEN ISLAND'], n),
+        'STREET': np.array([' %d Street ' % (c % 900) for c in range(27000)], dtype=object)[camis],
+        'CUISINE DESCRIPTION': rng.choice(['American', 'Café/Coffee/Tea', 'Pizza/Italian', 'Chinese'], n),
+        'ACTION': rng.choice(['Violations were cited in the following area(s).',
+                              'No violations were recorded at the time of this inspection.',
+                              'Establishment re-closed by DOHMH.'], n),
+        'INSPECTION DATE': rng.choice(['%02d/%02d/2018' % (m, d) for m in range(1, 13) for d in range(1, 29)], n),
+        'SCORE': rng.randint(0, 60, n).astype('float64')
+    })
+
+
+def _helpers(df):
+    df = fetch.strip_strings(df)
+    df = fetch.camel_case_cols(df)
+    return fetch.remove_punctuation(df)
+
+
+def run(df, repeat=3):
+    """
+    Times both normalization paths on copies of `df`
+
+    :param df:      Raw `DataFrame`
+    :param repeat:  Number of timed repetitions (best is reported)
+    :return:        dict of best times in seconds
+    """
+    results = {
+        'helpers': min(timeit.repeat(lambda: _helpers(df.copy()), number=1, repeat=repeat)),
+        'normalize_text': min(timeit.repeat(lambda: fetch.normalize_text(df.copy()), number=1, repeat=repeat))
+    }
+
+    print("[ INF ] Rows:", len(df), "String Columns:", len(df.select_dtypes(['object']).columns))
+    for k, v in results.items():
+        print("%-28s %8.3fs  (%.1fx)" % (k, v, results['helpers'] / v))
+
+    return results
+
+
+if __name__ == '__main__':
+    if os.path.isfile(RESTAURANT_INSPECTION_FILE):
+        print("[ INF ] Using", RESTAURANT_INSPECTION_FILE)
+        frame = pd.read_csv(RESTAURANT_INSPECTION_FILE, dtype=fetch.RESTAURANT_INSPECTION_DTYPES)
+    else:
+        print("[ INF ] Inspection data not found, using synthetic frame")
+        frame = _synthetic_frame(int(sys.argv[1]) if len(sys.argv) > 1 else 400000)
+
+    run(frame)
@@ -6,8 +6,10 @@
 #
 
 
+import argparse
 import warnings
 
+import src.profiling as profiling
 from src.models.prediction import ClosureRegressor, ClosureClassifier
 from src.models.visualization import pca_clusters
 
@@ -15,45 +17,63 @@ from src.models.visualization import pca_clusters
 # which throw a FutureWarning -- These are out of our control
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-# === Restaurant Inspection Viewing ==================================
-# import src.preprocessing.fetch as fetch
-# Merged set closure rate: 3.2%
-# Merging netted about 750 new closures
-# df = fetch.fetch_restaurant_inspection_data(merged_set=False)
-# ====================================================================
+# The pipeline runs under the main guard since `Model.fit_many`
+# starts worker processes which may re-import this module
+if __name__ == '__main__':
+    # Profiling of the stages below (see `src/profiling.py`)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='TRACE',
+                        help='record stage timings to a JSON lines trace')
+    parser.add_argument('--cprofile', action='append', default=[], metavar='STAGE',
+                        help='also run the named stage under cProfile')
+    args = parser.parse_args()
 
-# === Restaurant Cluster Viewing =====================================
-pca_clusters()
-# ====================================================================
+    if args.profile is not None or args.cprofile:
+        profiling.enable(args.profile or None, args.cprofile)
 
-# === Closure Prediction =============================================
-print("*** Closure Regressor ******************************")
-print("*** Using Master Data Set")
-print("****************************************************")
+    # === Restaurant Inspection Viewing ==================================
+    # import src.preprocessing.fetch as fetch
+    # Merged set closure rate: 3.2%
+    # Merging netted about 750 new closures
+    # df = fetch.fetch_restaurant_inspection_data(merged_set=False)
+    # ====================================================================
 
-c = ClosureRegressor()
-c.prepare()
-c.fit_gradient_boosting()
-c.select_features()
-c.fit_lin_reg()
-c.fit_neural_network()
+    # === Restaurant Cluster Viewing =====================================
+    pca_clusters()
+    # ====================================================================
 
-print("****************************************************")
+    # === Closure Prediction =============================================
+    print("*** Closure Regressor ******************************")
+    print("*** Using Master Data Set")
+    print("****************************************************")
 
-print()
+    # The data is prepared on first use, estimators found
+    # in the model registry do not need it
+    c = ClosureRegressor()
 
-print("*** Closure Classifier *****************************")
-print("*** Using Restaurant Inspection Data Set ")
-print("****************************************************")
+    # Gradient boosting selects the features, then linear regression and
+    # the neural network are trained concurrently on the selected ones
+    c.fit_or_load('Gradient Boosting')
+    c.print_importances(name='Gradient Boosting')
+    c.select_features()
 
-c2 = ClosureClassifier()
-c2.prepare()
-c2.fit_gradient_boosting()
+    c.fit_many([s for s in c.specs() if s.name != 'Gradient Boosting'])
 
-# This fails on the re-fit, if you run it, you'll
-# still get the feature list, but also an exception
-# c.select_features()
+    for name, estimator in c.estimators.items():
+        if name != 'Gradient Boosting':
+            c.print_importances(estimator, name=name)
 
-c2.fit_knn()
-c2.fit_neural_network()
-# ====================================================================
+    print("****************************************************")
+
+    print()
+
+    print("*** Closure Classifier *****************************")
+    print("*** Using Restaurant Inspection Data Set ")
+    print("****************************************************")
+
+    c2 = ClosureClassifier()
+    c2.fit_many()
+
+    for name, estimator in c2.estimators.items():
+        c2.print_importances(estimator, name=name)
+    # ====================================================================
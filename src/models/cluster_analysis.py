@@ -47,10 +47,12 @@ def pca_on_restaurant_inspections_file(n=3, y='is_closed'):
 
     # Drop other unneeded columns
     drop_list = ['camis', 'dba', 'boro', 'building', 'street', 'zip', 'phone',
+                 'inspection_date', 'inspection_period',
                  'inspection_year', 'inspection_month', 'inspection_day',
                  'violation_ratio', 'cuisine_description']
 
-    df = df.drop(drop_list, 1)
+    # Tables exported before the date was parsed do not have all of these
+    df = df.drop(drop_list, axis=1, errors='ignore')
 
     # Pivot cuisine
     # cuisines = pd.get_dummies(df['cuisine_description'], prefix='cuisine')
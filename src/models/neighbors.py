@@ -0,0 +1,192 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# neighbors.py
+#
+# Approximate nearest neighbor classification for `fit_knn`. The
+# training rows are hashed by random projections into several tables
+# at fit time; a query only measures its distance to the rows sharing
+# a bucket with it in any table, plus the buckets nearest to it
+# (multi-probe). More probes find more of the true neighbors (recall)
+# at the cost of more distances per query.
+#
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+#
+# Constants
+#
+
+# Number of rows queried at a time
+QUERY_BATCH_SIZE = 256
+
+
+#
+# Helper Functions
+#
+
+def _dense(x):
+    return np.asarray(x.toarray() if sp.issparse(x) else x, dtype='float32')
+
+
+def _squared_distances(q, x):
+    # Squared euclidean distances between the rows of `q` and `x`
+    d = (q ** 2).sum(axis=1)[:, None] - 2 * q @ x.T + (x ** 2).sum(axis=1)[None, :]
+    return np.maximum(d, 0)
+
+
+#
+# Index
+#
+
+class LSHNeighborsClassifier(BaseEstimator, ClassifierMixin):
+    """
+    k nearest neighbors classifier over a random projection hash index
+    """
+
+    def __init__(self, n_neighbors=30, n_tables=8, n_bits=12, n_probes=4, batch_size=QUERY_BATCH_SIZE,
+                 random_state=None):
+        """
+        :param n_neighbors: Number of neighbors voting on each prediction
+        :param n_tables:    Number of hash tables
+        :param n_bits:      Projections (bits of the bucket key) per table
+        :param n_probes:    Extra buckets probed per table, those of the bits
+                            the query is closest to flipping. The recall /
+                            latency knob: 0 probes only the query's own buckets
+        :param batch_size:  Number of rows queried at a time
+        :param random_state: Seed of the projections
+        """
+        self.n_neighbors = n_neighbors
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.n_probes = n_probes
+        self.batch_size = batch_size
+        self.random_state = random_state
+
+    def _project(self, x):
+        """
+        :return:    (bucket keys of each table, (rows, tables, bits) margins
+                    of the projections to their thresholds)
+        """
+        margins = (x @ self.projections_ - self.thresholds_).reshape(len(x), self.n_tables, self.n_bits)
+        keys = ((margins > 0) * self.bit_values_).sum(axis=2)
+        return keys, margins
+
+    def fit(self, x, y):
+        """
+        Builds the hash tables over the training rows
+
+        :param x:   Training rows, dense or sparse
+        :param y:   Labels
+        :return:    self
+        """
+        rng = np.random.RandomState(self.random_state)
+
+        self.x_ = _dense(x)
+        self.classes_, self.y_ = np.unique(np.asarray(y), return_inverse=True)
+
+        self.projections_ = rng.normal(size=(self.x_.shape[1], self.n_tables * self.n_bits)).astype('float32')
+        self.bit_values_ = (1 << np.arange(self.n_bits)).astype('int64')
+
+        # Thresholds at the median projection split every bit evenly
+        self.thresholds_ = np.median(self.x_ @ self.projections_, axis=0).astype('float32')
+
+        keys, _ = self._project(self.x_)
+
+        # Each table as its rows sorted by key, and the offsets of each key
+        self.order_ = np.argsort(keys, axis=0, kind='mergesort').T
+        self.buckets_ = []
+        for t in range(self.n_tables):
+            k, start, count = np.unique(keys[self.order_[t], t], return_index=True, return_counts=True)
+            self.buckets_.append((k, start, count))
+
+        return self
+
+    def _candidates(self, keys, margins):
+        """
+        :param keys:    (queries, tables) bucket keys of the queries
+        :param margins: (queries, tables, bits) margins of the queries
+        :return:        (query, row) position pairs of the rows sharing
+                        a probed bucket with each query, without repeats
+        """
+        queries, rows = [], []
+
+        for t in range(self.n_tables):
+            # The query's own bucket, then the buckets of its closest bits flipped
+            flips = np.argsort(np.abs(margins[:, t]), axis=1)[:, :self.n_probes]
+            probes = np.concatenate([keys[:, t:t + 1], keys[:, t:t + 1] ^ self.bit_values_[flips]], axis=1)
+
+            k, start, count = self.buckets_[t]
+            at = np.minimum(np.searchsorted(k, probes), len(k) - 1)
+            found = k[at] == probes
+
+            q = np.broadcast_to(np.arange(len(keys))[:, None], probes.shape)[found]
+            start, count = start[at[found]], count[at[found]]
+
+            # Expands each (query, bucket) into the bucket's rows
+            offsets = np.repeat(start - np.cumsum(count) + count, count) + np.arange(count.sum())
+            queries.append(np.repeat(q, count))
+            rows.append(self.order_[t][offsets])
+
+        pairs = np.unique(np.concatenate(queries) * len(self.x_) + np.concatenate(rows))
+        return pairs // len(self.x_), pairs % len(self.x_)
+
+    def kneighbors(self, x, n_neighbors=None):
+        """
+        :param x:           Query rows, dense or sparse
+        :param n_neighbors: Defaults to `self.n_neighbors`, at most the
+                            number of training rows
+        :return:            (distances, row positions) of the nearest training
+                            rows found, as `KNeighborsClassifier.kneighbors`
+        """
+        k = min(n_neighbors or self.n_neighbors, len(self.x_))
+        distances = np.empty((x.shape[0], k), dtype='float32')
+        neighbors = np.empty((x.shape[0], k), dtype='int64')
+
+        norms = (self.x_ ** 2).sum(axis=1)
+
+        for b in range(0, x.shape[0], self.batch_size):
+            q = _dense(x[b:b + self.batch_size])
+            keys, margins = self._project(q)
+
+            qi, ri = self._candidates(keys, margins)
+            d = np.maximum((q ** 2).sum(axis=1)[qi] - 2 * np.einsum('ij,ij->i', q[qi], self.x_[ri]) + norms[ri], 0)
+
+            # Candidates of each query, nearest first
+            order = np.lexsort((d, qi))
+            qi, ri, d = qi[order], ri[order], d[order]
+            first = np.searchsorted(qi, np.arange(len(q)))
+            found = np.diff(np.append(first, len(qi)))
+
+            enough = found >= k
+            take = first[enough][:, None] + np.arange(k)
+            distances[b:b + len(q)][enough] = np.sqrt(d[take])
+            neighbors[b:b + len(q)][enough] = ri[take]
+
+            # Queries with too few candidates found are answered exactly
+            few = np.flatnonzero(~enough)
+            if len(few):
+                d = _squared_distances(q[few], self.x_)
+                nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+                nearest = np.take_along_axis(nearest, np.argsort(np.take_along_axis(d, nearest, axis=1),
+                                                                 axis=1, kind='mergesort'), axis=1)
+                distances[b + few] = np.sqrt(np.take_along_axis(d, nearest, axis=1))
+                neighbors[b + few] = nearest
+
+        return distances, neighbors
+
+    def predict_proba(self, x):
+        """
+        :param x:   Query rows, dense or sparse
+        :return:    Share of each class among the neighbors of each row
+        """
+        _, neighbors = self.kneighbors(x)
+        votes = self.y_[neighbors]
+
+        return np.stack([(votes == c).mean(axis=1) for c in range(len(self.classes_))], axis=1)
+
+    def predict(self, x):
+        return self.classes_[self.predict_proba(x).argmax(axis=1)]
@@ -10,75 +10,568 @@
 #
 
 
+import hashlib
+import inspect
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import sklearn.metrics as metric
-from sklearn.ensemble import GradientBoostingRegressor, GradientBoostingClassifier
-from sklearn.feature_selection import RFECV
-from sklearn.linear_model import LinearRegression
+from sklearn.base import clone
+from sklearn.ensemble import GradientBoostingRegressor, GradientBoostingClassifier, \
+    HistGradientBoostingRegressor, HistGradientBoostingClassifier
+from sklearn.linear_model import LinearRegression, SGDClassifier
+from sklearn.naive_bayes import GaussianNB
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.neural_network import MLPRegressor, MLPClassifier
+from sklearn.preprocessing import MinMaxScaler
 
-from src.preprocessing.fetch import fetch_restaurant_inspection_data
+from src.preprocessing.fetch import fetch_restaurant_inspection_data, inspection_period, \
+    stream_restaurant_inspection_data
 from src.preprocessing.merge import master
-from src.preprocessing.transform import split_train_test, min_max_scale_values
+import src.preprocessing.transform as transform
+import src.models.selection as selection
+import src.models.neighbors as neighbors
+from src.models.neighbors import LSHNeighborsClassifier
+from src.models.registry import load_model, load_ranking, model_version, save_model, save_ranking
+from src.models.selection import ELIMINATION_STEP, rank_features
+from src.profiling import profiled, stage
+from src.preprocessing.transform import NEGATIVE_RATIO, frame_hash, load_design_matrix, \
+    materialize_design_matrix, min_max_scale_values, negative_downsample, rolling_time_splits, sparse_dummies, \
+    stratified_split, time_split
+
+# An estimator to train: a display name, an unfitted estimator and
+# the dtype to cast the design matrix to (None keeps float32)
+EstimatorSpec = namedtuple('EstimatorSpec', ['name', 'estimator', 'dtype'])
+
+# Default number of rows predicted at a time by `Model.score`
+SCORE_BATCH_SIZE = 50000
+
+# Gradient boosting engines: 'exact' (`GradientBoosting*`) or 'hist'
+# (`HistGradientBoosting*`, binned, multithreaded, with early stopping)
+BOOSTING_ENGINES = ('exact', 'hist')
+
+# Early stopping of the 'hist' engine, on a held out fraction of the training set
+HIST_VALIDATION_FRACTION = 0.1
+HIST_ITER_NO_CHANGE = 30
+
+# Trees of at most 8 leaves, as the depth 3 trees of the 'exact' engine
+HIST_MAX_LEAF_NODES = 8
+HIST_MIN_SAMPLES_LEAF = 5
+
+# Estimators of `StreamingClosureClassifier`: stochastic gradient
+# descent (logistic loss), the neural network and Gaussian naive Bayes
+STREAMING_ESTIMATORS = ('sgd', 'mlp', 'nb')
+
+# Restaurants read per batch, and passes over them, when streaming
+STREAM_BATCH_SIZE = 10000
+STREAM_EPOCHS = 5
+
+# Neighbor indexes of the kNN classifier: 'exact' (brute force), 'ball_tree'
+# or 'lsh' (approximate, see `neighbors.py`)
+NEIGHBOR_INDEXES = ('exact', 'ball_tree', 'lsh')
+
+# Extra buckets probed per hash table by the 'lsh' index (recall / latency knob)
+LSH_PROBES = 4
+
+# Seed of the classifier's downsampling and stratified split
+RANDOM_STATE = 42
+
+
+#
+# Scoring
+#
+
+def classification_scores(y_test, y_pred):
+    return {'F1': metric.f1_score(y_test, y_pred),
+            'Cohen Kappa': metric.cohen_kappa_score(y_test, y_pred)}
+
+
+def regression_scores(y_test, y_pred):
+    return {'Exp Var': metric.explained_variance_score(y_test, y_pred),
+            'MAE': metric.mean_absolute_error(y_test, y_pred),
+            'R2': metric.r2_score(y_test, y_pred)}
+
+
+def _dense_input(estimator):
+    # The histogram estimators and the tree neighbor indexes do not take sparse matrices
+    return isinstance(estimator, (HistGradientBoostingRegressor, HistGradientBoostingClassifier)) or \
+        getattr(estimator, 'algorithm', None) in ('ball_tree', 'kd_tree')
+
+
+def _weight_params(fit, weights):
+    # Sample weights for the estimators whose `fit` (or `partial_fit`)
+    # takes them, kNN and the neural networks are fit unweighted
+    if weights is None or 'sample_weight' not in inspect.signature(fit).parameters:
+        return {}
+    return {'sample_weight': np.asarray(weights)}
+
+
+def _fit_spec(path, spec, scores):
+    # Runs in a worker process: the design matrix is memory mapped
+    # from disk, so every worker shares the parent's pages
+    m = load_design_matrix(path)
+
+    x_train, x_test = m.x[:m.n_train], m.x[m.n_train:]
+    y_train, y_test = m.y[:m.n_train], m.y[m.n_train:]
+
+    if spec.dtype:
+        x_train, x_test = x_train.astype(spec.dtype), x_test.astype(spec.dtype)
+    if sp.issparse(x_train) and _dense_input(spec.estimator):
+        x_train, x_test = x_train.toarray(), x_test.toarray()
+
+    start = time.perf_counter()
+    with stage('prediction.fit ' + spec.name) as s:
+        spec.estimator.fit(s.output(x_train), y_train,
+                           **_weight_params(spec.estimator.fit, None if m.w is None else m.w[:m.n_train]))
+    fit_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    y_pred = spec.estimator.predict(x_test)
+    predict_time = time.perf_counter() - start
+
+    return spec.estimator, fit_time, predict_time, scores(y_test, y_pred)
+
+
+def predict_batches(estimator, x, columns=None, dtype=None, batch_size=SCORE_BATCH_SIZE, proba=False):
+    """
+    Predicts with a fitted estimator over `x` in batches, so only
+    one batch at a time is converted to the estimator's dtype.
+
+    :param estimator:   Fitted estimator
+    :param x:           DataFrame holding `columns`, or an array, memory
+                        map or sparse matrix in column order
+    :param columns:     Feature columns, in the order the estimator was fit on
+    :param dtype:       dtype the estimator was fit on, None for float32
+    :param batch_size:  Number of rows predicted at a time
+    :param proba:       If True, class probabilities are returned
+    :return:            `ndarray` of predictions
+    """
+    predict = estimator.predict_proba if proba else estimator.predict
+    dtype = dtype or 'float32'
+
+    if isinstance(x, pd.DataFrame):
+        def batch(i):
+            return x.iloc[i:i + batch_size][columns].fillna(0).values.astype(dtype)
+    elif sp.issparse(x):
+        x = x.tocsr()
+        dense = _dense_input(estimator)
+
+        def batch(i):
+            b = x[i:i + batch_size].astype(dtype)
+            return b.toarray() if dense else b
+    else:
+        def batch(i):
+            return np.asarray(x[i:i + batch_size], dtype=dtype)
+
+    y_pred = None
+    for i in range(0, x.shape[0], batch_size):
+        p = predict(batch(i))
+        if y_pred is None:
+            y_pred = np.empty((x.shape[0],) + p.shape[1:], dtype=p.dtype)
+        y_pred[i:i + len(p)] = p
+
+    return y_pred
+
+
+def _comparison_row(name, fit_time, predict_time, scores, source):
+    row = {'Model': name, 'Fit (s)': fit_time, 'Predict (s)': predict_time}
+    row.update(scores)
+    row['Source'] = source
+    return row
 
 
 class Model:
     """Abstract Class for the below Models"""
 
-    def __init__(self):
+    def __init__(self, boosting='exact'):
         # The data set used
         self.df = None
 
+        # Gradient boosting engine, one of `BOOSTING_ENGINES`
+        if boosting not in BOOSTING_ENGINES:
+            raise ValueError("Unknown boosting engine: " + str(boosting))
+        self.boosting = boosting
+
         # The estimator that was used
         self.estimator = None
 
         # Name of the prediction column
         self.y_col = None
 
+        # Memory mapped design matrix of `df` (see `design_matrix()`)
+        self.matrix = None
+        self._matrix_df = None
+        self._fit_dtype = None
+
+        # Estimators fitted by `fit_many`, by name
+        self.estimators = {}
+
+        # Hash of the input data set, before `prepare()`
+        self.data_hash = None
+
+        # True once `prepare()` has been ran
+        self.prepared = False
+
+        # Features kept by `select_features`, None for every feature
+        self.selected = None
+
+        # Sample weights of the rows of `df` set by `prepare()`, or None
+        self.sample_weight = None
+
+        # Feature columns and their fitted scaler (if any), which are
+        # also restored when estimators are loaded from the registry
+        self.columns = None
+        self.scaler = None
+
     def prepare(self):
         raise NotImplementedError
 
-    def _fit(self):
-        x_train, x_test, y_train, y_test = split_train_test(self.df.fillna(0), y=self.y_col)
-        print("Training Size:", len(x_train))
-        print("Test Size    :", len(x_test))
+    def split(self):
+        """
+        :return: (train positions, test positions) of the rows of `self.df`,
+                 or None for a random split
+        """
+        return None
+
+    def prepare_state(self):
+        """
+        :return: JSON serializable dict of the settings the prepared
+                 data depends on besides the input data (see `_version`)
+        """
+        return {'selected': self.selected}
+
+    def specs(self):
+        """
+        :return: List of `EstimatorSpec` this model can train
+        """
+        raise NotImplementedError
+
+    def boosting_spec(self, engine=None):
+        """
+        :param engine:  One of `BOOSTING_ENGINES`, defaults to `self.boosting`
+        :return:        `EstimatorSpec` of the gradient boosting estimator
+        """
+        raise NotImplementedError
+
+    def compare_boosting_engines(self, use_registry=True):
+        """
+        Trains the gradient boosting estimator with each engine
+        on the same split and compares their scores and timings
+
+        :param use_registry:    Load and save fitted estimators in the registry
+        :return:                `DataFrame` of `fit_many`
+        """
+        specs = [self.boosting_spec(e)._replace(name='Gradient Boosting (%s)' % e) for e in BOOSTING_ENGINES]
+        table = self.fit_many(specs, use_registry=use_registry)
+
+        for spec in specs:
+            estimator = self.estimators[spec.name]
+            if hasattr(estimator, 'n_iter_'):
+                print(spec.name, "stopped after", estimator.n_iter_, "iterations")
+
+        return table
+
+    # dict of metric name to value from (y_test, y_pred), set by subclasses
+    scores = None
+
+    def _spec(self, name):
+        return next(s for s in self.specs() if s.name == name)
 
-        self.estimator.fit(x_train, y_train)
+    def design_matrix(self):
+        """
+        The float32, memory mapped design matrix of `self.df`.
+        It is materialized on first use and again only when
+        `self.df` is replaced.
+
+        :return: `DesignMatrix`
+        """
+        if not self.prepared:
+            self.prepare()
+
+        if self.matrix is None or self._matrix_df is not self.df:
+            self.matrix = materialize_design_matrix(self.df, self.y_col, split=self.split(),
+                                                    weights=self.sample_weight)
+            self._matrix_df = self.df
+            self.columns = self.matrix.columns
+        return self.matrix
+
+    def _fit(self, dtype=None):
+        m = self.design_matrix()
+
+        # Views of the memory map, rows are stored training set first
+        x_train, x_test = m.x[:m.n_train], m.x[m.n_train:]
+
+        # Estimators that need more precision than float32 get a copy
+        self._fit_dtype = dtype
+        if dtype:
+            x_train, x_test = x_train.astype(dtype), x_test.astype(dtype)
+        if sp.issparse(x_train) and _dense_input(self.estimator):
+            x_train, x_test = x_train.toarray(), x_test.toarray()
+
+        y_train, y_test = m.y[:m.n_train], m.y[m.n_train:]
+        print("Training Size:", x_train.shape[0])
+        print("Test Size    :", x_test.shape[0])
+
+        self.estimator.fit(x_train, y_train,
+                           **_weight_params(self.estimator.fit, None if m.w is None else m.w[:m.n_train]))
         self.validate(y_test, x_test)
 
-    def select_features(self, print_output=True, apply_and_refit=True):
-        x, y, _, _ = split_train_test(self.df.fillna(0), y=self.y_col, split_size=0.0)
+    @profiled(output=lambda _, self: self.df)
+    def select_features(self, print_output=True, apply_and_refit=True, step=ELIMINATION_STEP, cv=5,
+                        n_jobs=-1, use_registry=True):
+        """
+        Ranks the features for the current estimator by recursive
+        elimination with cross validation (see `selection.py`). The
+        ranking is saved in the registry and reused while the design
+        matrix, estimator and settings are unchanged.
+
+        :param print_output:    Print the ranking
+        :param apply_and_refit: Keep only the selected features and refit
+        :param step:            Fraction (< 1) or number of features eliminated per step
+        :param cv:              Number of folds
+        :param n_jobs:          Number of folds scored in parallel, -1 for all CPUs
+        :param use_registry:    Load and save the ranking in the registry
+        :return:                dict of the ranking (see `rank_features`)
+        """
+        name = next((s.name for s in self.specs() if type(s.estimator) is type(self.estimator)
+                     and s.estimator.get_params() == self.estimator.get_params()),
+                    type(self.estimator).__name__)
+        version = model_version(self._state_hash() + str((step, cv)), self.estimator, self._fit_dtype,
+                                code=[__file__, transform.__file__, selection.__file__])
+        model_name = type(self).__name__
 
-        selector = RFECV(self.estimator, n_jobs=-1)
-        selector.fit(x, y)
+        ranking = load_ranking(model_name, name, version) if use_registry else None
+        if ranking is None:
+            ranking = rank_features(self.design_matrix().path, self.estimator, step=step, cv=cv,
+                                    dtype=self._fit_dtype, n_jobs=n_jobs)
+            if use_registry:
+                save_ranking(model_name, name, version, ranking)
+        else:
+            print("[ INF ] Loaded feature ranking", version)
 
         if print_output:
             print("Best Features for Current Estimator:")
 
-            ranks = sorted(zip(selector.ranking_, self.df.columns))
+            ranks = sorted(zip(ranking['ranking'], ranking['columns']))
             for r in ranks:
                 print(r)
 
         if apply_and_refit:
 
             # Make the selected set (those ranked as 1)
-            selected_set = []
-            for i in range(len(selector.ranking_)):
-                if selector.ranking_[i] == 1:
-                    selected_set.append(self.df.columns.values[i])
+            selected_set = [c for r, c in zip(ranking['ranking'], ranking['columns']) if r == 1]
 
             # Apply to df
-            self.df = self.df[selected_set]
+            if not self.prepared:
+                self.prepare()
+            self.df = self.df[selected_set + [self.y_col]]
+            self.selected = selected_set
 
             # Re-fit
-            self._fit()
+            self._fit(self._fit_dtype)
+
+        return ranking
+
+    @profiled()
+    def fit_many(self, specs=None, n_jobs=None, use_registry=True):
+        """
+        Trains several estimators concurrently on a process pool,
+        all over the same read-only train / test split. The fitted
+        estimators are kept in `self.estimators` by name.
+
+        With `use_registry`, an estimator already saved for the same
+        data, preparation, parameters and code is loaded instead of
+        being trained (see `registry.py`), and newly trained ones are
+        saved. The data is only prepared when an estimator is trained.
+
+        :param specs:           List of `EstimatorSpec`, defaults to `self.specs()`
+        :param n_jobs:          Number of worker processes, defaults to one per
+                                spec (up to the number of CPUs)
+        :param use_registry:    Load and save fitted estimators in the registry
+        :return:                `DataFrame` comparing the scores and timings
+        """
+        specs = specs or self.specs()
+        model_name = type(self).__name__
+
+        rows = {}
+        to_fit = []
+
+        for spec in specs:
+            saved = load_model(model_name, spec.name, self._version(spec)) if use_registry else None
+
+            if saved is None:
+                to_fit.append(spec)
+                continue
+
+            self.estimators[spec.name], self.scaler, meta = saved
+            self.columns = meta['columns']
+            rows[spec.name] = _comparison_row(spec.name, meta['fit_time'], meta['predict_time'],
+                                              meta['scores'], 'registry')
+
+        if to_fit:
+            m = self.design_matrix()
+            print("Training Size:", m.n_train)
+            print("Test Size    :", len(m.y) - m.n_train)
+
+            n_jobs = n_jobs or min(len(to_fit), os.cpu_count() or 1)
+
+            if n_jobs == 1:
+                results = [_fit_spec(m.path, spec, self.scores) for spec in to_fit]
+            else:
+                with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                    futures = [pool.submit(_fit_spec, m.path, spec, self.scores) for spec in to_fit]
+                    results = [f.result() for f in futures]
+
+            for spec, (estimator, fit_time, predict_time, scores) in zip(to_fit, results):
+                self.estimators[spec.name] = estimator
+                rows[spec.name] = _comparison_row(spec.name, fit_time, predict_time, scores, 'trained')
+
+                if use_registry:
+                    save_model(model_name, spec.name, self._version(spec), estimator,
+                               meta={'columns': m.columns,
+                                     'y_col': self.y_col,
+                                     'dtype': spec.dtype,
+                                     'data_hash': self.data_hash,
+                                     'scores': scores,
+                                     'fit_time': fit_time,
+                                     'predict_time': predict_time},
+                               scaler=self.scaler)
+
+        table = pd.DataFrame([rows[spec.name] for spec in specs]).set_index('Model')
+        print(table)
+
+        return table
+
+    def print_importances(self, estimator=None, n=10, name=None):
+        """
+        Prints the most important features of a fitted estimator: its
+        impurity based importances, or the magnitude of its coefficients.
+        Estimators with neither (i.e: kNN, the neural networks and the
+        histogram engine) print nothing.
+
+        :param estimator:   Fitted estimator, defaults to the current one
+        :param n:           Number of features printed
+        :param name:        If set, a header naming the estimator is printed first
+        :return:            None
+        """
+        estimator = estimator if estimator is not None else self.estimator
+
+        if hasattr(estimator, 'feature_importances_'):
+            importances = estimator.feature_importances_
+        elif hasattr(estimator, 'coef_'):
+            coef = np.abs(estimator.coef_)
+            importances = coef.sum(axis=0) if coef.ndim > 1 else coef
+        else:
+            return
+
+        if name:
+            print("=== %s Importances %s" % (name, '=' * max(0, 32 - len(name))))
+
+        features_importance = sorted(zip(importances, self.columns), reverse=True)
+        for f in features_importance[:n]:
+            print(f)
+
+    def fit_or_load(self, name):
+        """
+        Makes the named estimator the current one, loading it
+        from the registry when its inputs have not changed and
+        training (and saving) it otherwise.
+
+        :param name:    Name of the `EstimatorSpec`
+        :return:        None
+        """
+        spec = self._spec(name)
+        self.fit_many([spec])
+
+        self.estimator = self.estimators[name]
+        self._fit_dtype = spec.dtype
+
+    def _state_hash(self):
+        # The input data and the settings of its preparation, known
+        # before `prepare()` is ran. A model fit on a feature subset
+        # (i.e: after `select_features`) is a different version
+        return self.data_hash + json.dumps(self.prepare_state(), sort_keys=True)
+
+    def _version(self, spec):
+        return model_version(self._state_hash(), spec.estimator, spec.dtype,
+                             code=[__file__, transform.__file__, neighbors.__file__])
+
+    @profiled()
+    def score(self, x, batch_size=SCORE_BATCH_SIZE, proba=False):
+        """
+        Predicts with the current estimator over `x` in batches, so
+        only one batch at a time is converted to the estimator's dtype.
+
+        :param x:           DataFrame holding the design matrix columns,
+                            or an array, memory map or sparse matrix
+                            in column order
+        :param batch_size:  Number of rows predicted at a time
+        :param proba:       If True, class probabilities are returned
+        :return:            `ndarray` of predictions
+        """
+        if isinstance(x, pd.DataFrame) and self.columns is None:
+            self.design_matrix()
+
+        return predict_batches(self.estimator, x, self.columns, self._fit_dtype, batch_size, proba)
 
     def validate(self, y_test, x_test):
         raise NotImplementedError
 
 
-class ClosureClassifier(Model):
+class ClosureFeatures:
+    """
+    Features of the closure classifiers, in memory or streamed: the
+    feature columns of the restaurant inspection table and their
+    preparation for scoring. Needs `columns`, `scaler` and `score`.
+    """
+
+    # Columns of the restaurant inspection table used as features
+    feature_cols = ['zip', 'cuisine_description', 'critical_flag', 'score',
+                    'grade', 'violation_count', 'total_inspections']
+
+    scores = staticmethod(classification_scores)
+
+    def transform_rows(self, df):
+        """
+        Applies the feature preparation of `prepare()` to restaurant
+        rows (i.e: new or updated restaurants) with the fitted scaler
+        and feature columns, so that they can be scored
+
+        :param df:  DataFrame holding `feature_cols`
+        :return:    float32 `ndarray` in `self.columns` order
+        """
+        df = df[self.feature_cols].fillna(0)
+
+        # Pivot cuisine, cuisines not seen in training are dropped
+        cuisines = pd.get_dummies(df['cuisine_description'], prefix='cuisine')
+        df = df.join(cuisines).drop('cuisine_description', axis=1)
+        df = df.reindex(columns=self.columns, fill_value=0)
+
+        # The scaler was fit on the dense columns only, the
+        # one-hot columns are already within [0, 1]
+        dense = list(self.scaler.feature_names_in_)
+        df[dense] = self.scaler.transform(df[dense])
+
+        return df.values.astype('float32')
+
+    def validate(self, y_test, x_test):
+        self.report(y_test, self.score(x_test))
+
+    @staticmethod
+    def report(y_test, y_pred):
+        print("Results:")
+        print(metric.confusion_matrix(y_test, y_pred))
+        print("F1         :", metric.f1_score(y_test, y_pred))
+        print("Cohen Kappa:", metric.cohen_kappa_score(y_test, y_pred))
+
+
+class ClosureClassifier(ClosureFeatures, Model):
     """
     Performs classification of closed/not-closed
     on the Restaurant Inspections dataset. This can
@@ -86,84 +579,329 @@ class ClosureClassifier(Model):
     K-Nearest Neighbor.
     """
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, boosting='exact', neighbors='exact', lsh_probes=LSH_PROBES, weighted=True):
+        super().__init__(boosting)
+
+        # Weight the downsampled open restaurants back to their share
+        # of the whole table, for the estimators that take sample weights
+        self.weighted = weighted
 
-        # The restaurant closure dataset
-        self.df = fetch_restaurant_inspection_data()
+        # Neighbor index of the kNN estimator, one of `NEIGHBOR_INDEXES`
+        if neighbors not in NEIGHBOR_INDEXES:
+            raise ValueError("Unknown neighbor index: " + str(neighbors))
+        self.neighbors = neighbors
+        self.lsh_probes = lsh_probes
 
         self.y_col = "is_closed"
 
+        # The restaurant closure dataset. Only the feature columns are read,
+        # the identifying columns ('camis', 'dba', 'boro', ...), dates and
+        # 'violation_ratio' are not used
+        self.df = fetch_restaurant_inspection_data(columns=self.feature_cols + [self.y_col])
+        self.data_hash = frame_hash(self.df)
+
+    @profiled(output=lambda _, self: self.df)
     def prepare(self):
-        df = fetch_restaurant_inspection_data().fillna(0)
+        df = self.df.fillna(0)
 
         # Temporarily remove the Y column
         y = df[self.y_col]
         df = df.drop(self.y_col, 1)
 
-        # Drop other unneeded columns
-        drop_list = ['camis', 'dba', 'boro', 'building', 'street', 'phone',
-                     'inspection_year', 'inspection_month', 'inspection_day',
-                     'violation_ratio']
-
-        df = df.drop(drop_list, 1)
-
-        # Pivot cuisine
-        cuisines = pd.get_dummies(df['cuisine_description'], prefix='cuisine')
-        df = df.join(cuisines).drop('cuisine_description', 1)
+        # Pivot cuisine, as sparse columns which are kept sparse
+        # through scaling and into the design matrix
+        cuisines = sparse_dummies(df['cuisine_description'], prefix='cuisine')
+        df = df.join(cuisines).drop('cuisine_description', axis=1)
 
-        df = min_max_scale_values(df, None)
+        df, self.scaler = min_max_scale_values(df, None, return_scaler=True)
 
         # Place back Y col
-        df[self.y_col] = y.copy()
+        df[self.y_col] = y.values
 
         #
         # Downsample majority class
         #
 
-        open_downsample = df.loc[df[self.y_col] == 0].sample(sum(df[self.y_col]) * 3,
-                                                             random_state=42)
+        keep, weights = negative_downsample(y, NEGATIVE_RATIO, random_state=RANDOM_STATE, return_weights=True)
+
+        self.df = df.iloc[keep]
+        self.sample_weight = weights if self.weighted else None
+        self.prepared = True
+
+    def split(self):
+        # Closures are rare, both sets keep their share
+        return stratified_split(self.df[self.y_col], random_state=RANDOM_STATE)
+
+    def prepare_state(self):
+        return dict(super().prepare_state(), negative_ratio=NEGATIVE_RATIO, random_state=RANDOM_STATE,
+                    weighted=self.weighted)
+
+    def boosting_spec(self, engine=None):
+        if (engine or self.boosting) == 'hist':
+            estimator = HistGradientBoostingClassifier(max_iter=300,
+                                                       learning_rate=0.3,
+                                                       early_stopping=True,
+                                                       validation_fraction=HIST_VALIDATION_FRACTION,
+                                                       n_iter_no_change=HIST_ITER_NO_CHANGE,
+                                                       max_leaf_nodes=HIST_MAX_LEAF_NODES,
+                                                       min_samples_leaf=HIST_MIN_SAMPLES_LEAF,
+                                                       random_state=42)
+        else:
+            estimator = GradientBoostingClassifier(n_estimators=300,
+                                                   learning_rate=0.3)
+
+        return EstimatorSpec('Gradient Boosting', estimator, None)
 
-        df = pd.concat([open_downsample, df.loc[df[self.y_col] == 1]])
+    def knn_spec(self, index=None):
+        """
+        :param index:   One of `NEIGHBOR_INDEXES`, defaults to `self.neighbors`
+        :return:        `EstimatorSpec` of the kNN estimator
+        """
+        index = index or self.neighbors
 
-        self.df = df
+        if index == 'lsh':
+            estimator = LSHNeighborsClassifier(n_neighbors=30, n_probes=self.lsh_probes, random_state=42)
+        elif index == 'ball_tree':
+            estimator = KNeighborsClassifier(n_neighbors=30, algorithm='ball_tree')
+        else:
+            estimator = KNeighborsClassifier(n_neighbors=30)
 
-    def fit_gradient_boosting(self):
+        return EstimatorSpec('kNN', estimator, None)
+
+    def specs(self):
+        return [self.boosting_spec(),
+                self.knn_spec(),
+                EstimatorSpec('Neural Network',
+                              MLPClassifier(hidden_layer_sizes=(20, 7, 2),
+                                            alpha=0.00005,
+                                            learning_rate_init=0.001,
+                                            max_iter=500,
+                                            random_state=11),
+                              None)]
+
+    @profiled(output=lambda _, self: self.df)
+    def fit_gradient_boosting(self, engine=None):
         print("=== Gradient Boosting ========================")
 
-        self.estimator = GradientBoostingClassifier(n_estimators=300,
-                                                    learning_rate=0.3)
+        self.estimator = self.boosting_spec(engine).estimator
         self._fit()
 
-        features_importance = sorted(zip(self.estimator.feature_importances_,
-                                         self.df.columns),
-                                     reverse=True)
-        for f in features_importance[:10]:
-            print(f)
+        self.print_importances()
         print("==============================================")
 
-    def fit_knn(self):
+    @profiled(output=lambda _, self: self.df)
+    def fit_knn(self, index=None):
         print("=== kNN ======================================")
 
-        self.estimator = KNeighborsClassifier(n_neighbors=30)
+        self.estimator = self.knn_spec(index).estimator
         self._fit()
         print("==============================================")
 
+    @profiled(output=lambda _, self: self.df)
     def fit_neural_network(self):
         print("=== Neural Network ===========================")
-        self.estimator = MLPClassifier(hidden_layer_sizes=(20, 7, 2),
-                                       alpha=0.00005,
-                                       learning_rate_init=0.001,
-                                       max_iter=500,
-                                       random_state=11)
+        self.estimator = self._spec('Neural Network').estimator
         self._fit()
         print("==============================================")
 
-    def validate(self, y_test, x_test):
-        print("Results:")
-        print(metric.confusion_matrix(y_test, self.estimator.predict(x_test)))
-        print("F1         :", metric.f1_score(y_test, self.estimator.predict(x_test)))
-        print("Cohen Kappa:", metric.cohen_kappa_score(y_test, self.estimator.predict(x_test)))
+
+class StreamingClosureClassifier(ClosureFeatures):
+    """
+    The closure classifier trained out of core: the restaurant table
+    is streamed from the cache in batches through an estimator with
+    `partial_fit`, so it is never held in memory whole. The scaler and
+    class counts are fit in a first pass, and the majority class is
+    downsampled per batch, as `ClosureClassifier.prepare` does on the
+    whole table. It shares the features of `ClosureClassifier`, not its
+    in memory training (`Model`).
+    """
+
+    def __init__(self, estimator='sgd', batch_size=STREAM_BATCH_SIZE, epochs=STREAM_EPOCHS,
+                 negative_ratio=NEGATIVE_RATIO, split_size=0.2, random_state=42, weighted=True):
+        """
+        :param estimator:       One of `STREAMING_ESTIMATORS`
+        :param batch_size:      Number of restaurants read at a time
+        :param epochs:          Number of passes over the training rows
+        :param negative_ratio:  Open restaurants kept per closed restaurant
+        :param split_size:      Fraction of the restaurants held out for testing
+        :param random_state:    Seed of the downsampling and shuffling
+        :param weighted:        Weight the kept open restaurants back to their
+                                share of the table, as `ClosureClassifier`
+        """
+        if estimator not in STREAMING_ESTIMATORS:
+            raise ValueError("Unknown streaming estimator: " + str(estimator))
+
+        self.streaming_estimator = estimator
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.negative_ratio = negative_ratio
+        self.split_size = split_size
+        self.random_state = random_state
+        self.weighted = weighted
+
+        self.y_col = "is_closed"
+
+        # The estimator that was used, and the dtype it was fit on
+        self.estimator = None
+        self._fit_dtype = None
+
+        # Set by `prepare()`: the feature columns and their fitted scaler,
+        # the fraction of the open restaurants kept and the hash of the
+        # streamed table
+        self.columns = None
+        self.scaler = None
+        self.keep_open = None
+        self.data_hash = None
+
+        # True once `prepare()` has been ran
+        self.prepared = False
+
+    def streaming_spec(self, estimator=None):
+        """
+        :param estimator:   One of `STREAMING_ESTIMATORS`, defaults to
+                            the one the model was created with
+        :return:            `EstimatorSpec` of an estimator with `partial_fit`
+        """
+        estimator = estimator or self.streaming_estimator
+
+        if estimator == 'mlp':
+            return EstimatorSpec('Neural Network (streaming)',
+                                 MLPClassifier(hidden_layer_sizes=(20, 7, 2),
+                                               alpha=0.00005,
+                                               learning_rate_init=0.001,
+                                               random_state=11),
+                                 None)
+        if estimator == 'nb':
+            return EstimatorSpec('Naive Bayes (streaming)', GaussianNB(), None)
+
+        return EstimatorSpec('SGD (streaming)',
+                             SGDClassifier(loss='log_loss',
+                                           alpha=0.0001,
+                                           random_state=self.random_state),
+                             None)
+
+    def _batches(self):
+        # (position of the first row, `DataFrame`) of each batch
+        offset = 0
+        for df in stream_restaurant_inspection_data(columns=self.feature_cols + [self.y_col],
+                                                    batch_size=self.batch_size):
+            yield offset, df.fillna(0)
+            offset += len(df)
+
+    def _held_out(self, offset, n):
+        # Hashes the row positions, so every pass holds out the same rows
+        rows = np.arange(offset, offset + n, dtype='uint64')
+        return rows * np.uint64(2654435761) % np.uint64(2 ** 32) < self.split_size * 2 ** 32
+
+    def _downsample(self, df, rng):
+        # Keeps every closed restaurant and `keep_open` of the open ones,
+        # returns the kept rows and their sample weights
+        keep, weights = negative_downsample(df[self.y_col], keep_rate=self.keep_open, random_state=rng,
+                                            return_weights=True)
+        return df.iloc[keep], weights
+
+    @profiled()
+    def prepare(self):
+        """
+        First pass over the table: fits the min / max of the dense
+        columns, collects the cuisines and counts each class
+        """
+        dense = [c for c in self.feature_cols if c != 'cuisine_description']
+
+        self.scaler = MinMaxScaler()
+        cuisines = set()
+        counts = np.zeros(2, dtype='int64')
+        h = hashlib.sha256()
+
+        for _, df in self._batches():
+            h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+            self.scaler.partial_fit(df[dense])
+            cuisines.update('cuisine_' + str(c) for c in df['cuisine_description'].unique())
+            counts += np.bincount(df[self.y_col].astype('int64'), minlength=2)[:2]
+
+        # The columns of `prepare()` on the whole table: dense, then one-hot
+        self.columns = dense + sorted(cuisines)
+        self.keep_open = min(1.0, self.negative_ratio * counts[1] / max(counts[0], 1))
+        self.data_hash = h.hexdigest()
+
+        print("[ INF ] Streaming", counts.sum(), "restaurants,", counts[1], "closed, keeping",
+              "%.1f%% of the open ones" % (self.keep_open * 100))
+
+        self.prepared = True
+
+    @profiled()
+    def fit_streaming(self, estimator=None):
+        """
+        Trains with `partial_fit` over the training rows a batch at a
+        time, then scores the held out rows a batch at a time
+
+        :param estimator:   One of `STREAMING_ESTIMATORS`, defaults to
+                            the one the model was created with
+        :return:            dict of `classification_scores`
+        """
+        if not self.prepared:
+            self.prepare()
+
+        spec = self.streaming_spec(estimator)
+        print("=== %s %s" % (spec.name, '=' * (42 - len(spec.name))))
+
+        self.estimator = spec.estimator
+        self._fit_dtype = spec.dtype
+        rng = np.random.RandomState(self.random_state)
+
+        # Naive Bayes is fit exactly by one pass, more would count every row again
+        epochs = 1 if isinstance(self.estimator, GaussianNB) else self.epochs
+
+        for epoch in range(epochs):
+            n_rows = 0
+            for offset, df in self._batches():
+                df, weights = self._downsample(df.loc[~self._held_out(offset, len(df))], rng)
+
+                # The table is sorted by inspection date, rows are shuffled within each batch
+                order = rng.permutation(len(df))
+                df, weights = df.iloc[order], weights[order]
+                if not len(df):
+                    continue
+
+                self.estimator.partial_fit(self.transform_rows(df), df[self.y_col].values.astype('int64'),
+                                           classes=np.array([0, 1]),
+                                           **_weight_params(self.estimator.partial_fit,
+                                                            weights if self.weighted else None))
+                n_rows += len(df)
+
+            print("[ INF ] Epoch", epoch + 1, "of", epochs, "trained on", n_rows, "rows")
+
+        # The held out rows are downsampled as well, as the test split of `prepare()`
+        rng = np.random.RandomState(self.random_state)
+        y_test, y_pred = [], []
+
+        for offset, df in self._batches():
+            df, _ = self._downsample(df.loc[self._held_out(offset, len(df))], rng)
+            if len(df):
+                y_test.append(df[self.y_col].values.astype('int64'))
+                y_pred.append(self.score(self.transform_rows(df)))
+
+        y_test, y_pred = np.concatenate(y_test), np.concatenate(y_pred)
+        print("Test Size    :", len(y_test))
+        self.report(y_test, y_pred)
+        print("==============================================")
+
+        return self.scores(y_test, y_pred)
+
+    def score(self, x, batch_size=SCORE_BATCH_SIZE, proba=False):
+        """
+        Predicts with the current estimator over `x` in batches
+
+        :param x:           Rows of `transform_rows`, or a DataFrame
+                            holding `self.columns`
+        :param batch_size:  Number of rows predicted at a time
+        :param proba:       If True, class probabilities are returned
+        :return:            `ndarray` of predictions
+        """
+        if not self.prepared:
+            self.prepare()
+
+        return predict_batches(self.estimator, x, self.columns, self._fit_dtype, batch_size, proba)
 
 
 class ClosureRegressor(Model):
@@ -176,56 +914,141 @@ class ClosureRegressor(Model):
     Boosting Machine or Linear Regression.
     """
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, boosting='exact'):
+        super().__init__(boosting)
 
-        # The master dataset
-        self.df = master()
+        # The master dataset, without the columns `prepare()` drops
+        self.df = master(columns=self.read_column)
+        self.data_hash = frame_hash(self.df)
 
         self.y_col = "total_closures"
 
+        # Period (yyyymm) of each row of the prepared table
+        self.periods = None
+
+    @staticmethod
+    def read_column(c):
+        # The "reason for closure" columns and the economic data's own
+        # year / month are not features, the period columns are kept
+        # for the time split
+        return "reason_" not in c and c not in ('year', 'month')
+
+    @profiled(output=lambda _, self: self.df)
     def prepare(self):
-        df = self.df.loc[pd.to_numeric(self.df['inspection_year']) != 1900]
+        df = self.df.loc[inspection_period(self.df) // 100 != 1900]
+
+        # Kept for the time split, the period columns are dropped below
+        self.periods = inspection_period(df).values
 
         # Drop identifying columns
-        drop_list = ['inspection_year', 'inspection_month', 'year', 'month']
+        drop_list = ['inspection_period', 'inspection_year', 'inspection_month', 'year', 'month']
 
         # Remove the "reason for closure" columns
         drop_list += [c for c in df.columns.values if "reason_" in c]
 
         print(drop_list)
 
-        self.df = df.drop(drop_list, 1)
+        # Tables exported before the period key was added do not have it
+        self.df = df.drop(drop_list, axis=1, errors='ignore')
+        self.prepared = True
+
+    def split(self):
+        # The master table is a time series, the latest months are the test set
+        return time_split(self.periods)
+
+    def specs(self):
+        # Least squares on the collinear percent columns loses
+        # accuracy with float32 rounding
+        return [self.boosting_spec(),
+                EstimatorSpec('Linear Regression',
+                              LinearRegression(),
+                              'float64'),
+                EstimatorSpec('Neural Network',
+                              MLPRegressor(hidden_layer_sizes=(15, 5),
+                                           alpha=0.001),
+                              None)]
+
+    def boosting_spec(self, engine=None):
+        if (engine or self.boosting) == 'hist':
+            estimator = HistGradientBoostingRegressor(max_iter=300,
+                                                      learning_rate=0.13,
+                                                      early_stopping=True,
+                                                      validation_fraction=HIST_VALIDATION_FRACTION,
+                                                      n_iter_no_change=HIST_ITER_NO_CHANGE,
+                                                      max_leaf_nodes=HIST_MAX_LEAF_NODES,
+                                                      min_samples_leaf=HIST_MIN_SAMPLES_LEAF,
+                                                      random_state=42)
+        else:
+            estimator = GradientBoostingRegressor(n_estimators=300,
+                                                  learning_rate=0.13)
 
-    def fit_gradient_boosting(self):
+        return EstimatorSpec('Gradient Boosting', estimator, None)
+
+    scores = staticmethod(regression_scores)
+
+    def validate_over_time(self, n_splits=3, test_periods=3, train_periods=None):
+        """
+        Fits the current estimator (gradient boosting if none) on
+        rolling origin splits of the master table, each tested on the
+        months following its training months (see `rolling_time_splits`)
+
+        :param n_splits:        Number of splits
+        :param test_periods:    Number of months tested per split
+        :param train_periods:   Number of months trained on per split,
+                                or None for every earlier month
+        :return:                `DataFrame` of the scores of each split
+        """
+        if not self.prepared:
+            self.prepare()
+
+        estimator = self.estimator if self.estimator is not None else self.boosting_spec().estimator
+
+        x = self.df.drop(self.y_col, axis=1).fillna(0).values.astype(self._fit_dtype or 'float32')
+        y = self.df[self.y_col].fillna(0).values
+
+        rows = []
+        for train, test in rolling_time_splits(self.periods, n_splits, test_periods, train_periods):
+            e = clone(estimator).fit(x[train], y[train])
+            row = {'Train to': int(self.periods[train].max()),
+                   'Test': '%d-%d' % (self.periods[test].min(), self.periods[test].max()),
+                   'Training Size': len(train),
+                   'Test Size': len(test)}
+            row.update(self.scores(y[test], e.predict(x[test])))
+            rows.append(row)
+
+        table = pd.DataFrame(rows)
+        print(table)
+        return table
+
+    @profiled(output=lambda _, self: self.df)
+    def fit_gradient_boosting(self, engine=None):
         print("=== Gradient Boosting ========================")
 
-        self.estimator = GradientBoostingRegressor(n_estimators=300,
-                                                   learning_rate=0.13)
+        self.estimator = self.boosting_spec(engine).estimator
         self._fit()
 
-        features_importance = sorted(zip(self.estimator.feature_importances_,
-                                         self.df.columns),
-                                     reverse=True)
-        for f in features_importance[:10]:
-            print(f)
+        self.print_importances()
         print("==============================================")
 
+    @profiled(output=lambda _, self: self.df)
     def fit_lin_reg(self):
         print("=== Linear Regression ========================")
-        self.estimator = LinearRegression()
-        self._fit()
+        spec = self._spec('Linear Regression')
+        self.estimator = spec.estimator
+        self._fit(spec.dtype)
         print("==============================================")
 
+    @profiled(output=lambda _, self: self.df)
     def fit_neural_network(self):
         print("=== Neural Network ===========================")
-        self.estimator = MLPRegressor(hidden_layer_sizes=(15, 5),
-                                      alpha=0.001)
+        self.estimator = self._spec('Neural Network').estimator
         self._fit()
         print("==============================================")
 
     def validate(self, y_test, x_test):
+        y_pred = self.score(x_test)
+
         print("Results:")
-        print("Exp Var:", metric.explained_variance_score(y_test, self.estimator.predict(x_test)))
-        print("MAE    :", metric.mean_absolute_error(y_test, self.estimator.predict(x_test)))
-        print("R2     :", metric.r2_score(y_test, self.estimator.predict(x_test)))
+        print("Exp Var:", metric.explained_variance_score(y_test, y_pred))
+        print("MAE    :", metric.mean_absolute_error(y_test, y_pred))
+        print("R2     :", metric.r2_score(y_test, y_pred))
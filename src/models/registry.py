@@ -0,0 +1,186 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# registry.py
+#
+# Storage of fitted estimators. Each fitted estimator is saved with
+# its feature columns, scaler and the hash of the data and code it was
+# trained from, under `REGISTRY_DIR/<model>/<estimator>/<version>/`.
+# The version is derived from those hashes, so an estimator is only
+# retrained when its inputs change. Feature rankings are kept next to
+# the versions, under `rankings/`.
+#
+
+
+import hashlib
+import json
+import os
+import re
+import time
+
+import joblib
+
+from src.preprocessing.cache import hash_file
+
+#
+# Constants
+#
+
+REGISTRY_DIR = "data/registry/"
+
+BUNDLE_FILE = "estimator.joblib"
+META_FILE = "meta.json"
+LATEST_FILE = "LATEST"
+RANKING_DIR = "rankings"
+
+
+#
+# Helpers
+#
+
+def _slug(name):
+    return re.sub(r'[^\w]+', '_', name.lower()).strip('_')
+
+
+def _directory(model_name, estimator_name, registry_dir=REGISTRY_DIR):
+    return os.path.join(registry_dir, model_name, _slug(estimator_name))
+
+
+def model_version(data_hash, estimator, dtype=None, code=()):
+    """
+    Version of a fitted estimator: a hash of the data it is trained
+    on, its parameters and the code which prepares and fits it
+
+    :param data_hash:   Hash of the input data (see `transform.frame_hash`)
+    :param estimator:   Unfitted estimator
+    :param dtype:       dtype of the design matrix it is fit on
+    :param code:        Paths of the Python files which prepare the data
+    :return:            Version as string
+    """
+    h = hashlib.sha256()
+    h.update(data_hash.encode())
+    h.update(type(estimator).__name__.encode())
+    h.update(json.dumps(estimator.get_params(), sort_keys=True, default=str).encode())
+    h.update(str(dtype).encode())
+
+    for c in code:
+        h.update(hash_file(c).encode())
+
+    return h.hexdigest()[:16]
+
+
+#
+# Save / Load
+#
+
+def save_model(model_name, estimator_name, version, estimator, meta, scaler=None,
+               registry_dir=REGISTRY_DIR):
+    """
+    Saves a fitted estimator (and the scaler of its inputs) uncompressed,
+    so its arrays can be memory mapped on load, and marks it as the latest
+    version
+
+    :param model_name:      Name of the `Model` class
+    :param estimator_name:  Name of the `EstimatorSpec`
+    :param version:         Version from `model_version`
+    :param estimator:       Fitted estimator
+    :param meta:            dict of metadata (columns, y column, dtype, ...)
+    :param scaler:          Fitted scaler of the input columns, if any
+    :param registry_dir:    Root of the registry
+    :return:                Path of the saved version
+    """
+    directory = _directory(model_name, estimator_name, registry_dir)
+    path = os.path.join(directory, version)
+    os.makedirs(path, exist_ok=True)
+
+    joblib.dump({'estimator': estimator, 'scaler': scaler}, os.path.join(path, BUNDLE_FILE))
+
+    meta = dict(meta, model=model_name, estimator=estimator_name, version=version, created=time.time())
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    with open(os.path.join(directory, LATEST_FILE), 'w') as f:
+        f.write(version)
+
+    return path
+
+
+def load_model(model_name, estimator_name, version=None, registry_dir=REGISTRY_DIR):
+    """
+    Loads a saved estimator, memory mapping its arrays
+
+    :param model_name:      Name of the `Model` class
+    :param estimator_name:  Name of the `EstimatorSpec`
+    :param version:         Version to load, defaults to the latest
+    :param registry_dir:    Root of the registry
+    :return:                (estimator, scaler, meta dict), or None if not saved
+    """
+    directory = _directory(model_name, estimator_name, registry_dir)
+
+    if version is None:
+        if not os.path.isfile(os.path.join(directory, LATEST_FILE)):
+            return None
+        with open(os.path.join(directory, LATEST_FILE)) as f:
+            version = f.read().strip()
+
+    path = os.path.join(directory, version)
+    if not os.path.isfile(os.path.join(path, META_FILE)):
+        return None
+
+    bundle = joblib.load(os.path.join(path, BUNDLE_FILE), mmap_mode='r')
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+
+    return bundle['estimator'], bundle['scaler'], meta
+
+
+def save_ranking(model_name, estimator_name, version, ranking, registry_dir=REGISTRY_DIR):
+    """
+    Saves the feature ranking of an estimator (see `selection.rank_features`)
+
+    :param model_name:      Name of the `Model` class
+    :param estimator_name:  Name of the `EstimatorSpec`
+    :param version:         Version of the estimator, data and selection settings
+    :param ranking:         dict of the ranking
+    :param registry_dir:    Root of the registry
+    :return:                Path of the saved ranking
+    """
+    directory = os.path.join(_directory(model_name, estimator_name, registry_dir), RANKING_DIR)
+    os.makedirs(directory, exist_ok=True)
+
+    path = os.path.join(directory, version + '.json')
+    with open(path, 'w') as f:
+        json.dump(dict(ranking, version=version, created=time.time()), f, indent=1)
+
+    return path
+
+
+def load_ranking(model_name, estimator_name, version, registry_dir=REGISTRY_DIR):
+    """
+    :return: dict of a saved feature ranking, or None if not saved
+    """
+    path = os.path.join(_directory(model_name, estimator_name, registry_dir), RANKING_DIR, version + '.json')
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def list_versions(model_name, estimator_name, registry_dir=REGISTRY_DIR):
+    """
+    :return: List of metadata dicts of the saved versions, oldest first
+    """
+    directory = _directory(model_name, estimator_name, registry_dir)
+    if not os.path.isdir(directory):
+        return []
+
+    metas = []
+    for version in os.listdir(directory):
+        meta_file = os.path.join(directory, version, META_FILE)
+        if os.path.isfile(meta_file):
+            with open(meta_file) as f:
+                metas.append(json.load(f))
+
+    return sorted(metas, key=lambda m: m['created'])
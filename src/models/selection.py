@@ -0,0 +1,65 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# selection.py
+#
+# Recursive feature elimination with cross validation (`RFECV`) over
+# the memory mapped design matrix. The selection is sklearn's own: the
+# folds are scored in parallel and the final ranking comes from an
+# elimination over the whole data set. The number of features eliminated
+# per step can be raised to cut the number of fits, and rankings are
+# cached in the model registry (see `Model.select_features`) so they are
+# not recomputed.
+#
+
+import numpy as np
+from sklearn.feature_selection import RFECV
+
+from src.preprocessing.transform import load_design_matrix
+
+#
+# Constants
+#
+
+# Features eliminated at each step: one at a time by default, as
+# `RFECV`. A fraction (< 1) of the features per step is opt-in, i.e:
+# `FAST_ELIMINATION_STEP`, which needs far fewer fits on wide matrices
+# but may stop short of the best number of features
+ELIMINATION_STEP = 1
+FAST_ELIMINATION_STEP = 0.1
+
+
+#
+# Ranking
+#
+
+def rank_features(path, estimator, step=ELIMINATION_STEP, cv=5, scoring=None, dtype=None,
+                  min_features=1, n_jobs=-1):
+    """
+    Ranks the features of a design matrix by recursive elimination
+    with cross validation
+
+    :param path:            Path of the design matrix (see `materialize_design_matrix`)
+    :param estimator:       Unfitted estimator exposing `feature_importances_` or `coef_`
+    :param step:            Fraction (< 1) of the features, or number of
+                            features, eliminated per step (as `RFECV`)
+    :param cv:              Number of folds (stratified for classifiers)
+    :param scoring:         Scoring name, or None for the estimator's score
+    :param dtype:           dtype the matrix is cast to, or None for float32
+    :param min_features:    Smallest number of features scored
+    :param n_jobs:          Number of folds scored in parallel, -1 for all CPUs
+    :return:                dict of `columns`, `ranking` (`RFECV.ranking_`),
+                            `n_features` and the mean held out score per step
+    """
+    m = load_design_matrix(path)
+    x = m.x.astype(dtype) if dtype else m.x
+
+    selector = RFECV(estimator, step=step, cv=cv, scoring=scoring, min_features_to_select=min_features,
+                     n_jobs=n_jobs)
+    selector.fit(x, np.asarray(m.y))
+
+    return {'columns': list(m.columns),
+            'ranking': selector.ranking_.tolist(),
+            'n_features': int(selector.n_features_),
+            'scores': selector.cv_results_['mean_test_score'].tolist()}
@@ -0,0 +1,334 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# serving.py
+#
+# Online scoring of restaurants (by CAMIS) with a fitted
+# `ClosureClassifier`. The features of every restaurant are held
+# in memory, concurrent requests are batched into single
+# `predict_proba` calls, and the service is exposed over a small
+# asyncio HTTP server. Run with: `python -m src.models.serving [port]`
+#
+
+
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from src.models.prediction import ClosureClassifier
+from src.preprocessing.fetch import fetch_restaurant_inspection_data
+
+#
+# Constants
+#
+
+HOST = "127.0.0.1"
+PORT = 8008
+
+# Largest number of requests scored in one `predict_proba` call
+MAX_BATCH = 256
+
+# Longest time (seconds) a request waits for its batch to fill
+MAX_WAIT = 0.002
+
+# Number of recent request latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+
+#
+# Feature Index
+#
+
+class FeatureIndex:
+    """
+    In memory index of the prepared (scaled, one-hot encoded)
+    feature rows of restaurants, keyed by CAMIS
+    """
+
+    def __init__(self, model, df):
+        """
+        :param model:   Fitted `ClosureClassifier` (see `fit_or_load`)
+        :param df:      Restaurant rows holding `camis` and `model.feature_cols`
+        """
+        self.model = model
+
+        # A CAMIS has a row per name / address it was inspected under, and
+        # the table is sorted by inspection date, so its latest row is kept
+        df = df.drop_duplicates('camis', keep='first')
+
+        self.positions = {c: i for i, c in enumerate(df['camis'].values)}
+        self.x = model.transform_rows(df)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, camis):
+        return camis in self.positions
+
+    def rows(self, camis):
+        """
+        :param camis:   List of CAMIS, all present in the index
+        :return:        float32 `ndarray` of their feature rows
+        """
+        return self.x[[self.positions[c] for c in camis]]
+
+    def upsert(self, df):
+        """
+        Adds or replaces the feature rows of restaurants
+
+        :param df:  Restaurant rows holding `camis` and `model.feature_cols`.
+                    Of rows with the same CAMIS, the last one is kept
+        :return:    None
+        """
+        df = df.drop_duplicates('camis', keep='last')
+        x = self.model.transform_rows(df)
+
+        new = []
+        for c, row in zip(df['camis'].values, x):
+            if c in self.positions:
+                self.x[self.positions[c]] = row
+            else:
+                # New rows are stacked after the current ones
+                self.positions[c] = self.x.shape[0] + len(new)
+                new.append(row)
+
+        if new:
+            self.x = np.vstack([self.x, np.array(new, dtype='float32')])
+
+
+#
+# Service
+#
+
+class ScoringService:
+    """
+    Scores restaurants by CAMIS. Requests are queued and a single
+    batching task scores up to `max_batch` of them at a time,
+    waiting at most `max_wait` seconds for a batch to fill.
+    """
+
+    def __init__(self, model, index, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self.model = model
+        self.index = index
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.queue = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.batches = 0
+
+    async def score(self, camis):
+        """
+        :param camis:   CAMIS of the restaurant
+        :return:        dict of the closure probability and label,
+                        or None if the restaurant is not indexed
+        """
+        if camis not in self.index:
+            return None
+
+        start = time.perf_counter()
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((camis, future))
+        probability = await future
+
+        self.latencies.append(time.perf_counter() - start)
+        self.requests += 1
+
+        return {'camis': int(camis),
+                'probability': float(probability),
+                'is_closed': int(probability >= 0.5)}
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Prediction runs off the event loop so requests keep arriving.
+            # A failed batch fails its requests, the batcher keeps running
+            try:
+                x = self.index.rows([c for c, _ in batch])
+                p = await loop.run_in_executor(None, self.model.estimator.predict_proba, x)
+            except Exception as e:
+                print("[ ERR ] Scoring a batch of", len(batch), "failed:", e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+
+            for (_, future), probability in zip(batch, p[:, 1]):
+                if not future.done():
+                    future.set_result(probability)
+
+    def stats(self):
+        """
+        :return: dict of request / batch counts and p50 / p99 latency in ms
+        """
+        latencies = np.array(self.latencies) * 1000
+        return {'requests': self.requests,
+                'batches': self.batches,
+                'restaurants': len(self.index),
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None}
+
+    #
+    # HTTP
+    #
+
+    async def _route(self, method, path, body):
+        # GET  /score/<camis>   Score one restaurant
+        # POST /restaurants     Add or replace restaurant rows (JSON list of rows)
+        # GET  /stats           Latency and batching statistics
+        parts = path.strip('/').split('/')
+
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'score':
+            try:
+                camis = int(parts[1])
+            except ValueError:
+                return 400, {'error': 'CAMIS must be an integer'}
+
+            result = await self.score(camis)
+            if result is None:
+                return 404, {'error': 'Unknown CAMIS', 'camis': camis}
+            return 200, result
+
+        if method == 'POST' and parts == ['restaurants']:
+            rows = pd.DataFrame(json.loads(body or b'[]'))
+            missing = [c for c in ['camis'] + self.model.feature_cols if c not in rows.columns]
+            if missing:
+                return 400, {'error': 'Missing columns', 'columns': missing}
+
+            self.index.upsert(rows)
+            return 200, {'updated': len(rows)}
+
+        if method == 'GET' and parts == ['stats']:
+            return 200, self.stats()
+
+        return 404, {'error': 'Not found'}
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                writer.close()
+                return
+
+            method, path, _ = request_line.decode().split(' ', 2)
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                k, v = line.decode().split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, payload = await self._route(method, path, body)
+        except Exception as e:
+            status, payload = 500, {'error': str(e)}
+
+        data = json.dumps(payload).encode()
+        writer.write(('HTTP/1.1 %d\r\nContent-Type: application/json\r\n'
+                      'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(data))).encode() + data)
+        await writer.drain()
+        writer.close()
+
+    async def start(self, host=HOST, port=PORT):
+        """
+        Starts the batching task and the HTTP server
+
+        :return: `asyncio.Server`
+        """
+        self.queue = asyncio.Queue()
+        asyncio.get_running_loop().create_task(self._batcher())
+        return await asyncio.start_server(self._handle, host, port)
+
+
+def load_service(estimator_name='Gradient Boosting', max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+    """
+    Loads (or trains) the classifier from the model registry and
+    indexes the current restaurant features
+
+    :param estimator_name:  Name of the classifier's `EstimatorSpec`
+    :param max_batch:       Largest number of requests per prediction
+    :param max_wait:        Longest wait for a batch to fill, in seconds
+    :return:                `ScoringService`
+    """
+    model = ClosureClassifier()
+    model.fit_or_load(estimator_name)
+
+    df = fetch_restaurant_inspection_data(columns=['camis'] + model.feature_cols)
+    index = FeatureIndex(model, df)
+
+    print("[ INF ] Indexed", len(index), "restaurants")
+
+    return ScoringService(model, index, max_batch, max_wait)
+
+
+#
+# Client
+#
+
+class ScoringClient:
+    """Minimal asyncio client of the scoring service"""
+
+    def __init__(self, host=HOST, port=PORT):
+        self.host = host
+        self.port = port
+
+    async def request(self, method, path, payload=None):
+        """
+        :return: (status, dict)
+        """
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+
+        body = json.dumps(payload).encode() if payload is not None else b''
+        writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n\r\n'
+                      % (method, path, self.host, len(body))).encode() + body)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        response = await reader.read()
+        writer.close()
+
+        return status, json.loads(response.split(b'\r\n\r\n', 1)[1])
+
+    async def score(self, camis):
+        return await self.request('GET', '/score/%d' % camis)
+
+    async def upsert(self, rows):
+        return await self.request('POST', '/restaurants', rows)
+
+    async def stats(self):
+        return await self.request('GET', '/stats')
+
+
+if __name__ == '__main__':
+    async def _serve(port):
+        service = load_service()
+        server = await service.start(port=port)
+        print("[ INF ] Scoring on http://%s:%d" % (HOST, port))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(_serve(int(sys.argv[1]) if len(sys.argv) > 1 else PORT))
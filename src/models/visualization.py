@@ -12,6 +12,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from src.models.cluster_analysis import pca_on_restaurant_inspections_file
+from src.preprocessing.fetch import inspection_period
 from src.preprocessing.merge import master
 from src.preprocessing.transform import min_max_scale_values
 
@@ -23,9 +24,8 @@ def closures_over_time():
     """
     df = master().dropna()
 
-    # Merge Time
-    df['time'] = df['inspection_year'].astype('str') + df['inspection_month'].astype('str')
-    df['time'] = df['time'].astype('int')
+    # Monthly time key (yyyymm)
+    df['time'] = inspection_period(df)
     df = df.sort_values('time', ascending=True)
 
     # Isolate Cols
@@ -0,0 +1,596 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# cache.py
+#
+
+# This file handles the caching of fetched and merged tables.
+# Each cached table is stored under a key made from the hash
+# of its source files, the parameters it was built with and the
+# source code that built it, so a change to any of them is a miss
+# and the table is rebuilt. The cache is bounded in size and the
+# least recently used tables are evicted first. Tables are stored as
+# Parquet so their dtypes survive the round trip and a caller can read
+# back only the columns it needs.
+#
+# Tables that grow a month at a time can instead be stored as a
+# `PartitionedTable`, where only the partitions whose inputs
+# changed are rebuilt.
+
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the index is not locked across processes
+    fcntl = None
+
+#
+# Constants
+#
+
+
+CACHE_DIR = "data/cache/"
+CACHE_INDEX = "index.json"
+CACHE_LOCK = "index.lock"
+
+# Partitioned tables are stored as a directory of Parquet files each
+PARTITION_DIR = CACHE_DIR + "partitions/"
+PARTITION_MANIFEST = "manifest.json"
+
+# Storage format of cached tables, either 'parquet' or 'csv'
+CACHE_FORMAT = 'parquet'
+
+# Upper bound on the total size of cached tables on disk
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Number of rows per batch when a cached table is read in batches
+CACHE_BATCH_SIZE = 65536
+
+# Size of the blocks read when hashing source files
+HASH_BLOCK_SIZE = 1024 ** 2
+
+
+#
+# Hashing
+#
+
+
+def hash_file(file_name, block_size=HASH_BLOCK_SIZE):
+    """
+    SHA-256 of the contents of a file
+
+    :param file_name:   Path to the file
+    :param block_size:  Number of bytes read at a time
+    :return:            Hex digest as string
+    """
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_frames(frames):
+    """
+    SHA-256 of the columns, dtypes and values of DataFrames
+
+    :param frames:  List of `DataFrame`
+    :return:        Hex digest as string
+    """
+    h = hashlib.sha256()
+    for df in frames:
+        h.update(json.dumps([[str(c), str(t)] for c, t in df.dtypes.items()]).encode())
+        h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def project(columns, names):
+    """
+    Resolves a column projection against the columns of a table
+
+    :param columns: None (every column), a list of columns, or a function
+                    of a column name returning True for the columns kept
+    :param names:   Columns of the table
+    :return:        List of columns, or None for every column
+    """
+    if callable(columns):
+        return [c for c in names if columns(c)]
+    return columns
+
+
+def _column_names(path, file_format):
+    # Only the schema (or the CSV header) is read
+    if file_format == 'parquet':
+        return pq.read_schema(path).names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+#
+# Cache
+#
+
+
+class ArtifactCache:
+    """
+    Content addressed, size bounded, LRU cache of DataFrames
+    on disk. The index (keys, sizes, access times, hit/miss
+    statistics and known source file hashes) is kept as JSON
+    alongside the cached tables.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, file_format=CACHE_FORMAT):
+        if file_format not in ('parquet', 'csv'):
+            raise ValueError("Unknown cache format: " + str(file_format))
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.file_format = file_format
+
+    #
+    # Index
+    #
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, CACHE_INDEX)
+
+    def _load_index(self):
+        if os.path.isfile(self._index_path()):
+            with open(self._index_path()) as f:
+                return json.load(f)
+        return {'entries': {}, 'sources': {}, 'stats': {'hits': 0, 'misses': 0, 'evictions': 0}}
+
+    def _save_index(self, index):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Write then rename so a reader never sees a partial index
+        tmp = self._index_path() + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._index_path())
+
+    @contextmanager
+    def _lock(self):
+        # Serializes updates of the index between processes
+        # (i.e: pipeline stages caching their outputs concurrently)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, CACHE_LOCK), 'w') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _path(self, key, file_format=None):
+        return os.path.join(self.cache_dir, key + '.' + (file_format or self.file_format))
+
+    def _read(self, key, file_format, columns=None):
+        if callable(columns):
+            columns = project(columns, _column_names(self._path(key, file_format), file_format))
+
+        if file_format == 'parquet':
+            return pd.read_parquet(self._path(key, file_format), columns=columns)
+        df = pd.read_csv(self._path(key, file_format), usecols=columns)
+        return df[columns] if columns else df
+
+    def _read_batches(self, path, file_format, columns=None, batch_size=CACHE_BATCH_SIZE):
+        # The file is opened here rather than on the first batch, so
+        # an eviction after this returns cannot fail the iteration
+        if callable(columns):
+            columns = project(columns, _column_names(path, file_format))
+
+        if file_format == 'parquet':
+            reader = pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns)
+            return (batch.to_pandas() for batch in reader)
+
+        reader = pd.read_csv(path, usecols=columns, chunksize=batch_size)
+        return (df[columns] if columns else df for df in reader)
+
+    def _write(self, key, df):
+        if self.file_format == 'parquet':
+            df.to_parquet(self._path(key), index=False)
+        else:
+            df.to_csv(self._path(key), index=False)
+
+    #
+    # Keys
+    #
+
+    def _source_hash(self, index, file_name):
+        # Hashing large CSVs is slow, so the digest is reused
+        # while the file's size and modification time are unchanged
+        st = os.stat(file_name)
+        known = index['sources'].get(file_name)
+        if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime_ns:
+            return known['sha256']
+
+        digest = hash_file(file_name)
+        index['sources'][file_name] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': digest}
+        return digest
+
+    def key(self, name, sources=(), params=None, code=()):
+        """
+        Builds the cache key for a table
+
+        :param name:    Name of the table
+        :param sources: Paths of the files the table is built from
+        :param params:  dict of parameters the table is built with
+        :param code:    Paths of the Python files whose code builds the table
+        :return:        Key as string
+        """
+        index = self._load_index()
+
+        h = hashlib.sha256()
+        h.update(name.encode())
+        h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+
+        for s in sources:
+            h.update(s.encode())
+            h.update(self._source_hash(index, s).encode())
+
+        for c in code:
+            h.update(hash_file(c).encode())
+
+        # Files are hashed outside of the lock, only the
+        # known hashes are merged into the latest index
+        with self._lock():
+            latest = self._load_index()
+            latest['sources'].update({s: index['sources'][s] for s in sources})
+            self._save_index(latest)
+
+        return name + '-' + h.hexdigest()[:16]
+
+    #
+    # Access
+    #
+
+    def get(self, key, columns=None):
+        """
+        Reads a cached table, recording a hit or miss
+
+        :param key:     Key from `key()`
+        :param columns: If set, only these columns are read
+        :return:        `DataFrame` or None
+        """
+        # Only the index update is locked, concurrent readers
+        # of large tables do not wait on each other
+        with self._lock():
+            file_format = self._access(key)
+        if file_format is None:
+            return None
+
+        try:
+            return self._read(key, file_format, columns)
+        except FileNotFoundError:
+            # Evicted by another process since the hit was recorded
+            print("[ WRN ] Cache entry", key, "was evicted while reading - rebuilding")
+            return None
+
+    def _access(self, key):
+        # Records a hit or miss of `key`, with the lock held, and
+        # returns the storage format of the entry (None on a miss)
+        index = self._load_index()
+        entry = index['entries'].get(key)
+
+        if entry and os.path.isfile(self._path(key, entry.get('format', 'csv'))):
+            index['stats']['hits'] += 1
+            entry['last_access'] = time.time()
+            self._save_index(index)
+            return entry.get('format', 'csv')
+
+        index['stats']['misses'] += 1
+        index['entries'].pop(key, None)
+        self._save_index(index)
+        return None
+
+    def put(self, key, df):
+        """
+        Writes a table to the cache, then evicts the least
+        recently used tables until the cache fits `max_bytes`
+
+        :param key: Key from `key()`
+        :param df:  `DataFrame`
+        :return:    None
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._write(key, df)
+
+        with self._lock():
+            index = self._load_index()
+            index['entries'][key] = {'size': os.path.getsize(self._path(key)),
+                                     'format': self.file_format,
+                                     'last_access': time.time()}
+
+            lru = sorted(index['entries'].items(), key=lambda e: e[1]['last_access'])
+            total = sum(e['size'] for _, e in lru)
+
+            for k, e in lru:
+                if total <= self.max_bytes or k == key:
+                    break
+                if os.path.isfile(self._path(k, e.get('format', 'csv'))):
+                    os.remove(self._path(k, e.get('format', 'csv')))
+                total -= e['size']
+                del index['entries'][k]
+                index['stats']['evictions'] += 1
+                print("[ INF ] Cache evicted", k)
+
+            self._save_index(index)
+
+    def stats(self):
+        """
+        :return: dict of hits, misses, evictions, entries and total bytes
+        """
+        index = self._load_index()
+        s = dict(index['stats'])
+        s['entries'] = len(index['entries'])
+        s['bytes'] = sum(e['size'] for e in index['entries'].values())
+        return s
+
+    def clear(self):
+        """
+        Removes every cached table and resets the statistics
+        :return: None
+        """
+        with self._lock():
+            index = self._load_index()
+            for k, e in index['entries'].items():
+                if os.path.isfile(self._path(k, e.get('format', 'csv'))):
+                    os.remove(self._path(k, e.get('format', 'csv')))
+            self._save_index({'entries': {}, 'sources': index['sources'],
+                              'stats': {'hits': 0, 'misses': 0, 'evictions': 0}})
+
+    def lookup(self, name, sources=(), params=None, code=(), reload=False, fallback=None, columns=None):
+        """
+        Returns the cached table for the given inputs without building it
+
+        :param name:        Name of the table
+        :param sources:     Paths of the files the table is built from
+        :param params:      dict of parameters the table is built with
+        :param code:        Paths of the Python files whose code builds the table
+        :param reload:      Treat the table as missing (it is to be rebuilt)
+        :param fallback:    CSV to read instead if any source file is missing
+                            (i.e: a previously exported copy of the table)
+        :param columns:     If set, only these columns are read and returned
+                            (a list, or a function of a column name, see `project`)
+        :return:            `DataFrame`, or None if it has to be built
+        """
+        missing = [s for s in sources if not os.path.isfile(s)]
+        if missing:
+            if fallback and os.path.isfile(fallback):
+                print("[ WRN ] Missing sources for", name, "- using", fallback)
+                columns = project(columns, _column_names(fallback, 'csv'))
+                df = pd.read_csv(fallback, usecols=columns)
+                return df[columns] if columns else df
+            raise FileNotFoundError("Missing sources for " + name + ": " + ", ".join(missing))
+
+        if reload:
+            return None
+
+        return self.get(self.key(name, sources, params, code), columns)
+
+    def batches(self, name, sources=(), params=None, code=(), fallback=None, columns=None,
+                batch_size=CACHE_BATCH_SIZE):
+        """
+        Reads the cached table for the given inputs in batches of
+        rows, so that no more than a batch is held in memory
+
+        :param name:        Name of the table
+        :param sources:     Paths of the files the table is built from
+        :param params:      dict of parameters the table is built with
+        :param code:        Paths of the Python files whose code builds the table
+        :param fallback:    CSV to read instead if any source file is missing
+        :param columns:     If set, only these columns are read
+        :param batch_size:  Number of rows per batch
+        :return:            Iterator of `DataFrame`, or None if the table has to be built
+        """
+        missing = [s for s in sources if not os.path.isfile(s)]
+        if missing:
+            if fallback and os.path.isfile(fallback):
+                print("[ WRN ] Missing sources for", name, "- using", fallback)
+                return self._read_batches(fallback, 'csv', columns, batch_size)
+            raise FileNotFoundError("Missing sources for " + name + ": " + ", ".join(missing))
+
+        key = self.key(name, sources, params, code)
+        with self._lock():
+            file_format = self._access(key)
+        if file_format is None:
+            return None
+
+        try:
+            return self._read_batches(self._path(key, file_format), file_format, columns, batch_size)
+        except FileNotFoundError:
+            print("[ WRN ] Cache entry", key, "was evicted while reading - rebuilding")
+            return None
+
+    def cached(self, name, compute, sources=(), params=None, code=(), reload=False, fallback=None,
+               columns=None):
+        """
+        Returns the cached table for the given inputs, or builds
+        it with `compute` and caches it.
+
+        :param name:        Name of the table
+        :param compute:     Function with no arguments building the `DataFrame`
+        :param sources:     Paths of the files the table is built from
+        :param params:      dict of parameters the table is built with
+        :param code:        Paths of the Python files whose code builds the table
+        :param reload:      Force a rebuild even on a hit
+        :param fallback:    CSV to read instead if any source file is missing
+                            (i.e: a previously exported copy of the table)
+        :param columns:     If set, only these columns are read and returned
+        :return:            `DataFrame`
+        """
+        df = self.lookup(name, sources, params, code, reload, fallback, columns)
+        if df is not None:
+            return df
+
+        df = compute()
+        self.put(self.key(name, sources, params, code), df)
+
+        columns = project(columns, df.columns)
+        return df[columns] if columns else df
+
+
+#
+# Partitioned Tables
+#
+
+
+class PartitionedTable:
+    """
+    A table stored as one Parquet file per partition (i.e: per
+    month), with a manifest of the hash of the inputs each
+    partition was built from. An update rebuilds only the
+    partitions whose inputs changed, so its cost scales with the
+    size of the change rather than with the whole table. When the
+    changed partitions are known up front (i.e: from new rows), the
+    other partitions' inputs need not be read or hashed at all.
+    """
+
+    def __init__(self, name, partition_dir=PARTITION_DIR):
+        self.name = name
+        self.path = os.path.join(partition_dir, name)
+
+    def _manifest_path(self):
+        return os.path.join(self.path, PARTITION_MANIFEST)
+
+    def _load_manifest(self):
+        if os.path.isfile(self._manifest_path()):
+            with open(self._manifest_path()) as f:
+                return json.load(f)
+        return {'state': None, 'partitions': {}, 'info': {}}
+
+    def _save_manifest(self, manifest):
+        # Write then rename so a reader never sees a partial manifest
+        tmp = self._manifest_path() + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._manifest_path())
+
+    def _file(self, partition):
+        return os.path.join(self.path, partition + '.parquet')
+
+    @staticmethod
+    def _name(key):
+        return '-'.join(str(k) for k in key)
+
+    @staticmethod
+    def _state_hash(state):
+        return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_current(self, state=None):
+        """
+        :param state:   As `update`
+        :return:        True if partitions are stored, and were built with `state`
+        """
+        return self._load_manifest()['state'] == self._state_hash(state)
+
+    def info(self):
+        """
+        :return: dict of the data stored with `update(info=...)`
+        """
+        return self._load_manifest().get('info', {})
+
+    def update(self, inputs, build, state=None, only=None, info=None):
+        """
+        Brings the stored partitions up to date with their inputs
+
+        :param inputs:  dict of partition key (tuple) : list of
+                        the `DataFrame`s the partition is built from
+        :param build:   Function of a partition's input frames returning
+                        the partition's `DataFrame`
+        :param state:   JSON serializable dict of anything else every
+                        partition depends on (i.e: a column list). If it
+                        changes, every partition is rebuilt
+        :param only:    If set, the keys of the only partitions to bring up
+                        to date, `inputs` holding just these (a key missing
+                        from it is removed). The other partitions are kept
+                        without their inputs being read or hashed, so
+                        `state` has to be current (see `is_current`)
+        :param info:    JSON serializable dict stored in the manifest (i.e:
+                        per partition statistics, see `info()`). It replaces
+                        the stored one, or with `only` updates it key by key
+        :return:        dict of partition key : `DataFrame` of the partitions
+                        in `inputs`
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        state = self._state_hash(state)
+
+        manifest = self._load_manifest()
+        if only is not None and manifest['state'] != state:
+            raise ValueError("Partitions of " + self.name + " were built with another state")
+        if manifest['state'] != state:
+            manifest = {'state': state, 'partitions': {}, 'info': {}}
+
+        if only is None:
+            manifest['info'] = info or {}
+        else:
+            manifest.setdefault('info', {}).update(info or {})
+
+        partitions = {}
+        rebuilt = 0
+
+        for key, frames in inputs.items():
+            partition = self._name(key)
+            digest = hash_frames(frames)
+
+            if manifest['partitions'].get(partition) == digest and os.path.isfile(self._file(partition)):
+                partitions[key] = pd.read_parquet(self._file(partition))
+                continue
+
+            df = build(*frames)
+            df.to_parquet(self._file(partition), index=False)
+            manifest['partitions'][partition] = digest
+            partitions[key] = df
+            rebuilt += 1
+
+        # Drop partitions whose inputs are gone
+        current = {self._name(key) for key in inputs}
+        candidates = manifest['partitions'] if only is None else [self._name(key) for key in only]
+        for partition in [p for p in candidates if p not in current and p in manifest['partitions']]:
+            if os.path.isfile(self._file(partition)):
+                os.remove(self._file(partition))
+            del manifest['partitions'][partition]
+
+        self._save_manifest(manifest)
+
+        print("[ INF ] Rebuilt", rebuilt, "of", len(inputs) if only is None else len(manifest['partitions']),
+              "partitions of", self.name)
+
+        return partitions
+
+    def read(self, keys=None):
+        """
+        :param keys:    Keys (tuples) of the partitions to read, or None for all.
+                        Keys with no stored partition are left out
+        :return:        dict of partition name : `DataFrame`, in name order
+        """
+        stored = self._load_manifest()['partitions']
+        names = sorted(stored) if keys is None else sorted(self._name(k) for k in keys if self._name(k) in stored)
+        return {name: pd.read_parquet(self._file(name)) for name in names}
+
+    def clear(self):
+        """
+        Removes every stored partition
+        :return: None
+        """
+        manifest = self._load_manifest()
+        for partition in manifest['partitions']:
+            if os.path.isfile(self._file(partition)):
+                os.remove(self._file(partition))
+        if os.path.isfile(self._manifest_path()):
+            os.remove(self._manifest_path())
+
+
+# Shared cache used by `fetch.py` and `merge.py`
+CACHE = ArtifactCache()
@@ -10,11 +10,15 @@
 # used in `merge.py` and `preprocess.py` to combine and
 # impute their values
 
+import json
 import os
 
 import numpy as np
 import pandas as pd
 
+from src.preprocessing.cache import CACHE, CACHE_BATCH_SIZE, hash_file
+from src.profiling import profiled
+
 #
 # Constants
 #
@@ -25,6 +29,61 @@ IRS_DATA_DIR = DATA_DIR + "irs/datasets/"
 NYC_OPEN_DATA_DIR = DATA_DIR + "nyc_open_data/datasets/"
 YAHOO_FINANCE = DATA_DIR + "yahoo_finance/"
 
+# Exported copy of the default restaurant inspection table
+RESTAURANT_INSPECTION_EXPORT = DATA_DIR + "rid.csv"
+
+# Stored running aggregates of the restaurant inspections
+AGGREGATE_DIR = DATA_DIR + "aggregates/"
+
+# Column types for the DOHMH Restaurant Inspection CSVs. These are fixed
+# up front so that every chunk of a streamed read (and the in-memory read)
+# agree on the types of the grouping keys
+RESTAURANT_INSPECTION_DTYPES = {
+    'CAMIS': 'int64',
+    'DBA': str,
+    'BORO': str,
+    'BUILDING': str,
+    'STREET': str,
+    'ZIPCODE': 'float64',
+    'PHONE': str,
+    'CUISINE DESCRIPTION': str,
+    'INSPECTION DATE': str,
+    'ACTION': str,
+    'VIOLATION CODE': str,
+    'VIOLATION DESCRIPTION': str,
+    'CRITICAL FLAG': str,
+    'SCORE': 'float64',
+    'GRADE': str,
+    'GRADE DATE': str,
+    'RECORD DATE': str,
+    'INSPECTION TYPE': str
+}
+
+# Default number of rows per chunk for streamed reads
+RESTAURANT_INSPECTION_CHUNKSIZE = 100000
+
+# Inspection dates are `mm/dd/yyyy`, without punctuation once normalized
+INSPECTION_DATE_FORMAT = '%m%d%Y'
+
+# Grades in ascending order of quality, mapped to their index plus 1
+# (i.e: an "A" is a 3). Anything else is a 0
+GRADE_LOOKUP = {'c': 1, 'b': 2, 'a': 3}
+
+# Dictionary of String : (is_closed, violation_count)
+# Missing or unknown actions are (False, 0)
+ACTION_LOOKUP = {
+    'violations were cited in the following areas': (False, 1),
+    'no violations were recorded at the time of this inspection': (False, 0),
+    'establishment closed by dohmh  violations were cited in the following areas and those requiring immediate action were addressed': (
+        True, 1),
+    'establishment reclosed by dohmh': (True, 1),
+    'establishment reopened by dohmh': (False, 0)
+}
+
+GRADE_LOOKUP_VALUES = np.array(list(GRADE_LOOKUP.values()), dtype='int64')
+ACTION_LOOKUP_IS_CLOSED = np.array([v[0] for v in ACTION_LOOKUP.values()], dtype='bool')
+ACTION_LOOKUP_VIOLATION_COUNT = np.array([v[1] for v in ACTION_LOOKUP.values()], dtype='int64')
+
 
 #
 # Helpers
@@ -47,7 +106,230 @@ def camel_case_cols(df):
 
 def remove_punctuation(df):
     df_obj = df.select_dtypes(['object'])
-    df[df_obj.columns] = df_obj.apply(lambda x: x.str.replace(r'[^\w\s]', ''))
+    df[df_obj.columns] = df_obj.apply(lambda x: x.str.replace(r'[^\w\s]', '', regex=True))
+    return df
+
+
+def _normalize_text_column(s):
+    # The string operations are run once per *distinct* value
+    # and broadcast back through the factorized codes
+    codes, uniques = pd.factorize(s)
+    if len(uniques) == 0:
+        return s
+
+    uniques = pd.Series(np.asarray(uniques, dtype=object))
+    uniques = uniques.str.strip().str.lower().str.replace(r'[^\w\s]', '', regex=True)
+
+    # Distinct raw values may collapse to the same normalized value
+    value_codes, values = pd.factorize(uniques)
+    codes = np.where(codes < 0, -1, value_codes[codes])
+
+    c = pd.Categorical.from_codes(codes, values)
+    return pd.Series(np.asarray(c, dtype=object), index=s.index, name=s.name)
+
+
+def normalize_text(df):
+    """
+    Fused replacement for `strip_strings`, `camel_case_cols` and
+    `remove_punctuation`. Column names are lower/snake cased, and every
+    string column is stripped, lower cased and stripped of punctuation
+    in a single pass over its distinct values.
+
+    :param df:  DataFrame
+    :return:    DataFrame
+    """
+    df = camel_case_cols(df)
+
+    for c in df.select_dtypes(['object', 'category']).columns:
+        df[c] = _normalize_text_column(df[c])
+
+    return df
+
+
+def lookup_codes(s, lookup, name, report_unknown=False):
+    """
+    Vectorized dictionary lookup. Returns, for every value in `s`,
+    the position of that value in the keys of `lookup`, or -1 if it
+    is missing or unknown. Appending a default to an array of the
+    lookup values and indexing it with these codes maps a whole column
+    at once.
+
+    :param s:               Series to encode
+    :param lookup:          dict whose keys are the known values
+    :param name:            Name of the column (for reporting)
+    :param report_unknown:  If True, non-null values missing from `lookup`
+                            are counted and printed
+    :return:                `ndarray` of int codes
+    """
+    codes = pd.Index(list(lookup.keys())).get_indexer(s)
+
+    if report_unknown:
+        unknown = (codes < 0) & s.notnull().values
+        if unknown.any():
+            counts = s[unknown].value_counts()
+            print("[ WRN ]", unknown.sum(), "rows with unknown", name, "values:")
+            for value, count in counts.items():
+                print("[ WRN ]    ", count, value)
+
+    return codes
+
+
+#
+# Snapshot Comparison
+#
+
+
+def _inspection_date_key(df):
+    # yyyymmdd as a number so dates compare and sort numerically
+    date = df['inspection_date']
+    return date.dt.year * 10000 + date.dt.month * 100 + date.dt.day
+
+
+def summarize_snapshot(df):
+    """
+    Reduces a cleaned restaurant inspection snapshot to one row
+    per CAMIS holding its first and last inspection dates (as
+    yyyymmdd integers) and whether its latest inspection closed it.
+    Summaries are small enough to be kept and compared against later
+    snapshots without re-reading the original file.
+
+    :param df:  Cleaned (ungrouped) restaurant inspection rows
+    :return:    `DataFrame` indexed by `camis`
+    """
+    s = pd.DataFrame({'camis': df['camis'].values,
+                      'date': _inspection_date_key(df).values,
+                      'is_closed': df['is_closed'].astype('bool').values})
+
+    s = s.sort_values(by='date', ascending=False, kind='mergesort')
+    g = s.groupby('camis', sort=True)
+
+    return pd.DataFrame({'first_date': g['date'].min(),
+                         'last_date': g['date'].max(),
+                         'is_closed': g['is_closed'].first()})
+
+
+def combine_snapshot_summaries(a, b):
+    """
+    Combines two summaries of consecutive pieces of the same snapshot
+    (i.e: chunks of one file), as if it were summarized in one pass.
+    On a date tie the latest closure status of `a` is kept.
+
+    :param a:   `DataFrame` from `summarize_snapshot`
+    :param b:   `DataFrame` from `summarize_snapshot`
+    :return:    `DataFrame` indexed by `camis`
+    """
+    s = pd.concat([a, b]).sort_values(by='last_date', ascending=False, kind='mergesort')
+    g = s.groupby(level=0, sort=True)
+
+    summary = pd.DataFrame({'first_date': g['first_date'].min(),
+                            'last_date': g['last_date'].max(),
+                            'is_closed': g['is_closed'].first()})
+    summary.index.name = 'camis'
+
+    return summary
+
+
+def diff_snapshots(old, new):
+    """
+    Compares two snapshot summaries with vectorized set operations.
+    Returns a dict of three `DataFrame`s, each with a `camis` and
+    `date` column:
+        closed:     In `old` but not `new`, dated by its last inspection in `old`
+        new:        In `new` but not `old`, dated by its first inspection in `new`
+        reopened:   Closed at its latest inspection in `old`, but open at its
+                    latest inspection in `new`, dated by that inspection
+
+    :param old: `DataFrame` from `summarize_snapshot` for the older snapshot
+    :param new: `DataFrame` from `summarize_snapshot` for the newer snapshot
+    :return:    dict of `DataFrame`
+    """
+    old_ids = old.index.values
+    new_ids = new.index.values
+
+    closed = old.loc[np.setdiff1d(old_ids, new_ids, assume_unique=True), 'last_date']
+    opened = new.loc[np.setdiff1d(new_ids, old_ids, assume_unique=True), 'first_date']
+
+    both = np.intersect1d(old_ids, new_ids, assume_unique=True)
+    reopened = old.loc[both, 'is_closed'].values & ~new.loc[both, 'is_closed'].values
+    reopened = new.loc[both[reopened], 'last_date']
+
+    def frame(dates):
+        return pd.DataFrame({'camis': dates.index.values, 'date': dates.values})
+
+    return {'closed': frame(closed),
+            'new': frame(opened),
+            'reopened': frame(reopened)}
+
+
+#
+# Dates
+#
+
+
+def period_key(date):
+    """
+    Monthly key of dates as a yyyymm integer (i.e: 201905), which sorts
+    in time order and joins as an integer. Missing dates are 0.
+
+    :param date:    datetime64 Series
+    :return:        int64 Series
+    """
+    return (date.dt.year * 100 + date.dt.month).fillna(0).astype('int64')
+
+
+def inspection_period(df):
+    """
+    The monthly key of a table, computed from its year and month
+    columns if it was exported before the key was added (i.e: a
+    fallback CSV, where they were read back as integers)
+
+    :param df:  DataFrame holding `inspection_period`, or
+                `inspection_year` and `inspection_month`
+    :return:    int64 Series
+    """
+    if 'inspection_period' in df.columns:
+        return df['inspection_period']
+
+    return (pd.to_numeric(df['inspection_year'], errors='coerce') * 100 +
+            pd.to_numeric(df['inspection_month'], errors='coerce')).fillna(0).astype('int64')
+
+
+def period_columns(period):
+    """
+    :param period:  yyyymm Series (see `period_key`)
+    :return:        (year, month) arrays of zero padded strings
+    """
+    return _date_part_strings(period // 100, 4), _date_part_strings(period % 100, 2)
+
+
+def _date_part_strings(part, width):
+    # Zero padded strings of date parts (NaN where missing),
+    # formatting each distinct value only once
+    codes, uniques = pd.factorize(part)
+    strings = np.array([str(int(u)).zfill(width) for u in uniques] + [np.nan], dtype=object)
+    return strings[codes]
+
+
+def parse_inspection_dates(df):
+    """
+    Parses the normalized `inspection_date` column once, in place, into
+    a datetime64 column, from which are derived:
+        inspection_period:  yyyymm monthly key (see `period_key`)
+        inspection_year:    zero padded strings, as in the exported tables
+        inspection_month
+        inspection_day
+
+    :param df:  DataFrame with a normalized `inspection_date` column
+    :return:    DataFrame
+    """
+    date = pd.to_datetime(df['inspection_date'], format=INSPECTION_DATE_FORMAT, errors='coerce')
+
+    df['inspection_date'] = date
+    df['inspection_year'] = _date_part_strings(date.dt.year, 4)
+    df['inspection_month'] = _date_part_strings(date.dt.month, 2)
+    df['inspection_day'] = _date_part_strings(date.dt.day, 2)
+    df['inspection_period'] = period_key(date)
+
     return df
 
 
@@ -56,31 +338,30 @@ def remove_punctuation(df):
 #
 
 
-def fetch_inspection_data(append_closure_col=True):
+@profiled()
+def fetch_inspection_data(append_closure_col=True, file_name=None):
     """
     This Dataset can be used to find HARD CLOSURES, those which
     are not able to even conduct an inspection.
     :param append_closure_col:
+    :param file_name:   CSV in the layout of `Inspections.csv` (i.e: new
+                        records), defaults to `Inspections.csv`
     :return:
     """
-    df = pd.read_csv(NYC_OPEN_DATA_DIR + "Inspections.csv")
+    df = pd.read_csv(file_name or NYC_OPEN_DATA_DIR + "Inspections.csv")
 
     # Initial clean
-    df = strip_strings(df)
-    df = camel_case_cols(df)
-    df = remove_punctuation(df)
+    df = normalize_text(df)
 
     # Filter by restaurants only
     industries = ['sidewalk cafe  013', 'gaming cafe  129', 'restaurant  818']
     df = df.loc[df['industry'].isin(industries)]
 
     # Fix date
-    df['inspection_year'] = df['inspection_date'].str[-4:]
-    df['inspection_month'] = df['inspection_date'].str[:2]
-    df['inspection_day'] = df['inspection_date'].str[2:4]
+    df = parse_inspection_dates(df)
 
     # Drop unneeded columns
-    drop_cols = ['industry', 'unit_type', 'unit', 'description', 'inspection_date']
+    drop_cols = ['industry', 'unit_type', 'unit', 'description']
     df = df.drop(drop_cols, 1)
 
     # Append closure column
@@ -98,117 +379,88 @@ def fetch_inspection_data(append_closure_col=True):
     # df = df.sort_values(by=['inspection_year', 'inspection_month', 'inspection_day'], ascending=True)
 
     if append_closure_col:
-        return df.sort_values(by=['inspection_year', 'inspection_month',
-                                  'inspection_day', 'is_closed'], ascending=False)
+        return df.sort_values(by=['inspection_date', 'is_closed'], ascending=False)
     else:
-        return df.sort_values(by=['inspection_year', 'inspection_month', 'inspection_day'], ascending=False)
+        return df.sort_values(by='inspection_date', ascending=False, kind='mergesort')
 
 
-def fetch_restaurant_inspection_data(include_violation_code=False, new_set=False, merged_set=True):
+def _clean_restaurant_inspection_data(df, include_violation_code=False):
     """
-    This Dataset can be used for finding SOFT CLOSURES: Those which are caused
-    by inspections.
-    :param include_violation_code:  If True, table will be grouped by violations
-                                    instead of by restaurant
-    :param new_set:                 If True, then a more recent set will be loaded
-                                    for comparison
-    :param merged_set:              If True, the new set and original will be merged
+    Cleans a raw frame (or chunk) of the DOHMH Restaurant Inspection
+    data set into one row per violation with the closure, violation
+    count, grade and date columns derived.
+
+    :param df:                      Raw DOHMH `DataFrame`
+    :param include_violation_code:  If True, the violation code column is kept
     :return:                        `DataFrame`
     """
 
-    if not include_violation_code and not new_set and merged_set:
-        if os.path.isfile("data/rid.csv"):
-            return pd.read_csv("data/rid.csv")
-
-    if merged_set and new_set:
-        print("[ ERR ] Invalid settings, merged_set and new_set cannot both be True")
-        return None
-
-    # Used for merged_set
-    closed = []
-
-    if new_set:
-        df = pd.read_csv(NYC_OPEN_DATA_DIR + 'DOHMH_New_York_City_Restaurant_Inspection_Results-new.csv')
-    elif merged_set:
-        df_new = pd.read_csv(NYC_OPEN_DATA_DIR + 'DOHMH_New_York_City_Restaurant_Inspection_Results-new.csv')
-        df = pd.read_csv(NYC_OPEN_DATA_DIR + 'DOHMH_New_York_City_Restaurant_Inspection_Results.csv')
-
-        # Find restaurants that have been removed (closed)
-        camis1 = list(df.CAMIS.unique())
-        camis2 = list(df_new.CAMIS.unique())
-        closed = [c for c in camis1 if c not in camis2]
-
-        df = pd.concat([df_new, df])
-    else:
-        df = pd.read_csv(NYC_OPEN_DATA_DIR + 'DOHMH_New_York_City_Restaurant_Inspection_Results.csv')
-
     # Initial clean
-    df = strip_strings(df)
-    df = camel_case_cols(df)
-    df = remove_punctuation(df)
+    df = normalize_text(df)
 
     # Clean grade column
 
-    # Grades in ascending order of quality
-    grades = ['c', 'b', 'a']
-
     # Map grades to index values plus 1 (i.e: an "A" is a 3)
-    df['grade'] = df['grade'].apply(lambda x: grades.index(x) + 1 if x in grades else 0)
-    df['grade'] = pd.to_numeric(df['grade'])
+    grade_codes = lookup_codes(df['grade'], GRADE_LOOKUP, 'grade')
+    df['grade'] = np.append(GRADE_LOOKUP_VALUES, 0)[grade_codes]
 
     # Categorize violation action by open or closed
     # and count violations
-
-    # Dictionary of String : (is_closed, violation_count)
-    action_lookup = {
-        'violations were cited in the following areas': (False, 1),
-        'no violations were recorded at the time of this inspection': (False, 0),
-        'establishment closed by dohmh  violations were cited in the following areas and those requiring immediate action were addressed': (
-            True, 1),
-        'establishment reclosed by dohmh': (True, 1),
-        'establishment reopened by dohmh': (False, 0),
-        np.nan: (False, 0)
-    }
-
-    # Apply action mapping
-    df['is_closed'] = df['action'].apply(lambda x: action_lookup[x][0])
+    action_codes = lookup_codes(df['action'], ACTION_LOOKUP, 'action', report_unknown=True)
+    df['is_closed'] = np.append(ACTION_LOOKUP_IS_CLOSED, False)[action_codes]
 
     # (Violation count is defined as the number of inspections which *resulted*
     # in a violation or closure)
-    df['violation_count'] = df['action'].apply(lambda x: action_lookup[x][1])
+    df['violation_count'] = np.append(ACTION_LOOKUP_VIOLATION_COUNT, 0)[action_codes]
 
     # Fix date
-    df['inspection_year'] = df['inspection_date'].str[-4:]
-    df['inspection_month'] = df['inspection_date'].str[:2]
-    df['inspection_day'] = df['inspection_date'].str[2:4]
+    df = parse_inspection_dates(df)
 
     # Fix critical flag
     df['critical_flag'] = np.where(df['critical_flag'] == 'critical', 1, 0)
     df['critical_flag'] = pd.to_numeric(df['critical_flag'])
 
     # Drop unneeded cols
-    drop_cols = ['action', 'violation_description', 'inspection_date',
+    drop_cols = ['action', 'violation_description',
                  'grade_date', 'record_date', 'inspection_type']
 
     if not include_violation_code:
         drop_cols.append('violation_code')
 
-    df = df.drop(drop_cols, 1)
+    df = df.drop(drop_cols, axis=1)
 
     # Rename columns for consistency
     df = df.rename(columns={'zipcode': 'zip'})
 
-    # Sort by date
-    df = df.sort_values(by=['inspection_year', 'inspection_month', 'inspection_day'], ascending=False)
-
-    # Group by identifiers
     df['total_inspections'] = 1
+
+    return df
+
+
+def _restaurant_inspection_ids(include_violation_code=False):
     ids = ['camis', 'dba', 'boro', 'building', 'street', 'zip', 'phone', 'cuisine_description']
 
     if include_violation_code:
         ids.append('violation_code')
 
-    g = df.groupby(ids, as_index=False)
+    return ids
+
+
+def _aggregate_restaurant_inspection_data(df, include_violation_code=False):
+    """
+    Groups cleaned inspection rows into one row per restaurant
+    (or per restaurant and violation code).
+
+    :param df:                      Output of `_clean_restaurant_inspection_data`
+    :param include_violation_code:  If True, group by violation code as well
+    :return:                        `DataFrame`
+    """
+
+    # Sort by date
+    df = df.sort_values(by='inspection_date', ascending=False, kind='mergesort')
+
+    # Group by identifiers
+    g = df.groupby(_restaurant_inspection_ids(include_violation_code), as_index=False)
 
     # The aggregation will occur as follows:
     #   is_closed: latest value by date
@@ -229,6 +481,289 @@ def fetch_restaurant_inspection_data(include_violation_code=False, new_set=False
     # Apply aggregations to most recent entries for restaurants
     g[list(agr.keys())] = ga[list(agr.keys())]
 
+    return g
+
+
+#
+# Running Aggregates
+#
+
+
+class RestaurantAggregateStore:
+    """
+    Running per restaurant aggregates of cleaned inspection rows:
+    sums, (sum, count) pairs for the means, and the latest row by
+    date. Rows are absorbed in order and only the restaurants they
+    touch are recombined, so the table can be kept current from
+    daily deltas. `frame()` is identical to cleaning and aggregating
+    every absorbed row at once, in the order they were absorbed.
+
+    A summary (see `summarize_snapshot`) is also kept for each named
+    snapshot the rows were absorbed into, as are the digests of the
+    delta files absorbed (see `update_restaurant_inspection_data`).
+    """
+
+    SUM_COLS = ['critical_flag', 'violation_count', 'total_inspections']
+    MEAN_COLS = ['score', 'grade']
+    DATE_COL = 'inspection_date'
+
+    def __init__(self, include_violation_code=False):
+        self.include_violation_code = include_violation_code
+        self.ids = _restaurant_inspection_ids(include_violation_code)
+
+        # One row per group, with the latest values and the running sums
+        self.state = None
+
+        # Snapshot name : summary
+        self.summaries = {}
+
+        # SHA-256 digests of the delta files absorbed
+        self.absorbed = []
+
+        # CAMIS of the restaurants changed by `absorb` since the store was
+        # created or loaded, and the periods (yyyymm) of their groups both
+        # before and after the change. Not stored
+        self.changed = set()
+        self.touched = set()
+
+    def schema(self):
+        """
+        The layout of the stored aggregates. A stored store with a
+        different schema cannot be updated and has to be rebuilt.
+
+        :return: dict
+        """
+        empty = pd.DataFrame({c: pd.Series(dtype=t) for c, t in RESTAURANT_INSPECTION_DTYPES.items()})
+        columns = _clean_restaurant_inspection_data(empty, self.include_violation_code).columns
+
+        # Grouping puts the identifiers first
+        return {'ids': self.ids,
+                'columns': self.ids + [str(c) for c in columns if c not in self.ids],
+                'sum': self.SUM_COLS,
+                'mean': self.MEAN_COLS,
+                'dtypes': {k: str(v) for k, v in RESTAURANT_INSPECTION_DTYPES.items()}}
+
+    def absorb(self, df, snapshot=None):
+        """
+        Folds cleaned inspection rows into the aggregates
+
+        :param df:          Output of `_clean_restaurant_inspection_data`
+        :param snapshot:    If set, the summary of this snapshot is updated too
+        :return:            None
+        """
+        if snapshot is not None:
+            summary = summarize_snapshot(df)
+            if snapshot in self.summaries:
+                summary = combine_snapshot_summaries(self.summaries[snapshot], summary)
+            self.summaries[snapshot] = summary
+
+        # Means are carried as (sum, count) pairs so they can be combined
+        df = df.assign(**{c + '_count': df[c].notnull().astype('int64') for c in self.MEAN_COLS})
+
+        self.changed.update(df['camis'].unique().tolist())
+
+        untouched = None
+        if self.state is not None:
+            affected = self.state['camis'].isin(df['camis'].unique())
+            untouched = self.state.loc[~affected]
+            self.touched.update(self.state.loc[affected, 'inspection_period'].unique().tolist())
+
+            # Stable sort keeps previously absorbed rows ahead on date ties,
+            # matching the in-memory sort over the concatenated frame
+            df = pd.concat([self.state.loc[affected], df], ignore_index=True, sort=False)
+
+        df = df.sort_values(by=self.DATE_COL, ascending=False, kind='mergesort')
+
+        g = df.groupby(self.ids, as_index=False)
+        sums = g.agg({c: np.sum for c in self.SUM_COLS + self.MEAN_COLS + [m + '_count' for m in self.MEAN_COLS]})
+        combined = g.first()
+        combined[list(sums.columns)] = sums
+        self.touched.update(combined['inspection_period'].unique().tolist())
+
+        if untouched is None:
+            self.state = combined
+        else:
+            self.state = pd.concat([untouched, combined], ignore_index=True, sort=False)
+
+    def absorb_file(self, file_name, snapshot=None, chunksize=RESTAURANT_INSPECTION_CHUNKSIZE):
+        """
+        Streams a DOHMH CSV into the aggregates `chunksize` rows at a time
+
+        :param file_name:   DOHMH CSV path
+        :param snapshot:    If set, the summary of this snapshot is updated too
+        :param chunksize:   Number of CSV rows per chunk
+        :return:            None
+        """
+        for chunk in pd.read_csv(file_name, dtype=RESTAURANT_INSPECTION_DTYPES, chunksize=chunksize):
+            self.absorb(_clean_restaurant_inspection_data(chunk, self.include_violation_code), snapshot)
+
+    def frame(self):
+        """
+        :return: `DataFrame` of one row per group, as from
+                 `_aggregate_restaurant_inspection_data`
+        """
+        # Groups in the (sorted) order `groupby` would give them
+        state = self.state.sort_values(by=self.ids, kind='mergesort').reset_index(drop=True)
+
+        for c in self.MEAN_COLS:
+            state[c] = state[c] / state[c + '_count'].replace(0, np.nan)
+
+        return state[self.schema()['columns']]
+
+    def save(self, path):
+        """
+        :param path:    Path of the store without extension
+        :return:        None
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.state.to_parquet(path + '.parquet', index=False)
+        for name, summary in self.summaries.items():
+            summary.to_parquet(path + '.%s.summary.parquet' % name)
+
+        # The metadata is written last, so its presence marks a complete store
+        with open(path + '.json', 'w') as f:
+            json.dump({'schema': self.schema(), 'snapshots': list(self.summaries), 'absorbed': self.absorbed}, f)
+
+    @classmethod
+    def load(cls, path, include_violation_code=False):
+        """
+        :param path:                    Path of the store without extension
+        :param include_violation_code:  If True, groups include the violation code
+        :return:                        `RestaurantAggregateStore`, or None if none
+                                        is stored or its schema has changed
+        """
+        if not os.path.isfile(path + '.json'):
+            return None
+
+        with open(path + '.json') as f:
+            meta = json.load(f)
+
+        store = cls(include_violation_code)
+        if meta['schema'] != store.schema():
+            print("[ INF ] Aggregate schema changed, rebuilding", path)
+            return None
+
+        store.state = pd.read_parquet(path + '.parquet')
+        store.summaries = {name: pd.read_parquet(path + '.%s.summary.parquet' % name)
+                           for name in meta['snapshots']}
+        store.absorbed = meta.get('absorbed', [])
+
+        return store
+
+
+def _stream_restaurant_inspection_data(file_names, include_violation_code=False,
+                                       chunksize=RESTAURANT_INSPECTION_CHUNKSIZE):
+    """
+    Streaming equivalent of cleaning and aggregating the concatenation
+    of `file_names`. Each file is read `chunksize` rows at a time and
+    folded into running per-restaurant sums, counts and latest-by-date
+    values, so memory is bounded by the number of restaurants rather
+    than by the number of inspection rows.
+
+    :param file_names:              DOHMH CSV paths, in concatenation order
+    :param include_violation_code:  If True, group by violation code as well
+    :param chunksize:               Number of CSV rows per chunk
+    :return:                        (`DataFrame`, list of snapshot summaries per file)
+    """
+    store = RestaurantAggregateStore(include_violation_code)
+
+    for i, file_name in enumerate(file_names):
+        store.absorb_file(file_name, i, chunksize)
+
+    return store.frame(), [store.summaries[i] for i in range(len(file_names))]
+
+
+def restaurant_inspection_files(new_set=False, merged_set=True):
+    """
+    :param new_set:     If True, only the more recent set is used
+    :param merged_set:  If True, the new set and original are used
+    :return:            List of DOHMH CSV paths, in concatenation order
+    """
+    new_file = NYC_OPEN_DATA_DIR + 'DOHMH_New_York_City_Restaurant_Inspection_Results-new.csv'
+    old_file = NYC_OPEN_DATA_DIR + 'DOHMH_New_York_City_Restaurant_Inspection_Results.csv'
+
+    if new_set:
+        return [new_file]
+    elif merged_set:
+        return [new_file, old_file]
+    else:
+        return [old_file]
+
+
+def _read_restaurant_inspection_data(file_names, include_violation_code=False, merged_set=True):
+    # Used for merged_set
+    closed = []
+
+    if merged_set:
+        df_new = pd.read_csv(file_names[0], dtype=RESTAURANT_INSPECTION_DTYPES)
+        df_new = _clean_restaurant_inspection_data(df_new, include_violation_code)
+
+        df = pd.read_csv(file_names[1], dtype=RESTAURANT_INSPECTION_DTYPES)
+        df = _clean_restaurant_inspection_data(df, include_violation_code)
+
+        # Find restaurants that have been removed (closed)
+        closed = diff_snapshots(summarize_snapshot(df), summarize_snapshot(df_new))['closed']['camis']
+
+        df = pd.concat([df_new, df])
+    else:
+        df = pd.read_csv(file_names[0], dtype=RESTAURANT_INSPECTION_DTYPES)
+        df = _clean_restaurant_inspection_data(df, include_violation_code)
+
+    return df, closed
+
+
+@profiled()
+def _build_restaurant_inspection_data(file_names, include_violation_code=False, merged_set=True, chunksize=None):
+    # Used for merged_set
+    closed = []
+
+    if chunksize:
+        g, summaries = _stream_restaurant_inspection_data(file_names, include_violation_code, chunksize)
+
+        if merged_set:
+            # Find restaurants that have been removed (closed)
+            closed = diff_snapshots(summaries[1], summaries[0])['closed']['camis']
+    else:
+        df, closed = _read_restaurant_inspection_data(file_names, include_violation_code, merged_set)
+        g = _aggregate_restaurant_inspection_data(df, include_violation_code)
+
+    return _finalize_restaurant_inspection_data(g, closed, merged_set)
+
+
+@profiled()
+def _build_restaurant_inspection_levels(file_names, merged_set=True, chunksize=None):
+    """
+    Builds the table both by violation code and by restaurant from
+    a single read and clean of the CSVs. The restaurant level is the
+    same cleaned rows, less the violation code.
+
+    :return: dict of include_violation_code : `DataFrame`
+    """
+    closed = []
+
+    if chunksize:
+        stores = {True: RestaurantAggregateStore(True), False: RestaurantAggregateStore(False)}
+
+        for i, file_name in enumerate(file_names):
+            for chunk in pd.read_csv(file_name, dtype=RESTAURANT_INSPECTION_DTYPES, chunksize=chunksize):
+                chunk = _clean_restaurant_inspection_data(chunk, include_violation_code=True)
+                stores[True].absorb(chunk, i)
+                stores[False].absorb(chunk.drop('violation_code', axis=1))
+
+        levels = {ivc: store.frame() for ivc, store in stores.items()}
+
+        if merged_set:
+            closed = diff_snapshots(stores[True].summaries[1], stores[True].summaries[0])['closed']['camis']
+    else:
+        df, closed = _read_restaurant_inspection_data(file_names, True, merged_set)
+        levels = {True: _aggregate_restaurant_inspection_data(df, True),
+                  False: _aggregate_restaurant_inspection_data(df.drop('violation_code', axis=1), False)}
+
+    return {ivc: _finalize_restaurant_inspection_data(g, closed, merged_set) for ivc, g in levels.items()}
+
+
+def _finalize_restaurant_inspection_data(g, closed, merged_set=True):
     # Make violation ratio
     g['violation_ratio'] = g['violation_count'] / g['total_inspections']
 
@@ -236,12 +771,226 @@ def fetch_restaurant_inspection_data(include_violation_code=False, new_set=False
     if merged_set:
         g['is_closed'] = np.where(g['camis'].isin(closed), 1, g['is_closed'])
 
-    final = g.sort_values(by=['inspection_year', 'inspection_month', 'inspection_day'], ascending=False)
+    return g.sort_values(by='inspection_date', ascending=False, kind='mergesort')
+
+
+@profiled()
+def fetch_restaurant_inspection_data(include_violation_code=False, new_set=False, merged_set=True,
+                                     chunksize=None, reload=False, columns=None):
+    """
+    This Dataset can be used for finding SOFT CLOSURES: Those which are caused
+    by inspections.
+    :param include_violation_code:  If True, table will be grouped by violations
+                                    instead of by restaurant
+    :param new_set:                 If True, then a more recent set will be loaded
+                                    for comparison
+    :param merged_set:              If True, the new set and original will be merged
+    :param chunksize:               If set, the CSVs are streamed in chunks of this
+                                    many rows and aggregated incrementally instead
+                                    of being loaded into memory whole
+    :param reload:                  Force a rebuild of the cached table
+    :param columns:                 If set, only these columns are read and returned
+    :return:                        `DataFrame`
+    """
+
+    if merged_set and new_set:
+        print("[ ERR ] Invalid settings, merged_set and new_set cannot both be True")
+        return None
+
+    file_names = restaurant_inspection_files(new_set, merged_set)
+
+    def build():
+        final = _build_restaurant_inspection_data(file_names, include_violation_code, merged_set, chunksize)
+        _export_restaurant_inspection_data(final, include_violation_code, new_set, merged_set)
+        return final
+
+    return _cached_restaurant_inspection_data(build, include_violation_code, new_set, merged_set, reload, columns)
+
+
+@profiled()
+def fetch_restaurant_inspection_levels(new_set=False, merged_set=True, chunksize=None, reload=False):
+    """
+    The restaurant inspection table both grouped by violations and by
+    restaurant, as from `fetch_restaurant_inspection_data` with and without
+    `include_violation_code`. On a miss, the raw CSVs are read and cleaned
+    once for both tables.
+
+    :param new_set:     If True, then a more recent set will be loaded
+    :param merged_set:  If True, the new set and original will be merged
+    :param chunksize:   If set, the CSVs are streamed in chunks of this many rows
+    :param reload:      Force a rebuild of the cached tables
+    :return:            (by violation `DataFrame`, by restaurant `DataFrame`)
+    """
+
+    if merged_set and new_set:
+        print("[ ERR ] Invalid settings, merged_set and new_set cannot both be True")
+        return None
+
+    file_names = restaurant_inspection_files(new_set, merged_set)
+
+    # Both levels are built together, on the first one needed
+    levels = {}
+
+    def build(include_violation_code):
+        if not levels:
+            levels.update(_build_restaurant_inspection_levels(file_names, merged_set, chunksize))
+            _export_restaurant_inspection_data(levels[False], False, new_set, merged_set)
+        return levels[include_violation_code]
+
+    return tuple(_cached_restaurant_inspection_data(lambda: build(ivc), ivc, new_set, merged_set, reload)
+                 for ivc in (True, False))
 
+
+def _export_restaurant_inspection_data(df, include_violation_code, new_set, merged_set):
+    # The default table is also exported to `RESTAURANT_INSPECTION_EXPORT`,
+    # which is used in place of the raw data when it is not present
     if not include_violation_code and not new_set and merged_set:
-        final.to_csv("data/rid.csv", index=False)
+        df.to_csv(RESTAURANT_INSPECTION_EXPORT, index=False)
+
+
+def _restaurant_inspection_cache_args(include_violation_code, new_set, merged_set):
+    # Inputs of the cached restaurant inspection table, as keyword arguments of `CACHE`
+    export = not include_violation_code and not new_set and merged_set
+
+    return dict(sources=restaurant_inspection_files(new_set, merged_set),
+                params={'include_violation_code': include_violation_code,
+                        'new_set': new_set,
+                        'merged_set': merged_set},
+                code=[__file__],
+                fallback=RESTAURANT_INSPECTION_EXPORT if export else None)
+
+
+def _cached_restaurant_inspection_data(build, include_violation_code, new_set, merged_set, reload=False,
+                                       columns=None):
+    return CACHE.cached('restaurant_inspections', build, reload=reload, columns=columns,
+                        **_restaurant_inspection_cache_args(include_violation_code, new_set, merged_set))
+
+
+def stream_restaurant_inspection_data(columns=None, batch_size=CACHE_BATCH_SIZE, new_set=False, merged_set=True):
+    """
+    The restaurant table of `fetch_restaurant_inspection_data`, read from
+    the cache in batches of rows rather than whole. If it is not cached,
+    it is first built by streaming the CSVs (see `chunksize`), so memory
+    is bounded by the number of restaurants and the batch size.
+
+    :param columns:     If set, only these columns are read
+    :param batch_size:  Number of rows per batch
+    :param new_set:     If True, then a more recent set will be loaded
+    :param merged_set:  If True, the new set and original will be merged
+    :return:            Iterator of `DataFrame`
+    """
+    args = _restaurant_inspection_cache_args(False, new_set, merged_set)
+
+    batches = CACHE.batches('restaurant_inspections', columns=columns, batch_size=batch_size, **args)
+    if batches is None:
+        fetch_restaurant_inspection_data(new_set=new_set, merged_set=merged_set,
+                                         chunksize=RESTAURANT_INSPECTION_CHUNKSIZE)
+        batches = CACHE.batches('restaurant_inspections', columns=columns, batch_size=batch_size, **args)
+
+    return batches
+
+
+def _update_restaurant_aggregates(delta_files, include_violation_code, chunksize):
+    # Loads the stored aggregates (building them from the full data
+    # sets if needed), absorbs the delta files and stores the result
+    path = AGGREGATE_DIR + 'restaurant_inspections' + ('_violations' if include_violation_code else '')
+
+    store = RestaurantAggregateStore.load(path, include_violation_code)
+    if store is None:
+        new_file, old_file = restaurant_inspection_files()
+
+        print("[ INF ] Building running aggregates")
+        store = RestaurantAggregateStore(include_violation_code)
+        store.absorb_file(new_file, 'new', chunksize)
+        store.absorb_file(old_file, 'old', chunksize)
 
-    return final
+    for file_name in delta_files:
+        digest = hash_file(file_name)
+        if digest in store.absorbed:
+            print("[ WRN ] Already absorbed", file_name, "- skipping")
+            continue
+
+        print("[ INF ] Absorbing", file_name)
+        store.absorb_file(file_name, 'new', chunksize)
+        store.absorbed.append(digest)
+
+    store.save(path)
+
+    return store
+
+
+def _finalize_restaurant_aggregates(store):
+    closed = diff_snapshots(store.summaries['old'], store.summaries['new'])['closed']['camis']
+    return _finalize_restaurant_inspection_data(store.frame(), closed)
+
+
+@profiled()
+def update_restaurant_inspection_data(delta_files, include_violation_code=False,
+                                      chunksize=RESTAURANT_INSPECTION_CHUNKSIZE):
+    """
+    Absorbs new inspection rows (DOHMH CSVs in the same layout, i.e: a
+    day's export) into the stored running aggregates of the merged set,
+    recomputing only the restaurants they touch. The new rows are treated
+    as part of the more recent snapshot when finding closures.
+
+    The store is built from the full data sets on first use, and rebuilt
+    only if its schema has changed. A delta file whose contents were
+    already absorbed is skipped, so an update can be safely repeated.
+
+    :param delta_files:             Paths of the new inspection CSVs
+    :param include_violation_code:  If True, table will be grouped by violations
+                                    instead of by restaurant
+    :param chunksize:               Number of CSV rows per chunk
+    :return:                        `DataFrame`, as from `fetch_restaurant_inspection_data`
+    """
+    store = _update_restaurant_aggregates(delta_files, include_violation_code, chunksize)
+    return _finalize_restaurant_aggregates(store)
+
+
+@profiled()
+def update_restaurant_inspection_levels(delta_files, chunksize=RESTAURANT_INSPECTION_CHUNKSIZE):
+    """
+    As `update_restaurant_inspection_data`, for the tables both by
+    violation code and by restaurant (see `fetch_restaurant_inspection_levels`)
+
+    :param delta_files: Paths of the new inspection CSVs
+    :param chunksize:   Number of CSV rows per chunk
+    :return:            (dict of include_violation_code : `DataFrame`, set of the
+                        CAMIS of the restaurants which changed, set of the periods
+                        (yyyymm) of their rows before and after the update)
+    """
+    levels = {}
+    changed = set()
+    touched = set()
+
+    for ivc in (True, False):
+        store = _update_restaurant_aggregates(delta_files, ivc, chunksize)
+        levels[ivc] = _finalize_restaurant_aggregates(store)
+        changed |= store.changed
+        touched |= store.touched
+
+    return levels, changed, touched
+
+
+def fetch_restaurant_snapshot_summary(new_set=False, chunksize=RESTAURANT_INSPECTION_CHUNKSIZE):
+    """
+    Summarizes one DOHMH Restaurant Inspection snapshot for use
+    with `diff_snapshots`. The file is streamed in chunks.
+
+    :param new_set:     If True, the more recent snapshot is summarized
+    :param chunksize:   Number of CSV rows per chunk
+    :return:            `DataFrame` indexed by `camis`
+    """
+    file_name = restaurant_inspection_files(new_set, merged_set=False)[0]
+
+    summary = None
+    for chunk in pd.read_csv(file_name, dtype=RESTAURANT_INSPECTION_DTYPES, chunksize=chunksize):
+        chunk = _clean_restaurant_inspection_data(chunk)
+
+        chunk_summary = summarize_snapshot(chunk)
+        summary = chunk_summary if summary is None else combine_snapshot_summaries(summary, chunk_summary)
+
+    return summary
 
 
 def fetch_restaurant_violation_lookup_table(refresh=False):
@@ -258,20 +1007,18 @@ def fetch_legally_operating_businesses():
     df = pd.read_csv(NYC_OPEN_DATA_DIR + 'Legally_Operating_Businesses.csv')
 
     # Initial clean
-    df = strip_strings(df)
-    df = camel_case_cols(df)
-    df = remove_punctuation(df)
+    df = normalize_text(df)
 
     return df
 
 
+@profiled()
 def fetch_alternative_agi_returns(as_percents=True):
-    df = pd.read_csv(IRS_DATA_DIR + "AGI-Returns.csv")
+    df = pd.read_csv(IRS_DATA_DIR + "AGI-Returns.csv",
+                     dtype={'Size of adjusted gross income': str})
 
     # Initial clean
-    df = strip_strings(df)
-    df = camel_case_cols(df)
-    df = remove_punctuation(df)
+    df = normalize_text(df)
 
     # Filter out non-NYC zip codes for faster processing
     df = df.loc[df['zip'] < 11500]
@@ -306,13 +1053,12 @@ def fetch_alternative_agi_returns(as_percents=True):
     return df
 
 
+@profiled()
 def fetch_alternative_demographic_stats_data():
     df = pd.read_csv(NYC_OPEN_DATA_DIR + "Demographic_Statistics_By_Zip_Code.csv")
 
     # Initial clean
-    df = strip_strings(df)
-    df = camel_case_cols(df)
-    df = remove_punctuation(df)
+    df = normalize_text(df)
 
     df = df.rename(columns={'jurisdiction_name': 'zip'})
 
@@ -330,25 +1076,25 @@ def fetch_alternative_demographic_stats_data():
     return df
 
 
+@profiled()
 def fetch_alternative_financial_data():
-    dji = pd.read_csv(YAHOO_FINANCE + "^DJI.csv")
-    vix = pd.read_csv(YAHOO_FINANCE + "^VIX.csv")
-
-    dji = dji[['Date', 'Adj Close']]
-    vix = vix[['Date', 'Adj Close']]
+    dji = pd.read_csv(YAHOO_FINANCE + "^DJI.csv", usecols=['Date', 'Adj Close'])
+    vix = pd.read_csv(YAHOO_FINANCE + "^VIX.csv", usecols=['Date', 'Adj Close'])
 
     dji = dji.rename(columns={'Adj Close': 'dji_close'})
     vix = vix.rename(columns={'Adj Close': 'vix_close'})
 
     df = dji.merge(vix)
 
-    df['year'] = df['Date'].apply(lambda x: x.split('-')[0])
-    df['month'] = df['Date'].apply(lambda x: x.split('-')[1])
+    date = pd.to_datetime(df['Date'], format='%Y-%m-%d')
+    df['year'] = _date_part_strings(date.dt.year, 4)
+    df['month'] = _date_part_strings(date.dt.month, 2)
+    df['period'] = period_key(date)
 
-    df = df.drop('Date', 1)
+    df = df.drop('Date', axis=1)
 
-    df = df.groupby(['year', 'month'], as_index=False).mean()
-    df = df.sort_values(by=['year', 'month'])
+    df = df.groupby(['year', 'month', 'period'], as_index=False).mean()
+    df = df.sort_values(by='period')
 
     df['dji_sma_5'] = df['dji_close'].rolling(window=5).mean()
     df['vix_sma_5'] = df['vix_close'].rolling(window=5).mean()
@@ -356,8 +1102,6 @@ def fetch_alternative_financial_data():
     df = df.fillna(0)
 
     # Initial clean
-    df = strip_strings(df)
-    df = camel_case_cols(df)
-    df = remove_punctuation(df)
+    df = normalize_text(df)
 
     return df
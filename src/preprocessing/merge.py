@@ -9,11 +9,20 @@
 # are merged together into larger files. For data matrix
 # creation, see `preprocessing.py`
 
-import os
+from collections import Counter
+from functools import partial
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
 import src.preprocessing.fetch as fetch
+import src.preprocessing.pipeline as pipeline
+import src.preprocessing.transform as transform
+from src.preprocessing.cache import PartitionedTable, hash_file, hash_frames
+from src.preprocessing.pipeline import Stage, run_stages
+from src.preprocessing.transform import sparse_group_sum, sparse_one_hot
+from src.profiling import profiled
 
 #
 # Constants
@@ -22,67 +31,224 @@ import src.preprocessing.fetch as fetch
 
 MERGED_FILE_PATH = fetch.DATA_DIR + 'merged/'
 
+# Raw files each merged table is built from
+INSPECTION_SOURCES = [fetch.NYC_OPEN_DATA_DIR + "Inspections.csv"]
+
+CLOSURE_SOURCES = fetch.restaurant_inspection_files() + INSPECTION_SOURCES
+
+ECONOMIC_SOURCES = [fetch.YAHOO_FINANCE + "^DJI.csv",
+                    fetch.YAHOO_FINANCE + "^VIX.csv"]
+
+DEMOGRAPHIC_SOURCES = [fetch.IRS_DATA_DIR + "AGI-Returns.csv",
+                       fetch.NYC_OPEN_DATA_DIR + "Demographic_Statistics_By_Zip_Code.csv"]
+
+MASTER_SOURCES = CLOSURE_SOURCES + ECONOMIC_SOURCES + DEMOGRAPHIC_SOURCES
+
+# The merged tables are grouped by these integer keys (the yyyymm month,
+# see `fetch.period_key`, and the zip) and stored partitioned by month
+GROUP_KEYS = ['inspection_period', 'zip']
+PARTITION_KEYS = ['inspection_period']
+
+# Integer MultiIndex the grouped tables are joined on
+INDEX_KEYS = ['zip', 'inspection_period']
+
+# Columns of the inspection records merged into the closures
+INSPECTION_COLUMNS = ['inspection_period', 'zip', 'reason', 'is_closed']
+
 
 #
 # Helper Functions
 #
 
 
-def _total_restaurant_closure(restaurant_dataset):
-    r = restaurant_dataset[['is_closed', 'inspection_year', 'inspection_month', 'zip']]
-    r = r.loc[r['is_closed'] != 0]
-    return r.groupby(['inspection_year', 'inspection_month', 'zip'], as_index=False).count()
+def _violation_counts(restaurant_dataset):
+    """
+    :param restaurant_dataset:  Restaurant inspections including violation codes
+    :return:                    dict of 'closed' / 'open' : dict of violation
+                                code : number of rows
+    """
+    r = restaurant_dataset[['is_closed', 'violation_code']]
+    closed = r['is_closed'] != 0
+
+    return {'closed': {str(k): int(n) for k, n in r.loc[closed, 'violation_code'].value_counts().items()},
+            'open': {str(k): int(n) for k, n in r.loc[~closed, 'violation_code'].value_counts().items()}}
+
+
+def _monthly_violation_counts(restaurant_dataset):
+    """
+    :param restaurant_dataset:  Restaurant inspections including violation codes
+    :return:                    dict of period (as string, 0 where undated) :
+                                `_violation_counts` of that month's rows
+    """
+    return {str(k): _violation_counts(g) for k, g in restaurant_dataset.groupby('inspection_period', sort=True)}
+
+
+def _closed_rows(restaurant_dataset):
+    # Only closed restaurants are counted in the closures table
+    return restaurant_dataset.loc[restaurant_dataset['is_closed'] != 0]
+
+
+def _monthly_closed_camis(*frames):
+    """
+    :param frames:  Closed restaurant rows (see `_closed_rows`)
+    :return:        dict of period (as string) : sorted CAMIS of the closed
+                    restaurants with rows in that month
+    """
+    r = pd.concat([df[['inspection_period', 'camis']] for df in frames], ignore_index=True)
+    return {str(k): sorted(int(c) for c in g.unique()) for k, g in r.groupby('inspection_period')['camis']}
+
+
+def _top_violations(counts):
+    """
+    List of violations to pivot on. This list is generated from using the
+    top 15 violations from closed and not-closed restaurants and taking
+    only the values which do not appear in the non-closed set. Ties are
+    broken by the violation code.
 
+    :param counts:  List of `_violation_counts` (i.e: one per month), summed
+    :return:        List of violation column names
+    """
+    total = {'closed': Counter(), 'open': Counter()}
+    for c in counts:
+        for k in total:
+            total[k].update(c[k])
 
-def _violation_distribution_table(restaurant_dataset):
-    r = restaurant_dataset[['is_closed', 'inspection_year',
-                            'inspection_month', 'zip', 'violation_code']]
+    def top(c):
+        return [code for code, _ in sorted(c.items(), key=lambda i: (-i[1], i[0]))[:15]]
 
-    # r['is_closed'] = r['is_closed'].astype('bool')
+    open_codes = top(total['open'])
+    return ["violation_" + c for c in top(total['closed']) if c not in open_codes]
 
-    # First, generate a list of violations to pivot on
-    # This list is generated from using the top 15 violations from closed and not-closed
-    # restaurants and taking only the values which do not appear in the non-closed set
-    l1 = r.loc[r['is_closed'] != 0]['violation_code'].value_counts(sort=True)[:15]
-    l2 = r.loc[r['is_closed'] == 0]['violation_code'].value_counts(sort=True)[:15]
-    violations = ["violation_" + c for c in l1.index if c not in l2.index]
 
-    # Pivot Violations
-    dummies = pd.get_dummies(r['violation_code'], prefix='violation')
-    dummies = dummies[violations]
-    r = r.join(dummies).drop('violation_code', 1)
+def _closure_violations(restaurant_dataset):
+    """
+    :param restaurant_dataset:  Restaurant inspections including violation codes
+    :return:                    List of violation column names (see `_top_violations`)
+    """
+    return _top_violations([_violation_counts(restaurant_dataset)])
 
-    r = r.loc[r['is_closed'] != 0].drop('is_closed', 1)
 
-    return r.groupby(['inspection_year', 'inspection_month', 'zip'], as_index=False).sum()
+def _restaurant_closure_table(by_violation, by_restaurant, violations=None):
+    """
+    Counts of closed restaurants, and of their violations and cuisines, per
+    (year, month, zip), in one grouped aggregation over the closed rows of
+    both granularities. Only groups with both closed restaurants and closed
+    violation rows are kept.
+
+    :param by_violation:    Restaurant inspections grouped by violation code
+    :param by_restaurant:   Restaurant inspections grouped by restaurant
+    :param violations:      Violation columns to pivot on, chosen from these
+                            rows if not given (i.e: given when only one month
+                            of the data is passed)
+    :return:                DataFrame of GROUP_KEYS, `is_closed`, violation_*
+                            and cuisine_* counts
+    """
+    if violations is None:
+        violations = _closure_violations(by_violation)
+
+    v = by_violation.loc[by_violation['is_closed'] != 0]
+    r = by_restaurant.loc[by_restaurant['is_closed'] != 0]
 
+    # One-hot violations and cuisines as sparse matrices, then sum them
+    # per group along with the row counts of each granularity
+    v_x, _ = sparse_one_hot(v['violation_code'], categories=[c[len('violation_'):] for c in violations],
+                            dtype='int64')
+    r_x, cuisines = sparse_one_hot(r['cuisine_description'], prefix='cuisine', dtype='int64')
 
-def _cuisine_distribution_table(restaurant_dataset):
-    r = restaurant_dataset[['is_closed', 'inspection_year',
-                            'inspection_month', 'zip', 'cuisine_description']]
+    x = sp.bmat([[sp.csr_matrix(np.ones((len(v), 1), 'int64')), None, v_x, None],
+                 [None, sp.csr_matrix(np.ones((len(r), 1), 'int64')), None, r_x]], format='csr')
 
-    r = r.loc[r['is_closed'] != 0].drop('is_closed', 1)
+    keys = pd.concat([v[GROUP_KEYS], r[GROUP_KEYS]], ignore_index=True)
+    g = sparse_group_sum(keys, x, ['_violation_rows', 'is_closed'] + violations + cuisines)
+    g = g.loc[(g['_violation_rows'] > 0) & (g['is_closed'] > 0)]
 
-    r = r.join(pd.get_dummies(r['cuisine_description'],
-                              prefix='cuisine')).drop('cuisine_description', 1)
+    return g.drop('_violation_rows', axis=1).reset_index(drop=True)
 
-    return r.groupby(['inspection_year', 'inspection_month', 'zip'], as_index=False).sum()
 
+def _inspection_rows(file_name=None):
+    i = fetch.fetch_inspection_data(file_name=file_name)
+    return i[INSPECTION_COLUMNS]
 
-def _inspection_table():
-    i = fetch.fetch_inspection_data()
-    i = i[['inspection_year', 'inspection_month',
-           'zip', 'reason', 'is_closed']]
+
+def _inspection_table(inspections=None):
+    i = _inspection_rows() if inspections is None else inspections
 
     # i = i.loc[i['is_closed'] == 1].drop('is_closed', 1)
-    i = i.join(pd.get_dummies(i['reason'], prefix='reason')).drop('reason', 1)
-    i = i.groupby(['inspection_year', 'inspection_month', 'zip'], as_index=False).sum()
+    reasons, cols = sparse_one_hot(i['reason'], prefix='reason', dtype='int64')
+    x = sp.hstack([sp.csr_matrix(i[['is_closed']].values.astype('int64')), reasons], format='csr')
+    i = sparse_group_sum(i[GROUP_KEYS], x, ['is_closed'] + cols)
 
     i = i.rename(columns={'is_closed': 'total_closures'})
 
-    print(i['total_closures'].sum())
+    # A single month may have no 'na' reasons at all
+    return i.drop('reason_na', axis=1, errors='ignore')
+
+
+def _key_index(df):
+    """
+    Indexes a table grouped by GROUP_KEYS on its integer (zip, period)
+    keys, so it can be joined index to index. Grouping has dropped any
+    missing zip, so the float zips of the raw data convert exactly.
+
+    :param df:  DataFrame holding INDEX_KEYS
+    :return:    DataFrame
+    """
+    return df.astype({k: 'int64' for k in INDEX_KEYS}).set_index(INDEX_KEYS)
+
+
+def _month_partitions(*frames):
+    """
+    Splits DataFrames by month
+
+    :param frames:  DataFrames holding `PARTITION_KEYS`
+    :return:        dict of (period,) : list of each frame's rows in
+                    that month (empty where a frame has none)
+    """
+    groups = [{k if isinstance(k, tuple) else (k,): g for k, g in df.groupby(PARTITION_KEYS, sort=False)}
+              for df in frames]
+
+    # Rows without an inspection date (a period of 0) are left out,
+    # as they would be by grouping on the date
+    keys = sorted(k for k in set().union(*groups) if k != (0,))
 
-    return i.drop('reason_na', 1)
+    return {k: [g[k] if k in g else df.iloc[:0] for g, df in zip(groups, frames)] for k in keys}
+
+
+def _code():
+    # Every module whose code produces the merged tables, so an
+    # edit to any of them is a cache miss
+    return [__file__, fetch.__file__, transform.__file__, pipeline.__file__]
+
+
+def _code_hashes():
+    # Stored with the partitioned tables: a code change rebuilds every partition
+    return [hash_file(c) for c in _code()]
+
+
+def _stages(reload=False):
+    """
+    The stages the merged tables are built in. The four sources
+    are independent, so a cold build runs them concurrently.
+
+    :param reload:  Force a rebuild of the restaurant inspection tables
+    :return:        List of `Stage`
+    """
+    code = _code()
+
+    return [Stage('restaurant_inspections', partial(fetch.fetch_restaurant_inspection_levels, reload=reload),
+                  [], None),
+            Stage('inspections', _inspection_rows, [],
+                  {'sources': INSPECTION_SOURCES, 'code': code}),
+            Stage('economic', economic_data, [],
+                  {'sources': ECONOMIC_SOURCES, 'code': code}),
+            Stage('demographic', demographic_data, [],
+                  {'sources': DEMOGRAPHIC_SOURCES, 'code': code}),
+            Stage('closures', partial(_closure_data, MERGED_FILE_PATH + "closures.csv", reload),
+                  ['restaurant_inspections', 'inspections'],
+                  {'sources': CLOSURE_SOURCES, 'code': code, 'fallback': MERGED_FILE_PATH + "closures.csv"}),
+            Stage('master', partial(_master, MERGED_FILE_PATH + "master.csv", reload),
+                  ['closures', 'economic', 'demographic'],
+                  {'sources': MASTER_SOURCES, 'code': code, 'fallback': MERGED_FILE_PATH + "master.csv"})]
 
 
 #
@@ -90,7 +256,8 @@ def _inspection_table():
 #
 
 
-def closure_data(reload=False):
+@profiled()
+def closure_data(reload=False, columns=None, n_jobs=None):
     """
     The closure dataset is a merging of the Inspection
     and Restaurant inspection datasets. This is done
@@ -103,33 +270,62 @@ def closure_data(reload=False):
                         based on soft closures
         reason_*:       Total occurrences of closure reasons
 
-    :param reload:  Force rewrite of cached CSV file
+    :param reload:  Force rebuild of the cached table
+    :param columns: If set, only these columns are read and returned
+    :param n_jobs:  Number of processes building the sources (see `run_stages`)
 
     :return:        DataFrame
     """
-    file_name = MERGED_FILE_PATH + "closures.csv"
+    return run_stages(_stages(reload), ['closures'], reload, n_jobs, {'closures': columns})['closures']
+
+
+def _closure_data(file_name, reload, levels, inspections):
+    # Both granularities come from a single parse of the raw data
+    r1, r2 = levels
 
-    if not reload and os.path.isfile(file_name):
-        return pd.read_csv(file_name)
+    table = PartitionedTable('closures')
+    rows = PartitionedTable('inspection_rows')
+    if reload:
+        table.clear()
+        rows.clear()
 
-    r1 = fetch.fetch_restaurant_inspection_data(include_violation_code=True)
-    r2 = fetch.fetch_restaurant_inspection_data()
+    # Only the per month merges are skipped for unchanged months here, as
+    # every month's inputs are hashed. `update_merged_data` refreshes the
+    # tables from new rows without reading the other months
+    c1, c2 = _closed_rows(r1), _closed_rows(r2)
+    inputs = _month_partitions(c1, c2, inspections)
 
-    r_closures = _total_restaurant_closure(r2)
-    r_violations = _violation_distribution_table(r1)
-    r_cuisines = _cuisine_distribution_table(r2)
+    # For those refreshes, the inspection rows of each month are kept, as
+    # are each month's violation counts and closed restaurants
+    rows.update({k: v[2:] for k, v in inputs.items()}, lambda i: i, state={'code': _code_hashes()})
 
-    r_merged_monthly = pd.merge(r_closures, r_violations,
-                                on=['inspection_year', 'inspection_month', 'zip'])
+    counts = _monthly_violation_counts(r1)
+    violations = _top_violations(counts.values())
 
-    r_merged_monthly = pd.merge(r_merged_monthly, r_cuisines,
-                                on=['inspection_year', 'inspection_month', 'zip'])
+    partitions = table.update(inputs,
+                              lambda p1, p2, i: _closure_partition(p1, p2, i, violations),
+                              state={'violations': violations, 'code': _code_hashes()},
+                              info={'violation_counts': counts, 'closed_camis': _monthly_closed_camis(c1, c2)})
 
-    inspections = _inspection_table()
+    return _closure_table(file_name, partitions.values(), violations)
 
-    full = pd.merge(r_merged_monthly, inspections,
-                    on=['inspection_year', 'inspection_month', 'zip'],
-                    how='outer')
+
+def _closure_table(file_name, partitions, violations):
+    """
+    Makes the closures table from its month partitions
+
+    :param file_name:   Path the table is exported to
+    :param partitions:  `DataFrame`s of `_closure_partition`
+    :param violations:  Violation columns pivoted on
+    :return:            DataFrame
+    """
+    full = pd.concat(partitions, ignore_index=True, sort=False)
+
+    # Months may lack some cuisines or reasons, so restore
+    # the column order of a single, unpartitioned merge
+    cuisines = sorted(c for c in full.columns if c.startswith('cuisine_'))
+    reasons = sorted(c for c in full.columns if c.startswith('reason_'))
+    full = full[GROUP_KEYS + ['is_closed'] + violations + cuisines + ['total_closures'] + reasons]
 
     # Make violation and cuisine columns percent distributions based upon
     # the soft closures from the restaurant inspections. Then, this number
@@ -147,29 +343,46 @@ def closure_data(reload=False):
 
     full = full.fillna(0)
     full['total_closures'] = full['total_closures'] + full['is_closed']
-    full = full.drop('is_closed', 1)
-    full = full.sort_values(['inspection_year', 'inspection_month', 'zip'], ascending=False)
+    full = full.drop('is_closed', axis=1)
+    full = full.sort_values(GROUP_KEYS, ascending=False)
 
-    full = fetch.strip_strings(full)
-    full = fetch.camel_case_cols(full)
-    full = fetch.remove_punctuation(full)
+    # Year and month columns as in the restaurant inspection tables
+    year, month = fetch.period_columns(full['inspection_period'])
+    full.insert(1, 'inspection_year', year)
+    full.insert(2, 'inspection_month', month)
+
+    full = fetch.normalize_text(full)
 
     full.to_csv(file_name, index=False)
 
     return full
 
 
+@profiled()
+def _closure_partition(by_violation, by_restaurant, inspections, violations):
+    # Counts and pivots of a single month, before
+    # they are made into distributions
+    r_merged_monthly = _key_index(_restaurant_closure_table(by_violation, by_restaurant, violations))
+    i = _key_index(_inspection_table(inspections))
+
+    return r_merged_monthly.join(i, how='outer', validate='one_to_one').reset_index()
+
+
 # Merged set of demographic information by zip
 # code. Each cell represents a percent of the whole
 # for that row
+@profiled()
 def demographic_data():
     taxes = fetch.fetch_alternative_agi_returns()
     demo = fetch.fetch_alternative_demographic_stats_data()
 
-    return taxes.merge(demo)
+    # One row per zip on both sides, joined on integer zips
+    taxes['zip'] = taxes['zip'].astype('int64')
+    return taxes.merge(demo, on='zip', validate='one_to_one')
 
 
 # Economic data with SMA/EMA per day
+@profiled()
 def economic_data():
     # This is the same as the financial data in
     # fetch.py for now
@@ -184,21 +397,194 @@ def economic_data():
 
 
 # Entirely merged table where possible
-def master(reload=False):
-    file_name = MERGED_FILE_PATH + "master.csv"
-    if not reload and os.path.isfile(file_name):
-        return pd.read_csv(file_name)
-
-    c = closure_data(reload)
-    e = economic_data()
-    d = demographic_data()
-    m = pd.merge(c,
-                 e,
-                 left_on=['inspection_month', 'inspection_year'],
-                 right_on=['month', 'year'],
-                 how='left')
-
-    m2 = pd.merge(m, d, on='zip', how='inner')
+@profiled()
+def master(reload=False, columns=None, n_jobs=None):
+    return run_stages(_stages(reload), ['master'], reload, n_jobs, {'master': columns})['master']
+
+
+def _master(file_name, reload, c, e, d):
+    # Economic data joins on the month, so it is split with the closures;
+    # demographics join on the zip alone, so a change rebuilds every month
+    e = e.rename(columns={'period': 'inspection_period'})
+    partitions = _month_partitions(c, e)
+    partitions = {k: v for k, v in partitions.items() if len(v[0])}
+
+    table = PartitionedTable('master')
+    if reload:
+        table.clear()
+
+    state = {'demographics': hash_frames([d]), 'code': _code_hashes()}
+    d = d.set_index('zip')
+
+    partitions = table.update(partitions,
+                              lambda cp, ep: _master_partition(cp, ep, d),
+                              state=state)
+
+    return _master_table(file_name, partitions.values(), c, e, d)
+
+
+def _master_table(file_name, partitions, c, e, d):
+    """
+    Makes the master table from its month partitions
+
+    :param file_name:   Path the table is exported to
+    :param partitions:  `DataFrame`s of `_master_partition`
+    :param c:           The closures table
+    :param e:           The economic data, by `inspection_period`
+    :param d:           The demographic data, indexed by zip
+    :return:            DataFrame
+    """
+    m2 = pd.concat(partitions, ignore_index=True, sort=False)
+
+    # Months rebuilt before a cuisine, violation or reason first appeared
+    # lack its column, which is 0 in the closures table
+    m2 = m2.reindex(columns=list(c.columns) + [x for x in e.columns if x != 'inspection_period'] + list(d.columns))
+    pivots = [x for x in c.columns if x.startswith(('violation_', 'cuisine_', 'reason_'))]
+    m2[pivots] = m2[pivots].fillna(0)
+
+    # Restore the row order of a single merge, where the inner join groups
+    # rows by zip in order of first appearance (months are descending)
+    zips = pd.Index(c['zip'].unique())
+    m2 = m2.assign(_zip=zips.get_indexer(m2['zip']))
+    m2 = m2.sort_values(['_zip', 'inspection_period'], ascending=[True, False])
+    m2 = m2.drop('_zip', axis=1).reset_index(drop=True)
+
     m2.to_csv(file_name, index=False)
 
-    return m2.drop(['year', 'month'], 1)
+    return m2
+
+
+#
+# Refresh From New Rows
+#
+
+
+@profiled()
+def update_merged_data(delta_files, inspection_files=(), chunksize=fetch.RESTAURANT_INSPECTION_CHUNKSIZE):
+    """
+    Refreshes the merged tables from new rows: DOHMH CSVs (i.e: a month's
+    export), absorbed into the running restaurant aggregates (see
+    `fetch.update_restaurant_inspection_levels`), and new records in the
+    layout of `Inspections.csv`. Only the month partitions these rows
+    touch are rebuilt: the months of the new inspection records, and the
+    months the closed rows of the updated restaurants are in, before and
+    after the update. The other months' inputs are neither read nor hashed;
+    their violation counts and closed restaurants are kept in the manifest.
+
+    Every month is rebuilt when the pivoted violations, the demographics or
+    the code change, or when the tables were never partitioned. A file whose
+    contents were already absorbed is skipped. `closure_data` and `master`
+    are still built from the source files alone.
+
+    :param delta_files:         Paths of the new DOHMH CSVs
+    :param inspection_files:    Paths of the new inspection record CSVs
+    :param chunksize:           Number of CSV rows per chunk
+    :return:                    (closures `DataFrame`, master `DataFrame`)
+    """
+    levels, changed, touched = fetch.update_restaurant_inspection_levels(delta_files, chunksize)
+    r1, r2 = levels[True], levels[False]
+    c1, c2 = _closed_rows(r1), _closed_rows(r2)
+
+    rows = PartitionedTable('inspection_rows')
+    rows_state = {'code': _code_hashes()}
+    absorbed = rows.info().get('absorbed', [])
+
+    new = []
+    for file_name in inspection_files:
+        digest = hash_file(file_name)
+        if digest in absorbed:
+            print("[ WRN ] Already absorbed", file_name, "- skipping")
+            continue
+        new.append(_inspection_rows(file_name))
+        absorbed.append(digest)
+
+    #
+    # Closures
+    #
+
+    table = PartitionedTable('closures')
+    info = table.info()
+    incremental = 'violation_counts' in info and rows.is_current(rows_state)
+
+    # Violations are chosen from the counts of every month: those stored
+    # for the months of no changed rows, recounted for the others
+    if incremental:
+        counts = {p: c for p, c in info['violation_counts'].items() if int(p) not in touched}
+        counts.update(_monthly_violation_counts(r1.loc[r1['inspection_period'].isin(touched)]))
+    else:
+        counts = _monthly_violation_counts(r1)
+
+    violations = _top_violations(counts.values())
+    state = {'violations': violations, 'code': _code_hashes()}
+    incremental = incremental and table.is_current(state)
+
+    if incremental:
+        before = {int(p) for p, camis in info['closed_camis'].items() if not changed.isdisjoint(camis)}
+        after = set(pd.concat([c1.loc[c1['camis'].isin(changed), 'inspection_period'],
+                               c2.loc[c2['camis'].isin(changed), 'inspection_period']]).tolist())
+        months = before | after | {p for i in new for p in i['inspection_period'].unique().tolist()}
+        months = [(p,) for p in sorted(months) if p != 0]
+
+        c1 = c1.loc[c1['inspection_period'].isin([k[0] for k in months])]
+        c2 = c2.loc[c2['inspection_period'].isin([k[0] for k in months])]
+        inspections = list(rows.read(months).values()) + new
+
+        closed = {p: camis for p, camis in info['closed_camis'].items() if (int(p),) not in months}
+        closed.update(_monthly_closed_camis(c1, c2))
+    else:
+        print("[ INF ] Rebuilding every month of the merged tables")
+        months = None
+        inspections = (list(rows.read().values()) if rows.is_current(rows_state) else [_inspection_rows()]) + new
+        closed = _monthly_closed_camis(c1, c2)
+
+    inspections = pd.concat(inspections, ignore_index=True, sort=False) if inspections else \
+        pd.DataFrame(columns=INSPECTION_COLUMNS)
+
+    inputs = _month_partitions(c1, c2, inspections)
+    if months is not None:
+        inputs = {k: v for k, v in inputs.items() if k in months}
+
+    rows.update({k: v[2:] for k, v in inputs.items()}, lambda i: i, state=rows_state, only=months,
+                info={'absorbed': absorbed})
+    table.update(inputs,
+                 lambda p1, p2, i: _closure_partition(p1, p2, i, violations),
+                 state=state, only=months, info={'violation_counts': counts, 'closed_camis': closed})
+
+    c = _closure_table(MERGED_FILE_PATH + "closures.csv", table.read().values(), violations)
+
+    #
+    # Master
+    #
+
+    sources = run_stages(_stages(), ['economic', 'demographic'])
+    e = sources['economic'].rename(columns={'period': 'inspection_period'})
+    d = sources['demographic']
+
+    table = PartitionedTable('master')
+    state = {'demographics': hash_frames([d]), 'code': _code_hashes()}
+    if months is not None and not table.is_current(state):
+        months = None
+
+    if months is not None:
+        periods = [k[0] for k in months]
+        inputs = _month_partitions(c.loc[c['inspection_period'].isin(periods)],
+                                   e.loc[e['inspection_period'].isin(periods)])
+    else:
+        inputs = _month_partitions(c, e)
+    inputs = {k: v for k, v in inputs.items() if len(v[0])}
+
+    d = d.set_index('zip')
+    table.update(inputs,
+                 lambda cp, ep: _master_partition(cp, ep, d),
+                 state=state, only=months)
+
+    return c, _master_table(MERGED_FILE_PATH + "master.csv", table.read().values(), c, e, d)
+
+
+@profiled()
+def _master_partition(c, e, d):
+    # Each (zip, month) row of the closures takes its month's economic
+    # row and its zip's demographics, joined on the integer indexes
+    m = c.join(e.set_index('inspection_period'), on='inspection_period', how='left', validate='many_to_one')
+
+    return m.join(d, on='zip', how='inner', validate='many_to_one').reset_index(drop=True)
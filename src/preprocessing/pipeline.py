@@ -0,0 +1,153 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# pipeline.py
+#
+# Runs the fetch / merge stages as a graph. Stages whose inputs
+# are ready run concurrently in a process pool, each stage's output
+# is cached, and a cached stage skips the stages it depends on.
+#
+
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import src.profiling as profiling
+from src.preprocessing.cache import CACHE, project
+
+#
+# Stages
+#
+
+# name:     Name of the stage (and of its cached table)
+# func:     Function building the output from the outputs of `deps`, in order
+# deps:     Names of the stages it depends on
+# cache:    dict of `ArtifactCache.lookup` arguments (sources, params, code,
+#           fallback), or None if the output is not cached by the pipeline
+Stage = namedtuple('Stage', ['name', 'func', 'deps', 'cache'])
+
+
+def _run_stage(stage, inputs):
+    """
+    Builds (and caches) the output of a stage. Ran in the worker
+    processes, so the output is returned with its start and end times.
+
+    :param stage:   `Stage`
+    :param inputs:  Outputs of `stage.deps`
+    :return:        (output, start time, end time)
+    """
+    start = time.time()
+
+    with profiling.stage('pipeline.' + stage.name) as s:
+        output = s.output(stage.func(*inputs))
+    if stage.cache is not None:
+        CACHE.put(CACHE.key(stage.name, stage.cache.get('sources', ()), stage.cache.get('params'),
+                            stage.cache.get('code', ())), output)
+
+    return output, start, time.time()
+
+
+def _lookup(stage, reload, columns=None):
+    if stage.cache is None:
+        return None
+    return CACHE.lookup(stage.name, reload=reload, columns=columns, **stage.cache)
+
+
+def _resolve(stages, targets, reload, columns):
+    """
+    Probes the cache from the targets down to the stages that have
+    to be built (a cached stage does not need its dependencies)
+
+    :return:    (dict of cached outputs, list of stage names to build
+                in dependency order)
+    """
+    outputs = {}
+    needed = []
+
+    def visit(name):
+        if name in outputs or name in needed:
+            return
+
+        stage = stages[name]
+        output = _lookup(stage, reload, columns.get(name))
+        if output is not None:
+            outputs[name] = output
+            return
+
+        for d in stage.deps:
+            visit(d)
+        needed.append(name)
+
+    for t in targets:
+        visit(t)
+
+    return outputs, needed
+
+
+def run_stages(stages, targets, reload=False, n_jobs=None, columns=None):
+    """
+    Builds the target stages and the stages they depend on. Stages
+    are submitted to a process pool as soon as their dependencies are
+    built, so independent sources are read at the same time. A stage
+    that is the only one able to run is built in this process instead,
+    saving the copy of its inputs and output between processes.
+
+    :param stages:  List of `Stage`
+    :param targets: Names of the stages to return
+    :param reload:  Force a rebuild of every stage
+    :param n_jobs:  Number of worker processes (1 builds every stage
+                    in this process, None uses one per CPU)
+    :param columns: dict of stage name : columns to return of it (a list,
+                    or a function of a column name, see `cache.project`)
+    :return:        dict of target name : output
+    """
+    stages = {s.name: s for s in stages}
+    columns = columns or {}
+
+    start = time.time()
+    outputs, needed = _resolve(stages, targets, reload, columns)
+    timings = {name: None for name in outputs}
+
+    def ready():
+        return [n for n in needed if n not in outputs and n not in running.values()
+                and all(d in outputs for d in stages[n].deps)]
+
+    def run_inline(name):
+        stage = stages[name]
+        outputs[name], s, e = _run_stage(stage, [outputs[d] for d in stage.deps])
+        timings[name] = (s, e)
+
+    running = {}
+    if n_jobs == 1 or len(needed) < 2:
+        for name in needed:
+            run_inline(name)
+    else:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            while running or ready():
+                waiting = ready()
+
+                if len(waiting) == 1 and not running:
+                    run_inline(waiting[0])
+                    continue
+
+                for name in waiting:
+                    stage = stages[name]
+                    running[pool.submit(_run_stage, stage, [outputs[d] for d in stage.deps])] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    name = running.pop(f)
+                    outputs[name], s, e = f.result()
+                    timings[name] = (s, e)
+
+    print("[ INF ] Pipeline stages:")
+    for name, t in timings.items():
+        if t is None:
+            print("        %-24s %18s" % (name, "cached"))
+        else:
+            print("        %-24s +%7.2fs %8.2fs" % (name, t[0] - start, t[1] - t[0]))
+    print("        %-24s %18.2fs" % ("total", time.time() - start))
+
+    return {t: outputs[t][project(columns[t], outputs[t].columns)] if columns.get(t) and timings[t] is not None
+            else outputs[t] for t in targets}
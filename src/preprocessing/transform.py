@@ -8,38 +8,415 @@
 # and other numerical preparations for data matrices
 #
 
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import MinMaxScaler, StandardScaler
+from sklearn.utils import check_random_state
+
+from src.preprocessing.fetch import inspection_period
+from src.profiling import profiled
+
+#
+# Constants
+#
+
+MATRIX_DIR = "data/matrices/"
+
+# Negative (majority class) rows kept per positive row when downsampling
+NEGATIVE_RATIO = 3
+
+# A design matrix materialized on disk: `x` and `y` are read-only memory
+# maps with the rows stored in split order, so `x[:n_train]` is the training
+# set and `x[n_train:]` the test set, both without copying. A frame with
+# sparse (one-hot) columns is stored as CSR, and `x` is then a `csr_matrix`
+# over memory mapped arrays. `w` holds the sample weights of the rows in
+# the same order, or is None when the rows are not weighted
+DesignMatrix = namedtuple('DesignMatrix', ['path', 'x', 'y', 'columns', 'y_col', 'n_train', 'w'])
 
 
 #
 # Split
 #
 
-def split_train_test(df, y, split_size=0.2):
+@profiled()
+def split_train_test(df, y, split_size=0.2, time=None):
     """
     Performs preprocessing on the master dataset
     and splits it into training and test sets, treating
-    it as time series data.
+    it as time series data: the latest periods are the
+    test set (see `time_split`).
 
     :param df:          The master dataset
     :param y:           Column to predict on
     :param split_size:  Percent of data to use for testing
+    :param time:        Inspection periods of the rows (see `time_split`),
+                        defaults to the `inspection_year` and
+                        `inspection_month` columns of `df`
     :return:            X/Y, Train/Test Sets
     """
     if split_size <= 0:
-        return df.drop(y, 1), df[y], None, None
+        return df.drop(y, axis=1), df[y], None, None
+
+    train, test = time_split(df if time is None else time, split_size)
 
     y_set = df[y]
-    x_set = df.drop(y, 1)
+    x_set = df.drop(y, axis=1)
+
+    return x_set.iloc[train], x_set.iloc[test], y_set.iloc[train], y_set.iloc[test]
+
+
+def _periods(time):
+    # Periods as yyyymm integers, 0 where the inspection date is missing.
+    # The year and month columns of a frame are strings when parsed from
+    # the raw data (see `inspection_period`)
+    if isinstance(time, pd.DataFrame):
+        return inspection_period(time).values
+    return np.nan_to_num(np.asarray(time, dtype='float64')).astype('int64')
+
+
+def time_split(time, split_size=0.2):
+    """
+    Splits rows by time: the test set is the latest periods, holding
+    about `split_size` of the rows. A period is never split between
+    the sets.
+
+    :param time:        DataFrame with `inspection_year` and `inspection_month`,
+                        or an array of yyyymm periods, one per row
+    :param split_size:  Fraction of the rows to use for testing
+    :return:            (train positions, test positions), sorted. Rows
+                        without a date are in neither
+    """
+    periods = _periods(time)
+    dated = periods > 0
+
+    n_test = int(round(dated.sum() * split_size))
+    if n_test == 0:
+        return np.flatnonzero(dated), np.arange(0)
+
+    # The period of the first test row, rows sorted by time
+    cutoff = np.sort(periods[dated], kind='mergesort')[dated.sum() - n_test]
+    test = periods >= cutoff
+
+    return np.flatnonzero(dated & ~test), np.flatnonzero(test)
+
+
+def rolling_time_splits(time, n_splits=3, test_periods=1, train_periods=None):
+    """
+    Rolling origin splits for time series validation: each split tests
+    on the `test_periods` periods following the training periods, and
+    the last split ends on the latest period
+
+    :param time:            DataFrame with `inspection_year` and `inspection_month`,
+                            or an array of yyyymm periods, one per row
+    :param n_splits:        Number of splits
+    :param test_periods:    Number of periods tested per split
+    :param train_periods:   Number of periods trained on per split, or
+                            None for every earlier period
+    :return:                Iterator of (train positions, test positions).
+                            Rows without a date are in neither
+    """
+    periods = _periods(time)
+    unique = np.unique(periods[periods > 0])
+
+    if len(unique) < n_splits * test_periods + 1:
+        raise ValueError("Too few periods for %d splits of %d: %d" % (n_splits, test_periods, len(unique)))
+
+    for i in range(n_splits, 0, -1):
+        end = len(unique) - (i - 1) * test_periods
+        start = end - test_periods
+        first = 0 if train_periods is None else max(0, start - train_periods)
+
+        train = (periods >= unique[first]) & (periods < unique[start])
+        test = (periods >= unique[start]) & (periods <= unique[end - 1])
+
+        yield np.flatnonzero(train), np.flatnonzero(test)
+
+
+def stratified_split(y, split_size=0.2, random_state=42):
+    """
+    Splits rows at random, holding out the same fraction of each class
+
+    :param y:               Labels, one per row
+    :param split_size:      Fraction of the rows to use for testing
+    :param random_state:    Seed or `RandomState`
+    :return:                (train positions, test positions), sorted
+    """
+    rng = check_random_state(random_state)
+    y = np.asarray(y)
+    test = np.zeros(len(y), dtype='bool')
+
+    for c in np.unique(y):
+        rows = np.flatnonzero(y == c)
+        test[rng.choice(rows, int(round(len(rows) * split_size)), replace=False)] = True
+
+    return np.flatnonzero(~test), np.flatnonzero(test)
+
+
+def random_split(n, split_size=0.2, random_state=42):
+    """
+    :param n:               Number of rows
+    :param split_size:      Fraction of the rows to use for testing
+    :param random_state:    Seed
+    :return:                (train positions, test positions), shuffled
+    """
+    return tuple(train_test_split(np.arange(n), train_size=1 - split_size, random_state=random_state))
+
+#
+# Sparse Encoding
+#
+
+def sparse_one_hot(s, prefix=None, categories=None, dtype='uint8'):
+    """
+    One-hot encodes a column as a CSR matrix, with the columns of
+    `pd.get_dummies` (sorted categories, missing values all zero)
+
+    :param s:           Series of categories
+    :param prefix:      Column name prefix, joined with '_'
+    :param categories:  If set, encode only these categories, in this order
+    :param dtype:       dtype of the matrix
+    :return:            (`csr_matrix`, list of column names)
+    """
+    if categories is None:
+        codes, categories = pd.factorize(s, sort=True)
+    else:
+        codes = pd.Index(categories).get_indexer(s)
+
+    rows = np.flatnonzero(codes >= 0)
+    x = sp.csr_matrix((np.ones(len(rows), dtype=dtype), (rows, codes[rows])),
+                      shape=(len(s), len(categories)))
+
+    columns = [str(c) if prefix is None else prefix + '_' + str(c) for c in categories]
+    return x, columns
+
+
+@profiled()
+def sparse_dummies(s, prefix=None, categories=None):
+    """
+    `pd.get_dummies` with sparse uint8 columns, which store only
+    the ones and can be joined to a frame like dense dummies
+
+    :param s:           Series of categories
+    :param prefix:      Column name prefix, joined with '_'
+    :param categories:  If set, encode only these categories, in this order
+    :return:            DataFrame of `SparseDtype` columns, on the index of `s`
+    """
+    x, columns = sparse_one_hot(s, prefix, categories)
+    return pd.DataFrame.sparse.from_spmatrix(x, index=s.index, columns=columns)
+
+
+def sparse_group_sum(keys, x, columns):
+    """
+    Sums the rows of a sparse matrix per group, as `groupby(keys).sum()`
+    would (groups sorted, rows with a missing key dropped), by multiplying
+    with a sparse group indicator matrix
+
+    :param keys:    DataFrame of the grouping columns, one row per row of `x`
+    :param x:       Sparse matrix
+    :param columns: Column names of `x`
+    :return:        DataFrame of the group keys followed by the sums,
+                    as dense columns
+    """
+    cols = list(keys.columns)
+    groups = keys.groupby(cols, sort=True).ngroup().values
+    rows = np.flatnonzero(groups >= 0)
+
+    n_groups = groups.max() + 1 if len(rows) else 0
+    indicator = sp.csr_matrix((np.ones(len(rows), dtype='int64'), (groups[rows], rows)),
+                              shape=(n_groups, len(keys)))
+
+    g = keys.groupby(cols, as_index=False).size().drop('size', axis=1)
+
+    # Only the sums are densified: a row per group rather than per input
+    # row, and far denser than the one-hot input. Every caller stores them
+    # in Parquet partitions or exports them to CSV, neither of which keeps
+    # a sparse dtype, and divides and fills them first (see `merge.py`)
+    sums = pd.DataFrame((indicator @ x).toarray(), columns=columns)
+
+    return pd.concat([g, sums], axis=1)
+
+
+def sparse_columns(df):
+    """
+    :param df:  DataFrame
+    :return:    List of the columns of `df` with a `SparseDtype`
+    """
+    return [c for c, t in df.dtypes.items() if isinstance(t, pd.SparseDtype)]
+
+
+#
+# Design Matrices
+#
+
+def frame_hash(df):
+    """
+    Hash of the values, column names and dtypes of a DataFrame
+
+    :param df:  DataFrame
+    :return:    Hex digest as string
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([str(c) for c in df.columns]).encode())
+    h.update(json.dumps([str(t) for t in df.dtypes]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+@profiled()
+def materialize_design_matrix(df, y, split_size=0.2, matrix_dir=MATRIX_DIR, split=None, weights=None):
+    """
+    Writes the X columns of `df` (missing values as 0) to a contiguous
+    float32 `.npy` file, `y` to a second file and the column index to a
+    JSON sidecar. The rows are written in the order of the train / test
+    split, training rows first. Matrices are keyed by the hash of `df`
+    and the split, so an unchanged frame is only written once and every
+    process loading it shares the same pages.
+
+    :param df:          DataFrame
+    :param y:           Name of Y col as string
+    :param split_size:  Percent of data to use for testing
+    :param matrix_dir:  Directory of the materialized matrices
+    :param split:       (train positions, test positions), i.e: from
+                        `time_split` or `stratified_split`. Defaults to
+                        a `random_split` of `split_size`
+    :param weights:     Sample weights, one per row of `df` (i.e: from
+                        `negative_downsample`), or None
+    :return:            `DesignMatrix`
+    """
+    h = hashlib.sha256((frame_hash(df) + y + str(split_size)).encode())
+    if split is not None:
+        for positions in split:
+            h.update(np.ascontiguousarray(positions, dtype='int64').tobytes())
+            h.update(b'|')
+    if weights is not None:
+        h.update(b'w')
+        h.update(np.ascontiguousarray(weights, dtype='float64').tobytes())
+    key = h.hexdigest()[:16]
+    path = os.path.join(matrix_dir, key)
+
+    # The sidecar is written last, so its presence marks a complete matrix
+    if os.path.isfile(path + '.json'):
+        return load_design_matrix(path)
+
+    os.makedirs(matrix_dir, exist_ok=True)
+
+    cols = [c for c in df.columns if c != y]
+    order = np.arange(len(df))
+    n_train = len(df)
+
+    if split is None and split_size > 0:
+        split = random_split(len(df), split_size)
+    if split is not None:
+        order = np.concatenate(split)
+        n_train = len(split[0])
+
+    meta = {'columns': cols, 'y': y, 'n_train': n_train}
+
+    if sparse_columns(df[cols]):
+        # Stored as the three arrays of a CSR matrix
+        dense = [c for c in cols if c not in sparse_columns(df[cols])]
+        x = df[cols].fillna({c: 0 for c in dense}).astype(pd.SparseDtype('float32', 0))
+        x = x.sparse.to_coo().tocsr()[order]
+        x.sort_indices()
+
+        np.save(path + '.data.npy', x.data)
+        np.save(path + '.indices.npy', x.indices)
+        np.save(path + '.indptr.npy', x.indptr)
+        meta['sparse'] = True
+        meta['shape'] = list(x.shape)
+    else:
+        x = np.lib.format.open_memmap(path + '.x.npy', mode='w+', dtype='float32', shape=(len(df), len(cols)))
+        for i, c in enumerate(cols):
+            x[:, i] = df[c].fillna(0).values[order]
+        x.flush()
+    del x
+
+    np.save(path + '.y.npy', df[y].fillna(0).values[order])
+    if weights is not None:
+        np.save(path + '.w.npy', np.asarray(weights, dtype='float64')[order])
+        meta['weighted'] = True
+
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f)
+
+    return load_design_matrix(path)
+
+
+def load_design_matrix(path):
+    """
+    Memory maps a matrix written by `materialize_design_matrix`
+
+    :param path:    Path of the matrix without extension
+    :return:        `DesignMatrix`
+    """
+    with open(path + '.json') as f:
+        meta = json.load(f)
+
+    if meta.get('sparse'):
+        x = sp.csr_matrix((np.load(path + '.data.npy', mmap_mode='r'),
+                           np.load(path + '.indices.npy', mmap_mode='r'),
+                           np.load(path + '.indptr.npy', mmap_mode='r')),
+                          shape=tuple(meta['shape']), copy=False)
+    else:
+        x = np.load(path + '.x.npy', mmap_mode='r')
+
+    return DesignMatrix(path=path,
+                        x=x,
+                        y=np.load(path + '.y.npy', mmap_mode='r'),
+                        columns=meta['columns'],
+                        y_col=meta['y'],
+                        n_train=meta['n_train'],
+                        w=np.load(path + '.w.npy', mmap_mode='r') if meta.get('weighted') else None)
 
-    return train_test_split(x_set, y_set, train_size=1 - split_size, random_state=42)
 
 #
 # Resampling
 #
 
+def negative_downsample(y, ratio=NEGATIVE_RATIO, keep_rate=None, random_state=42, return_weights=False):
+    """
+    Keeps every positive row and a sample of the negative ones. With
+    `return_weights`, each kept negative row is weighted by the inverse
+    of the rate negatives were kept at, so an estimator fit with these
+    sample weights sees the original class prior
+
+    :param y:               Binary labels, one per row
+    :param ratio:           Negative rows kept per positive row
+    :param keep_rate:       If set, each negative row is kept with this
+                            probability instead (i.e: a rate from the counts
+                            of a whole table, when `y` is one batch of it)
+    :param random_state:    Seed or `RandomState`
+    :param return_weights:  If True, the weights of the kept rows are returned too
+    :return:                Sorted positions kept, and their float64 sample
+                            weights if `return_weights`
+    """
+    rng = check_random_state(random_state)
+    y = np.asarray(y)
+
+    keep = y != 0
+    negatives = np.flatnonzero(~keep)
+
+    if keep_rate is None:
+        n = min(len(negatives), ratio * int(keep.sum()))
+        keep_rate = n / max(len(negatives), 1)
+        keep[negatives[rng.choice(len(negatives), n, replace=False)]] = True
+    else:
+        keep[negatives[rng.random_sample(len(negatives)) < keep_rate]] = True
+
+    positions = np.flatnonzero(keep)
+    if not return_weights:
+        return positions
+
+    weights = np.where(y[positions] != 0, 1.0, 1.0 / keep_rate) if keep_rate > 0 else np.ones(len(positions))
+    return positions, weights
+
+
 # def selective_master_downsample(master):
 #     """
 #     Selectively downsample sparse data
@@ -68,17 +445,32 @@ def normalize_values(df, y):
     return pd.DataFrame(StandardScaler().fit_transform(df.drop(y, 1)), columns=cols), df[y]
 
 
-def min_max_scale_values(df, y):
+@profiled()
+def min_max_scale_values(df, y, return_scaler=False):
     """
-    Min/Max scale columns of values in DataFrame
+    Min/Max scale columns of values in DataFrame. Sparse (one-hot)
+    columns are already within [0, 1] and are passed through as is,
+    so they stay sparse; the scaler is fit on the dense columns only.
 
-    :param df:  DataFrame
-    :param y:   Name of Y col as string
-    :return:    DataFrame
+    :param df:              DataFrame
+    :param y:               Name of Y col as string
+    :param return_scaler:   If True, the fitted `MinMaxScaler` is
+                            also returned (last)
+    :return:                DataFrame
     """
-    if y:
-        cols = df.drop(y, 1).columns
-        return pd.DataFrame(MinMaxScaler().fit_transform(df.drop(y, 1)), columns=cols), df[y]
-    else:
-        cols = df.columns
-        return pd.DataFrame(MinMaxScaler().fit_transform(df), columns=cols)
+    scaler = MinMaxScaler()
+
+    x = df.drop(y, axis=1) if y else df
+    cols = x.columns
+    sparse = sparse_columns(x)
+    dense = [c for c in cols if c not in sparse]
+
+    scaled = pd.DataFrame(scaler.fit_transform(x[dense]), columns=dense)
+    if sparse:
+        scaled = pd.concat([scaled, x[sparse].reset_index(drop=True)], axis=1)[cols]
+
+    result = (scaled, df[y]) if y else scaled
+
+    if return_scaler:
+        return result + (scaler,) if y else (result, scaler)
+    return result
@@ -0,0 +1,298 @@
+#
+# Cole Smith
+# Restaurant Closure Engine
+# BDS - Undergraduate
+# profiling.py
+#
+# Opt-in timing of the pipeline stages. Each stage records its wall
+# time, CPU time, peak RSS and the rows / columns of its output to a
+# JSON lines trace, which can be compared between runs with:
+#
+#   python -m src.profiling <old trace> <new trace>
+#
+# Profiling is enabled with the `PROFILE_TRACE` environment variable
+# (the trace path), or `enable()`. The stages named in `PROFILE_STAGES`
+# (comma separated) are also ran under cProfile.
+#
+
+import atexit
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Windows: peak RSS is not recorded
+    resource = None
+
+#
+# Constants
+#
+
+TRACE_DIR = "data/traces/"
+
+# Number of functions printed from a stage's cProfile statistics
+CPROFILE_LINES = 25
+
+_trace_file = None
+_cprofile = set()
+_profiles = {}
+_local = threading.local()
+
+
+#
+# Setup
+#
+
+def enable(trace_file=None, cprofile=()):
+    """
+    Starts recording stages to a trace
+
+    :param trace_file:  Path of the JSON lines trace, defaults to a
+                        timestamped file in `TRACE_DIR`
+    :param cprofile:    Names of the stages to also run under cProfile
+    :return:            Path of the trace
+    """
+    global _trace_file, _cprofile
+
+    _trace_file = trace_file or TRACE_DIR + time.strftime("%Y%m%d-%H%M%S") + ".jsonl"
+    _cprofile = set(cprofile)
+
+    # Worker processes started later (pipeline stages, `fit_many`)
+    # record to the same trace
+    os.environ['PROFILE_TRACE'] = _trace_file
+    os.environ['PROFILE_STAGES'] = ','.join(sorted(_cprofile))
+
+    os.makedirs(os.path.dirname(_trace_file) or '.', exist_ok=True)
+    _write({'event': 'run', 'argv': sys.argv, 'time': time.time()})
+
+    print("[ INF ] Profiling to", _trace_file)
+    return _trace_file
+
+
+def enabled():
+    return _trace_file is not None
+
+
+def _write(record):
+    # One line per record, appended in a single write, so
+    # processes can record to the same trace concurrently
+    record['pid'] = os.getpid()
+    with open(_trace_file, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+
+    # Kilobytes on Linux, bytes on macOS
+    unit = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+
+
+def _shape(output):
+    """
+    :param output:  A stage's output
+    :return:        (rows, columns) of the output, or of the first
+                    element holding a shape of a tuple or dict (i.e:
+                    a `DesignMatrix`), or (None, None)
+    """
+    if isinstance(output, dict):
+        output = tuple(output.values())
+    if isinstance(output, (tuple, list)) and not hasattr(output, 'shape'):
+        output = next((o for o in output if hasattr(o, 'shape')), None)
+
+    shape = getattr(output, 'shape', None)
+    if not shape:
+        return None, None
+
+    return int(shape[0]), int(shape[1]) if len(shape) > 1 else None
+
+
+#
+# Stages
+#
+
+class _Stage:
+    """A running stage, whose output can be set for its row / column counts"""
+
+    def __init__(self):
+        self.rows = None
+        self.cols = None
+
+    def output(self, output):
+        self.rows, self.cols = _shape(output)
+        return output
+
+
+@contextmanager
+def stage(name):
+    """
+    Records a stage of the pipeline. Stages nest, and a stage is
+    recorded under the path of the stages it runs within.
+
+    :param name:    Name of the stage
+    :return:        Context manager yielding a `_Stage`
+    """
+    s = _Stage()
+    if not enabled():
+        yield s
+        return
+
+    path = getattr(_local, 'path', ())
+    _local.path = path + (name,)
+
+    # Calls of a stage add up in one profile, a nested
+    # call of the same stage is already being profiled
+    profile = None
+    if name in _cprofile and name not in path:
+        profile = _profiles.setdefault(name, cProfile.Profile())
+
+    rss = _peak_rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    start = time.time()
+
+    if profile:
+        profile.enable()
+    try:
+        yield s
+    finally:
+        if profile:
+            profile.disable()
+
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        _local.path = path
+
+        peak = _peak_rss_mb()
+        _write({'event': 'stage',
+                'name': name,
+                'path': '/'.join(path + (name,)),
+                'start': start,
+                'wall_s': wall,
+                'cpu_s': cpu,
+                'peak_rss_mb': peak,
+                'rss_growth_mb': peak - rss if peak is not None else None,
+                'rows': s.rows,
+                'cols': s.cols})
+
+        if profile:
+            profile.dump_stats(_profile_file(name))
+
+
+def _profile_file(name):
+    # Saved next to the trace, one file per stage and process
+    return '%s-%s-%d.prof' % (os.path.splitext(_trace_file)[0], name.replace(' ', '_'), os.getpid())
+
+
+@atexit.register
+def _print_profiles():
+    for name, profile in _profiles.items():
+        print("[ INF ] cProfile of", name, "saved to", _profile_file(name))
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(CPROFILE_LINES)
+
+
+def profiled(name=None, output=None):
+    """
+    Decorator recording each call of a function as a stage
+
+    :param name:    Name of the stage, defaults to `module.function`
+    :param output:  Function of (result, *args) returning what the
+                    row / column counts are taken from, defaults to
+                    the result (i.e: `self.df` of a method building it)
+    :return:        Decorator
+    """
+    def decorator(f):
+        stage_name = name or f.__module__.rsplit('.', 1)[-1] + '.' + f.__qualname__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return f(*args, **kwargs)
+
+            with stage(stage_name) as s:
+                result = f(*args, **kwargs)
+                s.output(output(result, *args) if output else result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+#
+# Traces
+#
+
+def read_trace(trace_file):
+    """
+    :param trace_file:  Path of a JSON lines trace
+    :return:            `DataFrame` of its stages, one row per call
+    """
+    with open(trace_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    return pd.DataFrame([r for r in records if r['event'] == 'stage'])
+
+
+def summarize_trace(trace_file):
+    """
+    :param trace_file:  Path of a JSON lines trace
+    :return:            `DataFrame` of the calls, total wall / CPU time,
+                        peak RSS and largest output of each stage path
+    """
+    df = read_trace(trace_file)
+
+    return df.groupby('path').agg(calls=('name', 'size'),
+                                  wall_s=('wall_s', 'sum'),
+                                  cpu_s=('cpu_s', 'sum'),
+                                  peak_rss_mb=('peak_rss_mb', 'max'),
+                                  rows=('rows', 'max'),
+                                  cols=('cols', 'max'))
+
+
+def diff_traces(old_file, new_file):
+    """
+    Compares the stages of two runs
+
+    :param old_file:    Path of the baseline trace
+    :param new_file:    Path of the new trace
+    :return:            `DataFrame` of both summaries side by side, with
+                        the ratio of new to old wall time per stage path
+    """
+    old, new = summarize_trace(old_file), summarize_trace(new_file)
+
+    df = old.join(new, how='outer', lsuffix='_old', rsuffix='_new')
+    df['wall_ratio'] = df['wall_s_new'] / df['wall_s_old']
+
+    return df.sort_values('wall_s_new', ascending=False)
+
+
+# Traces from the environment (i.e: `PROFILE_TRACE=run.jsonl python -m src.main`),
+# also picked up by the worker processes of a profiled run
+if os.environ.get('PROFILE_TRACE') and not enabled():
+    _trace_file = os.environ['PROFILE_TRACE']
+    _cprofile = set(s for s in os.environ.get('PROFILE_STAGES', '').split(',') if s)
+    os.makedirs(os.path.dirname(_trace_file) or '.', exist_ok=True)
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 20)
+    pd.set_option('display.max_colwidth', None)
+
+    if len(sys.argv) == 2:
+        print(summarize_trace(sys.argv[1]))
+    elif len(sys.argv) == 3:
+        print(diff_traces(sys.argv[1], sys.argv[2]))
+    else:
+        print("[ ERR ] Usage: python -m src.profiling <trace> [new trace]")
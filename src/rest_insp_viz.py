@@ -3,21 +3,21 @@
 
 
 import numpy as np
-import pandas as pd
 
-from src.preprocessing.fetch import fetch_restaurant_inspection_data
+from src.preprocessing.fetch import fetch_restaurant_inspection_data, inspection_period
+from src.preprocessing.transform import NEGATIVE_RATIO, negative_downsample
 
 #
 # Prepare Initial Clean
 #
 
-ids = ['camis', 'dba', 'boro', 'building', 'street', 'phone',
+ids = ['camis', 'dba', 'boro', 'building', 'street', 'phone', 'inspection_date', 'inspection_period',
        'inspection_year', 'inspection_month', 'inspection_day']
 
 df = fetch_restaurant_inspection_data()
-df = df.loc[pd.to_numeric(df['inspection_year']) != 1900]
+df = df.loc[inspection_period(df) // 100 != 1900]
 
-df = df.drop(ids, 1)
+df = df.drop(ids, axis=1, errors='ignore')
 df = df.dropna()
 
 #
@@ -41,8 +41,8 @@ df['closed'] = is_closed_labels
 # Downsample majority class
 #
 
-open_downsample = df.loc[df['closed'] == 0].sample(sum(is_closed_labels) * 3, random_state=42)
-s = pd.concat([open_downsample, df.loc[df['closed'] == 1]])
+keep = negative_downsample(is_closed_labels, NEGATIVE_RATIO)
+s = df.iloc[keep]
 
 #
 # Re-upsample with replacement on Sub-sample set